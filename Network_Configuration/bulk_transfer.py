@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+# Reliable transfer of recorded session files between nodes over DigiMesh.
+#
+# The file is cut into numbered chunks that fill a radio payload. The sender
+# keeps a window of chunks in flight and the receiver regularly reports which
+# ones it has as a base index plus a bitmap (selective ACK), so only missing
+# chunks are sent again. When every chunk is in, the receiver checks the
+# SHA-256 of the whole file before keeping it.
+#
+# The receiver keeps partial files as <name>.part with a <name>.part.json
+# next to it saying which chunks arrived, so a transfer cut off by a link drop
+# or a reboot carries on where it stopped when the sender offers it again.
+#
+#   sender:    await send_file(xbee, '0013A200415A8686', 'session.log')
+#   receiver:  BulkReceiver(xbee, '/home/pi/incoming').start()
+#
+# Messages all start with MAGIC, then the message type and the transfer id
+# (the first 4 bytes of the file's SHA-256, so the same file is always the
+# same transfer):
+#
+#   OFFER  size I, chunk size H, chunks I, sha256 32s, name
+#   STATE  base I, bitmap            chunks base, base+1, ... received or not
+#   DATA   index I, data
+#   DONE   status B                  0 = hash matched, 1 = mismatch
+
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import time
+
+from xbee_async import XBeeError, to_address
+
+MAGIC = 0xB7
+
+MSG_OFFER = 0x01
+MSG_STATE = 0x02
+MSG_DATA = 0x03
+MSG_DONE = 0x04
+
+HEADER = struct.Struct('<BBI')
+OFFER = struct.Struct('<IHI32s')
+STATE = struct.Struct('<I')
+DATA = struct.Struct('<I')
+DONE = struct.Struct('<B')
+
+DONE_OK = 0
+DONE_BAD_HASH = 1
+
+DEFAULT_MAX_PAYLOAD = 73
+
+
+class TransferError(XBeeError):
+    pass
+
+
+def file_digest(path, blocksize=1 << 16):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.digest()
+
+
+def _message(kind, transfer_id, *parts):
+    return HEADER.pack(MAGIC, kind, transfer_id) + b''.join(parts)
+
+
+def _parse(frame):
+    data = frame['rf_data']
+    if len(data) < HEADER.size or data[0] != MAGIC:
+        return None
+    magic, kind, transfer_id = HEADER.unpack_from(data, 0)
+    return kind, transfer_id, data[HEADER.size:]
+
+
+# ----------------------------------------------------------------- receiver
+
+class _Incoming(object):
+    def __init__(self, directory, transfer_id, size, chunk_size, count, digest, name):
+        self.id = transfer_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.count = count
+        self.digest = digest
+        self.name = os.path.basename(name) or '{:08x}'.format(transfer_id)
+        self.path = os.path.join(directory, self.name)
+        self.part = self.path + '.part'
+        self.state_path = self.part + '.json'
+        self.have = bytearray(count)
+        self.received = 0
+        self.base = 0
+        self.unsaved = 0
+        self._load()
+        self.file = open(self.part, 'r+b' if os.path.exists(self.part) else 'w+b')
+
+    def _load(self):
+        # Pick up a partial transfer of the same file
+        if not (os.path.exists(self.state_path) and os.path.exists(self.part)):
+            return
+        with open(self.state_path) as f:
+            state = json.load(f)
+        if state.get('sha256') != self.digest.hex() or state.get('chunk_size') != self.chunk_size:
+            return
+        have = bytearray.fromhex(state['have'])
+        if len(have) == self.count:
+            self.have = have
+            self.received = sum(have)
+            self._advance()
+
+    def save(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        state = {'sha256': self.digest.hex(), 'size': self.size, 'chunk_size': self.chunk_size,
+                 'have': self.have.hex()}
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+        self.unsaved = 0
+
+    def _advance(self):
+        while self.base < self.count and self.have[self.base]:
+            self.base += 1
+
+    def write(self, index, data):
+        if index >= self.count or self.have[index]:
+            return False
+        self.file.seek(index * self.chunk_size)
+        self.file.write(data)
+        self.have[index] = 1
+        self.received += 1
+        self.unsaved += 1
+        self._advance()
+        return True
+
+    def bitmap(self, nbytes):
+        # Bit i of the bitmap is chunk base + i
+        bits = self.have[self.base:self.base + 8 * nbytes]
+        out = bytearray((len(bits) + 7) // 8)
+        for i, got in enumerate(bits):
+            if got:
+                out[i >> 3] |= 1 << (i & 7)
+        return bytes(out)
+
+    def complete(self):
+        return self.received == self.count
+
+    def finish(self):
+        # Check the hash and move the file into place. Returns a DONE status.
+        self.file.truncate(self.size)
+        self.file.close()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        if file_digest(self.part) != self.digest:
+            os.remove(self.part)
+            return DONE_BAD_HASH
+        os.replace(self.part, self.path)
+        return DONE_OK
+
+
+class BulkReceiver(object):
+    def __init__(self, xbee, directory, ack_every=8, save_every=64, max_payload=DEFAULT_MAX_PAYLOAD):
+        self.xbee = xbee
+        self.directory = directory
+        # Send a STATE after this many new chunks, and save progress to disk
+        # after save_every
+        self.ack_every = ack_every
+        self.save_every = save_every
+        self.bitmap_bytes = max_payload - HEADER.size - STATE.size
+        self._incoming = {}
+        # transfer id -> (path, sha256) of files received, so a sender that
+        # missed the DONE gets it again while the file is still there
+        self._finished = {}
+        self._subscription = None
+        # Called with the final path of every file received
+        self.on_file = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._subscription = self.xbee.subscribe(self._on_frame, 'rx')
+        return self
+
+    def stop(self):
+        if self._subscription is not None:
+            self.xbee.unsubscribe(self._subscription)
+            self._subscription = None
+        for incoming in self._incoming.values():
+            incoming.save()
+            incoming.file.close()
+        self._incoming.clear()
+
+    def _reply(self, addr, kind, transfer_id, *parts):
+        self.xbee.send_nowait(addr, _message(kind, transfer_id, *parts))
+
+    def _send_state(self, addr, incoming):
+        self._reply(addr, MSG_STATE, incoming.id, STATE.pack(incoming.base),
+                    incoming.bitmap(self.bitmap_bytes))
+
+    def _on_frame(self, frame):
+        message = _parse(frame)
+        if message is None:
+            return
+        kind, transfer_id, body = message
+        addr = frame['source_addr_long']
+
+        if kind == MSG_OFFER:
+            if len(body) < OFFER.size:
+                return
+            if transfer_id in self._finished:
+                path, digest = self._finished[transfer_id]
+                if os.path.exists(path) and file_digest(path) == digest:
+                    self._reply(addr, MSG_DONE, transfer_id, DONE.pack(DONE_OK))
+                    return
+                # Moved away or changed since, receive it again
+                del self._finished[transfer_id]
+            incoming = self._incoming.get(transfer_id)
+            if incoming is None:
+                size, chunk_size, count, digest = OFFER.unpack_from(body, 0)
+                name = bytes(body[OFFER.size:]).decode('utf-8', 'replace')
+                incoming = _Incoming(self.directory, transfer_id, size, chunk_size, count, digest, name)
+                self._incoming[transfer_id] = incoming
+            # The OFFER doubles as a poll, the sender re-sends it whenever it
+            # hasn't heard from us
+            if incoming.complete():
+                self._complete(addr, incoming)
+            else:
+                self._send_state(addr, incoming)
+
+        elif kind == MSG_DATA:
+            incoming = self._incoming.get(transfer_id)
+            if incoming is None or len(body) < DATA.size:
+                return
+            index, = DATA.unpack_from(body, 0)
+            gap = incoming.base < index < incoming.count and not incoming.have[index - 1]
+            if incoming.write(index, body[DATA.size:]):
+                if incoming.complete():
+                    self._complete(addr, incoming)
+                    return
+                if incoming.unsaved >= self.save_every:
+                    incoming.save()
+                if gap or incoming.received % self.ack_every == 0:
+                    # A hole before this chunk is a NACK for the missing ones
+                    self._send_state(addr, incoming)
+
+    def _complete(self, addr, incoming):
+        status = incoming.finish()
+        del self._incoming[incoming.id]
+        # After a bad hash it starts over next time it is offered
+        if status == DONE_OK:
+            self._finished[incoming.id] = (incoming.path, incoming.digest)
+            if self.on_file is not None:
+                self.on_file(incoming.path)
+        self._reply(addr, MSG_DONE, incoming.id, DONE.pack(status))
+
+
+# ------------------------------------------------------------------- sender
+
+async def send_file(xbee, peer, path, window=32, max_payload=None, rto=2.0, max_idle=30.0,
+                    name=None, attempts=3):
+    # Send one file to peer. Returns once the receiver confirmed the hash.
+    # Raises TransferError when the receiver has been silent for max_idle
+    # seconds; calling again later resumes the transfer.
+    peer = to_address(peer)
+    if max_payload is None:
+        max_payload = int.from_bytes(await xbee.at_command('NP'), 'big')
+    chunk_size = max_payload - HEADER.size - DATA.size
+    bitmap_bytes = max_payload - HEADER.size - STATE.size
+    window = min(window, 8 * bitmap_bytes)
+
+    size = os.path.getsize(path)
+    digest = file_digest(path)
+    transfer_id = int.from_bytes(digest[:4], 'little')
+    count = max(1, (size + chunk_size - 1) // chunk_size)
+    name = (name or os.path.basename(path)).encode('utf-8')
+    name = name[:max_payload - HEADER.size - OFFER.size]
+    offer = _message(MSG_OFFER, transfer_id, OFFER.pack(size, chunk_size, count, digest), name)
+
+    acked = bytearray(count)
+    sent_at = {}
+    # 'stated' is set by the first STATE, until then the receiver may still
+    # be loading a partial file whose chunks shouldn't be sent again
+    state = {'base': 0, 'done': None, 'heard': time.time(), 'stated': False}
+    news = asyncio.Event()
+
+    def on_frame(frame):
+        if frame['source_addr_long'] != peer:
+            return
+        message = _parse(frame)
+        if message is None or message[1] != transfer_id:
+            return
+        kind, _, body = message
+        if kind == MSG_STATE and len(body) >= STATE.size:
+            base, = STATE.unpack_from(body, 0)
+            for i in range(state['base'], min(base, count)):
+                acked[i] = 1
+            bitmap = body[STATE.size:]
+            for i in range(min(8 * len(bitmap), count - base)):
+                if bitmap[i >> 3] & (1 << (i & 7)):
+                    acked[base + i] = 1
+            state['base'] = max(state['base'], base)
+            state['stated'] = True
+        elif kind == MSG_DONE and len(body) >= DONE.size:
+            state['done'] = body[0]
+        else:
+            return
+        state['heard'] = time.time()
+        news.set()
+
+    async def send_chunk(index, f):
+        f.seek(index * chunk_size)
+        try:
+            await xbee.send(peer, _message(MSG_DATA, transfer_id, DATA.pack(index), f.read(chunk_size)),
+                            retries=0)
+            # The retransmit timer starts once the chunk has left the radio,
+            # not while it is still queued behind the rest of the window
+            sent_at[index] = time.time()
+        except XBeeError:
+            # Still missing, the next STATE or timeout sends it again
+            sent_at.pop(index, None)
+
+    subscription = xbee.subscribe(on_frame, 'rx')
+    in_flight = set()
+    try:
+        with open(path, 'rb') as f:
+            xbee.send_nowait(peer, offer)
+            offered = polled = time.time()
+            while True:
+                if state['done'] == DONE_OK:
+                    return True
+                if state['done'] == DONE_BAD_HASH:
+                    attempts -= 1
+                    if attempts <= 0:
+                        raise TransferError('receiver keeps getting a bad hash for {}'.format(path))
+                    acked[:] = bytes(count)
+                    sent_at.clear()
+                    state['base'] = 0
+                    state['done'] = None
+                    state['stated'] = False
+                    xbee.send_nowait(peer, offer)
+                    offered = time.time()
+
+                now = time.time()
+                if now - state['heard'] > max_idle:
+                    raise TransferError('no answer from receiver for {:.0f} s'.format(max_idle))
+
+                # Fill the window with chunks never sent or sent over rto ago
+                # and still not acknowledged. On a resume the first STATE
+                # says what the receiver already has, so wait up to rto
+                # for it before sending anything.
+                while state['base'] < count and acked[state['base']]:
+                    state['base'] += 1
+                end = min(state['base'] + window, count)
+                if not state['stated'] and now - offered < rto:
+                    end = state['base']
+                for index in range(state['base'], end):
+                    if acked[index] or now - sent_at.get(index, -rto) < rto:
+                        continue
+                    sent_at[index] = float('inf')
+                    task = asyncio.ensure_future(send_chunk(index, f))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+
+                # Poll with an OFFER when the receiver has gone quiet, which
+                # also restarts a transfer the receiver forgot about
+                if now - max(state['heard'], polled) > rto:
+                    xbee.send_nowait(peer, offer)
+                    polled = now
+
+                news.clear()
+                try:
+                    await asyncio.wait_for(news.wait(), rto / 2)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        xbee.unsubscribe(subscription)
+        for task in in_flight:
+            task.cancel()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from link_tuner import load_config
+    from xbee_async import XBeeClient
+    from xbee_devices import xbeeDevicesMacAddress
+
+    link = load_config()
+    parser = argparse.ArgumentParser(description='Send or receive session files over the mesh')
+    parser.add_argument('--port', default='/dev/serial0')
+    parser.add_argument('--baud', type=int, default=link['baudrate'], help='default from link_tuner.py')
+    sub = parser.add_subparsers(dest='command')
+    send = sub.add_parser('send')
+    send.add_argument('peer', help='node name or 64-bit address')
+    send.add_argument('files', nargs='+')
+    receive = sub.add_parser('receive')
+    receive.add_argument('directory')
+    args = parser.parse_args()
+
+    async def main():
+        async with XBeeClient(args.port, args.baud, rtscts=link['rtscts']) as xbee:
+            if args.command == 'send':
+                peer = xbeeDevicesMacAddress.get(args.peer, args.peer)
+                for path in args.files:
+                    started = time.time()
+                    await send_file(xbee, peer, path)
+                    print('{}: {:.0f} B/s'.format(path, os.path.getsize(path) / (time.time() - started)))
+            else:
+                receiver = BulkReceiver(xbee, args.directory).start()
+                receiver.on_file = print
+                try:
+                    await asyncio.Event().wait()
+                finally:
+                    receiver.stop()
+
+    asyncio.run(main())
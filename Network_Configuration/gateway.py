@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Ground station gateway for several CATMAN nodes on one radio.
+#
+# receiverScript.py prints whatever text arrives, so frames from CATMAN1 and
+# CATMAN2 end up mixed in one stream. The gateway decodes API frames, sorts
+# them by source address and gives every node its own worker thread that
+# decodes the telemetry batches and writes them to that node's log files.
+#
+# The serial port is read on the event loop and never waits for the disk. The
+# per node queues are bounded: when one fills up past its high water mark
+# the gateway stops reading the port until the workers catch up, which with
+# RTS/CTS flow control makes the radio hold the frames instead of the UART
+# dropping them. Without flow control it keeps reading and a full queue drops
+# frames, so at least every loss shows up in the counts. Every few seconds it
+# prints frame and byte rates, missing batches (sequence gaps), drops and
+# queue depth per node.
+#
+#   python3 gateway.py --out /home/pi/sessions --rtscts
+
+import argparse
+import asyncio
+import os
+import queue
+import threading
+import time
+
+from bulk_transfer import MAGIC as BULK_MAGIC
+from link_tuner import load_config
+from route_table import RouteTable
+from telemetry_batcher import HEADER, STREAM_FORMATS, decode_batch
+from time_sync import MAGIC as SYNC_MAGIC
+from xbee_async import XBeeClient
+
+# A sequence number up to this far behind the newest is a duplicate or a
+# late batch, further back means the node restarted its counters
+REORDER_WINDOW = 64
+
+# Column names for the per stream log files
+STREAM_FILES = {
+    1: ('imu.txt', 'Time, Acc, GYR, Mag'),
+    2: ('gps.txt', 'Time, Lat, Lon, Alt'),
+}
+
+
+class NodeWorker(object):
+    # Decodes and writes the payloads of one node on its own thread
+    def __init__(self, name, directory, maxsize=4096):
+        self.name = name
+        self.directory = directory
+        self.queue = queue.Queue(maxsize)
+        self._files = {}
+        self._thread = threading.Thread(target=self._run, name='node-' + name, daemon=True)
+
+        # Updated on the event loop
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self._sequence = {}
+        self.gaps = 0
+        self.duplicates = 0     # repeated or late batches
+        self.restarts = 0
+        # Updated on the worker thread
+        self.batches = 0
+        self.samples = 0
+        self.raw = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def put(self, t, payload):
+        # Called on the event loop. Returns False if the queue was full.
+        self.frames += 1
+        self.bytes += len(payload)
+        self._check_sequence(payload)
+        try:
+            self.queue.put_nowait((t, payload))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _check_sequence(self, payload):
+        if not is_telemetry(payload):
+            return
+        stream_id, sequence = payload[0], payload[1] | payload[2] << 8
+        last = self._sequence.get(stream_id)
+        if last is not None:
+            ahead = (sequence - last) & 0xFFFF
+            if 0 < ahead < 0x8000:
+                self.gaps += ahead - 1
+            elif ahead == 0 or 0x10000 - ahead <= REORDER_WINDOW:
+                # Repeated after a lost TX status, or overtaken by a newer
+                # batch. Keep the newest sequence number.
+                self.duplicates += 1
+                return
+            else:
+                self.restarts += 1
+        self._sequence[stream_id] = sequence
+
+    def _file(self, key):
+        f = self._files.get(key)
+        if f is None:
+            name, header = STREAM_FILES.get(key, ('raw.txt', 'Time, Payload'))
+            path = os.path.join(self.directory, name)
+            new = not os.path.exists(path)
+            f = self._files[key] = open(path, 'a')
+            if new:
+                f.write(header + '\n')
+        return f
+
+    def _run(self):
+        while True:
+            # Take everything that is waiting and write it in one go, so a
+            # slow disk costs one write per backlog instead of one per frame
+            items = [self.queue.get()]
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = items[-1] is None
+            lines = {}
+            for item in items:
+                if item is None:
+                    continue
+                self._decode(item[0], item[1], lines)
+            for key, chunk in lines.items():
+                f = self._file(key)
+                f.write(''.join(chunk))
+                f.flush()
+            if stop:
+                for f in self._files.values():
+                    f.close()
+                return
+
+    def _decode(self, t, payload, lines):
+        if is_telemetry(payload):
+            try:
+                stream_id, sequence, samples = decode_batch(payload)
+            except Exception:
+                samples = None
+            if samples is not None:
+                out = lines.setdefault(stream_id, [])
+                for st, values in samples:
+                    out.append('{}\t{}\n'.format(st, '\t'.join(str(v) for v in values)))
+                self.batches += 1
+                self.samples += len(samples)
+                return
+        self.raw += 1
+        lines.setdefault('raw', []).append('{}\t{}\n'.format(t, payload.hex()))
+
+
+def is_telemetry(payload):
+    return len(payload) >= HEADER.size and payload[0] in STREAM_FORMATS
+
+
+class Gateway(object):
+    def __init__(self, xbee, directory, routes=None, queue_size=4096, high_water=0.75, low_water=0.25):
+        self.xbee = xbee
+        self.directory = directory
+        self.routes = routes
+        self.queue_size = queue_size
+        self.high_water = int(queue_size * high_water)
+        self.low_water = int(queue_size * low_water)
+        self.workers = {}
+        self._subscription = None
+        self._last_report = (time.time(), {})
+        self.pauses = 0
+
+    def start(self):
+        self._subscription = self.xbee.subscribe(self._on_rx, 'rx')
+        return self
+
+    def stop(self):
+        if self._subscription is not None:
+            self.xbee.unsubscribe(self._subscription)
+            self._subscription = None
+        for worker in self.workers.values():
+            worker.stop()
+
+    def _worker(self, addr):
+        worker = self.workers.get(addr)
+        if worker is None:
+            name = addr.hex().upper()
+            if self.routes is not None:
+                node = self.routes.get(addr)
+                if node is not None and node.ni:
+                    name = node.ni
+            worker = NodeWorker(name, os.path.join(self.directory, name), self.queue_size).start()
+            self.workers[addr] = worker
+        return worker
+
+    def _on_rx(self, frame):
+        if frame['rf_data'][:1] in (bytes((BULK_MAGIC,)), bytes((SYNC_MAGIC,))):
+            # File transfers and clock sync have their own handlers
+            return
+        worker = self._worker(frame['source_addr_long'])
+        # rf_data points into the receive buffer, the worker gets a copy
+        worker.put(time.time(), bytes(frame['rf_data']))
+        # Only pause with flow control. Without it the radio keeps sending
+        # and the frames would be lost in the UART, uncounted.
+        if (self.xbee.rtscts and worker.queue.qsize() >= self.high_water
+                and not self.xbee.reading_paused):
+            self.xbee.pause_reading()
+            self.pauses += 1
+            asyncio.ensure_future(self._resume_when_drained())
+
+    async def _resume_when_drained(self):
+        while any(w.queue.qsize() > self.low_water for w in self.workers.values()):
+            await asyncio.sleep(0.01)
+        self.xbee.resume_reading()
+
+    def report(self):
+        # Per node rates since the last report, as a list of lines
+        now = time.time()
+        then, before = self._last_report
+        elapsed = max(now - then, 1e-6)
+        lines = []
+        counts = {}
+        for addr, w in self.workers.items():
+            frames0, bytes0 = before.get(addr, (0, 0))
+            counts[addr] = (w.frames, w.bytes)
+            lines.append('{:16s} {:6.1f} frames/s {:8.1f} B/s  gaps {:4d}  dups {:4d}  restarts {:2d}  '
+                         'queued {:4d}  dropped {:4d}  samples {:7d}'.format(
+                             w.name, (w.frames - frames0) / elapsed, (w.bytes - bytes0) / elapsed,
+                             w.gaps, w.duplicates, w.restarts, w.queue.qsize(), w.dropped, w.samples))
+        self._last_report = (now, counts)
+        return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Receive and log telemetry from several nodes')
+    parser.add_argument('--port', default='/dev/serial0')
+    link = load_config()
+    parser.add_argument('--baud', type=int, default=link['baudrate'], help='default from link_tuner.py')
+    parser.add_argument('--rtscts', action=argparse.BooleanOptionalAction, default=link['rtscts'],
+                        help='RTS/CTS flow control, needed to pause reading without losing frames')
+    parser.add_argument('--out', default='sessions')
+    parser.add_argument('--report', type=float, default=5.0, help='seconds between rate reports')
+    args = parser.parse_args()
+
+    if not args.rtscts:
+        print('no RTS/CTS flow control: reading never pauses, frames a full queue drops show as dropped')
+
+    async def main():
+        routes = RouteTable()
+        async with XBeeClient(args.port, args.baud, rtscts=args.rtscts) as xbee:
+            routes.attach(xbee)
+            gateway = Gateway(xbee, args.out, routes).start()
+            try:
+                while True:
+                    await asyncio.sleep(args.report)
+                    for line in gateway.report():
+                        print(line)
+            finally:
+                gateway.stop()
+                routes.save()
+
+    asyncio.run(main())
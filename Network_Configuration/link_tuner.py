@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Finds the fastest working serial settings between the Pi and its XBee.
+#
+# Every script in this directory opens the radio at 9600 baud with no flow
+# control. This tool tries each serial rate (ATBD), with and without RTS/CTS
+# flow control (ATD6/ATD7), and for each one times real transfers to a peer
+# node at a few payload sizes up to the radio's maximum (ATNP).
+#
+#   python3 link_tuner.py --peer CATMAN2 --out link_config.json --write
+#
+# Nothing is saved to the radio's flash unless --write is given, so if a baud
+# switch goes badly wrong a power cycle brings the radio back to its old
+# settings. Before that, the tuner scans every rate to find the radio again.
+#
+# The JSON file records the settings the radio is left at, which the gateway
+# and the other scripts open the port with: the best one with --write, the
+# one it started at without (the best is still in the file, under 'best').
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from xbee_async import XBeeClient, XBeeError, to_address
+from xbee_devices import xbeeDevicesMacAddress
+
+# ATBD parameter for each serial rate
+BAUD_CODES = {
+    1200: 0, 2400: 1, 4800: 2, 9600: 3, 19200: 4,
+    38400: 5, 57600: 6, 115200: 7, 230400: 8,
+}
+DEFAULT_BAUDS = [9600, 19200, 38400, 57600, 115200]
+
+# Values of ATD6 (RTS) and ATD7 (CTS) for off and on
+FLOW_CONTROL_OFF = (0, 0)
+FLOW_CONTROL_ON = (1, 1)
+
+CONFIG_FILE = 'link_config.json'
+
+
+def load_config(path=CONFIG_FILE):
+    # Serial settings the tuner left the radio at, or the old defaults if it
+    # never ran
+    if not os.path.exists(path):
+        return {'baudrate': 9600, 'rtscts': False}
+    with open(path) as f:
+        return json.load(f)
+
+
+async def probe(xbee, timeout=0.5):
+    # True if the radio answers an AT command at the port's current settings
+    try:
+        await xbee.at_command('BD', timeout=timeout)
+        return True
+    except XBeeError:
+        return False
+
+
+async def find_radio(xbee, bauds=None):
+    # Scan serial rates until the radio answers. Returns the rate or None.
+    for baud in [xbee.baudrate] + sorted(bauds or BAUD_CODES, reverse=True):
+        for rtscts in (False, True):
+            xbee.reconfigure(baudrate=baud, rtscts=rtscts)
+            if await probe(xbee):
+                return baud
+    return None
+
+
+def _settings(baud, rtscts):
+    flow = FLOW_CONTROL_ON if rtscts else FLOW_CONTROL_OFF
+    return (('D6', flow[0]), ('D7', flow[1]), ('BD', BAUD_CODES[baud]))
+
+
+async def _apply(xbee, baud, rtscts):
+    # Queue the new settings (they change nothing yet) and apply them all at
+    # once with AC. Its response may come at either rate, so don't count on
+    # it. Raises XBeeError if queueing failed, nothing was applied then.
+    for command, value in _settings(baud, rtscts):
+        await xbee.at_command(command, value, queue=True)
+    try:
+        await xbee.at_command('AC')
+    except XBeeError:
+        pass
+
+
+async def recover(xbee, baud, rtscts):
+    # Put the radio and the port back to baud and rtscts. Queueing the old
+    # values also overwrites anything left queued by a failed switch, which
+    # the next command would otherwise apply. If the radio can't be heard at
+    # the old settings either, scan for it and stay wherever it is.
+    xbee.reconfigure(baudrate=baud, rtscts=rtscts)
+    try:
+        await _apply(xbee, baud, rtscts)
+        await asyncio.sleep(0.1)
+        if await probe(xbee, timeout=1.0):
+            return True
+    except XBeeError:
+        pass
+    if await find_radio(xbee) is None:
+        raise XBeeError('radio not answering at any rate, power cycle it')
+    return False
+
+
+async def switch(xbee, baud, rtscts):
+    # Move both the radio and the port to a new rate and flow control. If
+    # anything goes wrong, go back, and failing that scan for the radio.
+    old_baud, old_rtscts = xbee.baudrate, xbee.rtscts
+    try:
+        await _apply(xbee, baud, rtscts)
+    except XBeeError:
+        print('could not queue {} baud rtscts={}, recovering'.format(baud, rtscts))
+        await recover(xbee, old_baud, old_rtscts)
+        return False
+
+    await asyncio.sleep(0.1)
+    xbee.reconfigure(baudrate=baud, rtscts=rtscts)
+    if await probe(xbee, timeout=1.0):
+        return True
+
+    print('radio lost after switching to {} baud, recovering'.format(baud))
+    await recover(xbee, old_baud, old_rtscts)
+    return False
+
+
+async def trial(xbee, peer, size, duration, window):
+    # Keep `window` transmits of `size` bytes in flight for `duration`
+    # seconds. Returns (delivered bytes per second, failed sends).
+    payload = bytes(range(256)) * (size // 256 + 1)
+    payload = payload[:size]
+    delivered = [0, 0]
+    deadline = time.time() + duration
+
+    async def sender():
+        while time.time() < deadline:
+            try:
+                await xbee.send(peer, payload, retries=0)
+                delivered[0] += size
+            except XBeeError:
+                delivered[1] += 1
+
+    started = time.time()
+    await asyncio.gather(*[sender() for _ in range(window)])
+    return delivered[0] / (time.time() - started), delivered[1]
+
+
+async def tune(args):
+    peer = to_address(xbeeDevicesMacAddress.get(args.peer, args.peer))
+    xbee = XBeeClient(args.port, args.baud, timeout=2.0)
+    await xbee.open()
+    results = []
+    try:
+        if not await probe(xbee):
+            print('no answer at {} baud, scanning'.format(args.baud))
+            if await find_radio(xbee) is None:
+                raise XBeeError('radio not found')
+        start = (xbee.baudrate, xbee.rtscts)
+        max_payload = int.from_bytes(await xbee.at_command('NP'), 'big')
+        sizes = sorted(set(min(s, max_payload) for s in args.sizes + [max_payload]))
+        print('radio found at {} baud, maximum payload {} bytes'.format(xbee.baudrate, max_payload))
+
+        for baud in args.bauds:
+            for rtscts in (False, True):
+                if not await switch(xbee, baud, rtscts):
+                    print('{} baud rtscts={}: switch failed'.format(baud, rtscts))
+                    continue
+                for size in sizes:
+                    rate, failed = await trial(xbee, peer, size, args.duration, args.window)
+                    print('{:6d} baud rtscts={:d} {:3d} byte payloads: {:8.1f} B/s, {} failed'.format(
+                        baud, rtscts, size, rate, failed))
+                    results.append({'baudrate': baud, 'rtscts': rtscts, 'payload': size,
+                                    'throughput': rate, 'failed': failed})
+
+        if not results:
+            raise XBeeError('no setting worked')
+        # Failures cost retransmissions later, so rank by clean throughput
+        best = max(results, key=lambda r: (r['failed'] == 0, r['throughput']))
+        await switch(xbee, best['baudrate'], best['rtscts'])
+        if args.write:
+            await xbee.at_command('WR')
+        else:
+            await switch(xbee, *start)
+        # What the radio will be at from now on, also after a power cycle
+        config = {'baudrate': xbee.baudrate, 'rtscts': xbee.rtscts, 'saved_to_radio': args.write,
+                  'max_payload': max_payload, 'best': best, 'trials': results}
+        with open(args.out, 'w') as f:
+            json.dump(config, f, indent=2)
+        print('best: {baudrate} baud, rtscts={rtscts}, {payload} byte payloads, '
+              '{throughput:.1f} B/s'.format(**best))
+        print('radio left at {baudrate} baud, rtscts={rtscts} -> {0}'.format(args.out, **config))
+    finally:
+        xbee.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure XBee link throughput per serial setting')
+    parser.add_argument('--port', default='/dev/serial0')
+    parser.add_argument('--baud', type=int, default=9600, help='rate the radio is at now')
+    parser.add_argument('--peer', required=True, help='node name or 64-bit address to send to')
+    parser.add_argument('--bauds', type=int, nargs='+', default=DEFAULT_BAUDS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 32, 64])
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per trial')
+    parser.add_argument('--window', type=int, default=8, help='transmits kept in flight')
+    parser.add_argument('--out', default=CONFIG_FILE)
+    parser.add_argument('--write', action='store_true', help='save the best setting on the radio (ATWR)')
+    asyncio.run(tune(parser.parse_args()))
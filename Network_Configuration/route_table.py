@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# Neighbour and route table for the mesh, keyed by 64-bit address.
+#
+# init_network.js runs a full network discovery (ND) before every send, which
+# keeps the radio busy for seconds. Here the results of ND are cached with a
+# time to live, together with the RSSI, when each node was last heard and how
+# deliveries to it went. Received frames refresh entries for free. Senders
+# look destinations up in a dict and only pay for a new ND when the entry is
+# missing, too old, or deliveries to it keep failing. A destination that ND
+# didn't help with isn't searched for again right away: the wait before the
+# next scan on its behalf doubles each time, up to a few minutes.
+#
+#   routes = RouteTable('nodes.json').attach(xbee)
+#   await routes.send(xbee, 'CATMAN2', b'hello')
+#   routes.save()
+
+import asyncio
+import json
+import os
+import time
+
+from xbee_async import XBeeError, to_address
+from xbee_devices import xbeeDevicesMacAddress
+
+DEFAULT_FILE = 'nodes.json'
+
+
+class Node(object):
+    FIELDS = ('ni', 'rssi', 'last_seen', 'discovered', 'successes', 'failures',
+              'consecutive_failures', 'static')
+
+    def __init__(self, addr, ni='', static=False):
+        self.addr = addr
+        self.ni = ni
+        self.rssi = None          # dBm, from ND or ATDB after a received frame
+        self.last_seen = 0.0      # wall clock time anything was heard from it
+        self.discovered = 0.0     # wall clock time of the last ND answer
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.static = static
+
+    @property
+    def delivery_ratio(self):
+        total = self.successes + self.failures
+        return self.successes / float(total) if total else None
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, addr, data):
+        node = cls(addr)
+        for name in cls.FIELDS:
+            if name in data:
+                setattr(node, name, data[name])
+        return node
+
+    def __repr__(self):
+        return 'Node({} {!r} rssi={} seen={:.0f}s ago ok={} failed={})'.format(
+            self.addr.hex().upper(), self.ni, self.rssi, time.time() - self.last_seen,
+            self.successes, self.failures)
+
+
+class RouteTable(object):
+    def __init__(self, path=DEFAULT_FILE, ttl=600.0, max_failures=3, known=xbeeDevicesMacAddress,
+                 rediscover_interval=30.0, max_rediscover_interval=600.0):
+        self.path = path
+        # Entries not heard from for ttl seconds are stale, and so are entries
+        # with max_failures deliveries in a row failing
+        self.ttl = ttl
+        self.max_failures = max_failures
+        # Seconds before a destination ND didn't resolve may trigger another
+        # ND, doubling up to the maximum
+        self.rediscover_interval = rediscover_interval
+        self.max_rediscover_interval = max_rediscover_interval
+        self._searched = {}
+        self.nodes = {}
+        self.names = {}
+        self._discovery = None
+        self._subscription = None
+        self._rssi_asked = {}
+
+        # Known nodes are always resolvable, but are still rediscovered when
+        # deliveries to them keep failing
+        for name, addr in (known or {}).items():
+            self.add(to_address(addr), name, static=True)
+        if path and os.path.exists(path):
+            self.load()
+
+    # ------------------------------------------------------------- entries
+
+    def add(self, addr, ni=None, static=False):
+        node = self.nodes.get(addr)
+        if node is None:
+            node = self.nodes[addr] = Node(addr, ni or '', static)
+        if ni:
+            if node.ni and node.ni != ni:
+                self.names.pop(node.ni, None)
+            node.ni = ni
+            self.names[ni] = addr
+        node.static = node.static or static
+        return node
+
+    def get(self, dest):
+        # Node for a name, hex address or raw address, or None
+        addr = self.names.get(dest) if isinstance(dest, str) else None
+        if addr is None:
+            try:
+                addr = to_address(dest)
+            except ValueError:
+                return None
+        return self.nodes.get(addr)
+
+    def resolve(self, dest):
+        node = self.get(dest)
+        return node.addr if node is not None else None
+
+    def is_stale(self, node, now=None):
+        now = time.time() if now is None else now
+        if node.consecutive_failures >= self.max_failures:
+            return True
+        if node.static:
+            return False
+        return now - max(node.last_seen, node.discovered) > self.ttl
+
+    def stale(self):
+        now = time.time()
+        return [node for node in self.nodes.values() if self.is_stale(node, now)]
+
+    # ------------------------------------------------------------ learning
+
+    def seen(self, addr, rssi=None):
+        node = self.add(addr)
+        node.last_seen = time.time()
+        if rssi is not None:
+            node.rssi = rssi
+        return node
+
+    def record_delivery(self, addr, ok):
+        node = self.add(addr)
+        if ok:
+            node.successes += 1
+            node.consecutive_failures = 0
+            node.last_seen = time.time()
+        else:
+            node.failures += 1
+            node.consecutive_failures += 1
+
+    def learn_discovery(self, found):
+        # found: list of dicts from XBeeClient.discover_nodes()
+        now = time.time()
+        for info in found:
+            node = self.add(info['addr'], info.get('ni'))
+            node.discovered = node.last_seen = now
+            node.consecutive_failures = 0
+            if 'rssi' in info:
+                node.rssi = info['rssi']
+
+    def attach(self, xbee, rssi_interval=None):
+        # Learn from every frame received on xbee. With rssi_interval set,
+        # also ask the radio for the RSSI of the last packet (ATDB) at most
+        # that often per node.
+        def on_rx(frame):
+            addr = frame['source_addr_long']
+            self.seen(addr)
+            if rssi_interval is not None:
+                now = time.time()
+                if now - self._rssi_asked.get(addr, 0) >= rssi_interval:
+                    self._rssi_asked[addr] = now
+                    asyncio.ensure_future(self._sample_rssi(xbee, addr))
+        self._subscription = xbee.subscribe(on_rx, 'rx')
+        return self
+
+    def detach(self, xbee):
+        if self._subscription is not None:
+            xbee.unsubscribe(self._subscription)
+            self._subscription = None
+
+    async def _sample_rssi(self, xbee, addr):
+        try:
+            db = await xbee.at_command('DB', timeout=1.0)
+        except XBeeError:
+            return
+        if db:
+            self.nodes[addr].rssi = -db[-1]
+
+    # ----------------------------------------------------------- discovery
+
+    async def discover(self, xbee):
+        # Run ND, sharing one scan between everybody who asks while it runs
+        if self._discovery is None:
+            self._discovery = asyncio.ensure_future(xbee.discover_nodes())
+            self._discovery.add_done_callback(self._discovery_done)
+        found = await asyncio.shield(self._discovery)
+        return found
+
+    def _discovery_done(self, task):
+        self._discovery = None
+        if not task.cancelled() and task.exception() is None:
+            self.learn_discovery(task.result())
+
+    async def lookup(self, xbee, dest):
+        # Address for dest, running ND only if we don't know it or it's
+        # stale, and not again soon if that didn't help. Between scans a
+        # stale entry is still used.
+        node = self.get(dest)
+        if node is None or self.is_stale(node):
+            key = node.addr if node is not None else dest
+            now = time.time()
+            next_scan, interval = self._searched.get(key, (0.0, self.rediscover_interval))
+            if now >= next_scan:
+                await self.discover(xbee)
+                node = self.get(dest)
+                if node is not None and not self.is_stale(node):
+                    self._searched.pop(key, None)
+                else:
+                    self._searched[key] = (time.time() + interval,
+                                           min(2 * interval, self.max_rediscover_interval))
+        if node is None:
+            raise XBeeError('node {} not found'.format(dest))
+        return node.addr
+
+    async def send(self, xbee, dest, data, **kwargs):
+        # xbee.send() with the destination looked up and the outcome recorded
+        addr = await self.lookup(xbee, dest)
+        try:
+            status = await xbee.send(addr, data, **kwargs)
+        except XBeeError:
+            self.record_delivery(addr, False)
+            raise
+        self.record_delivery(addr, True)
+        return status
+
+    # --------------------------------------------------------- persistence
+
+    def save(self, path=None):
+        path = path or self.path
+        data = dict((addr.hex().upper(), node.to_dict()) for addr, node in self.nodes.items())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path=None):
+        with open(path or self.path) as f:
+            data = json.load(f)
+        for hexaddr, fields in data.items():
+            addr = to_address(hexaddr)
+            node = Node.from_dict(addr, fields)
+            old = self.nodes.get(addr)
+            node.static = node.static or (old is not None and old.static)
+            self.nodes[addr] = node
+            if node.ni:
+                self.names[node.ni] = addr
+
+
+if __name__ == '__main__':
+    import sys
+
+    from xbee_async import XBeeClient
+
+    # Refresh the table with one discovery and print it
+    async def main():
+        routes = RouteTable(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FILE)
+        async with XBeeClient('/dev/serial0', 9600) as xbee:
+            routes.learn_discovery(await xbee.discover_nodes())
+        routes.save()
+        for node in routes.nodes.values():
+            print(node)
+
+    asyncio.run(main())
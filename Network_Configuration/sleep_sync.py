@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Sleep-aware sending for a DigiMesh network using synchronous cyclic sleep.
+#
+# When the network sleeps, frames sent to it are lost or burn retries. The
+# radio tells us when the network wakes up and goes to sleep with modem
+# status frames (0x0B network wake, 0x0C network sleep), and the wake time ST
+# says how long each wake window lasts. Outgoing messages are held while the
+# network sleeps and sent as one pipelined burst as soon as it wakes, with no
+# more bytes than the serial link can move before the window closes. Whatever
+# doesn't fit waits for the next window.
+#
+#   sender = SleepAwareSender(xbee)
+#   await sender.start()
+#   batcher = TelemetryBatcher(lambda payload: sender.submit(addr, payload))
+
+import asyncio
+import collections
+import time
+
+from xbee_async import (MODEM_STATUS_NETWORK_SLEEP, MODEM_STATUS_NETWORK_WAKE, RETRY_STATUSES, DeliveryError,
+                        XBeeError, XBeeTimeout)
+
+# Bytes of API framing around every transmit request: start delimiter,
+# length, type, frame id, 64 and 16-bit address, radius, options, checksum
+TX_FRAME_OVERHEAD = 18
+
+
+class SleepSchedule(object):
+    # Follows the network's wake/sleep cycle from modem status frames
+    def __init__(self, wake_time=None, sleep_period=None, clock=time.monotonic):
+        # Seconds awake and asleep per cycle, from ST and SP, refined from the
+        # modem status frames as they come in
+        self.wake_time = wake_time
+        self.sleep_period = sleep_period
+        self.clock = clock
+        self.awake = True
+        self.woke_at = None
+        self.slept_at = None
+
+    def on_modem_status(self, status):
+        now = self.clock()
+        if status == MODEM_STATUS_NETWORK_WAKE:
+            if self.slept_at is not None:
+                self.sleep_period = self._average(self.sleep_period, now - self.slept_at)
+            self.awake = True
+            self.woke_at = now
+        elif status == MODEM_STATUS_NETWORK_SLEEP:
+            if self.woke_at is not None:
+                self.wake_time = self._average(self.wake_time, now - self.woke_at)
+            self.awake = False
+            self.slept_at = now
+
+    @staticmethod
+    def _average(old, new):
+        return new if old is None else 0.75 * old + 0.25 * new
+
+    def remaining(self):
+        # Seconds left in the current wake window. None if awake for an
+        # unknown time (e.g. sleep is not enabled), 0 while asleep.
+        if not self.awake:
+            return 0.0
+        if self.wake_time is None or self.woke_at is None:
+            return None
+        return max(0.0, self.woke_at + self.wake_time - self.clock())
+
+    def next_wake(self):
+        # Estimated seconds until the network wakes, 0 if it is awake
+        if self.awake:
+            return 0.0
+        if self.sleep_period is None or self.slept_at is None:
+            return None
+        return max(0.0, self.slept_at + self.sleep_period - self.clock())
+
+
+class SleepAwareSender(object):
+    def __init__(self, xbee, byte_rate=None, margin=0.1, max_queued=1024, max_attempts=3, schedule=None):
+        self.xbee = xbee
+        # Bytes per second the serial link can carry, 10 bits per byte
+        self.byte_rate = byte_rate or xbee.baudrate / 10.0
+        # Seconds kept free at the end of a window for the last TX statuses
+        self.margin = margin
+        self.max_queued = max_queued
+        # Windows a message is tried in before it is given up
+        self.max_attempts = max_attempts
+        self.schedule = schedule or SleepSchedule()
+        self._queue = collections.deque()
+        self._woken = asyncio.Event()
+        self._worker = None
+        self._subscription = None
+
+        self.bursts = 0
+        self.sent = 0
+        self.failed = 0         # failed attempts
+        self.given_up = 0       # messages dropped after failing
+        self.dropped = 0        # messages dropped for lack of room
+        self.bytes_per_burst = 0.0
+
+    async def start(self):
+        # Read the sleep settings from the radio where we can. ST is in ms,
+        # SP in units of 10 ms, bit 0 of SS is set while the network is awake.
+        try:
+            self.schedule.wake_time = int.from_bytes(await self.xbee.at_command('ST'), 'big') / 1000.0
+            self.schedule.sleep_period = int.from_bytes(await self.xbee.at_command('SP'), 'big') / 100.0
+            ss = int.from_bytes(await self.xbee.at_command('SS'), 'big')
+            self.schedule.awake = bool(ss & 0x01)
+            if self.schedule.awake:
+                # We don't know when this window started, play safe
+                self.schedule.woke_at = self.schedule.clock() - self.schedule.wake_time / 2
+        except XBeeError:
+            pass
+        self._subscription = self.xbee.subscribe(self._on_status, 'status')
+        self._worker = asyncio.ensure_future(self._run())
+        self._woken.set()
+        return self
+
+    def stop(self):
+        if self._subscription is not None:
+            self.xbee.unsubscribe(self._subscription)
+            self._subscription = None
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def submit(self, addr, data):
+        # Queue a message for the next wake window. When the queue is full
+        # the oldest message goes.
+        if len(self._queue) >= self.max_queued:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((addr, bytes(data), 0))
+        if self.schedule.awake:
+            self._woken.set()
+
+    def queued(self):
+        return len(self._queue)
+
+    def _on_status(self, frame):
+        self.schedule.on_modem_status(frame['status'])
+        if frame['status'] == MODEM_STATUS_NETWORK_WAKE:
+            self._woken.set()
+
+    def _budget(self):
+        # Bytes we can still get out in this window, None for no limit
+        remaining = self.schedule.remaining()
+        if remaining is None:
+            return None
+        return (remaining - self.margin) * self.byte_rate
+
+    @staticmethod
+    def _retryable(error):
+        return isinstance(error, XBeeTimeout) or (isinstance(error, DeliveryError) and
+                                                  error.status in RETRY_STATUSES)
+
+    async def _run(self):
+        while True:
+            await self._woken.wait()
+            self._woken.clear()
+            if not self.schedule.awake or not self._queue:
+                continue
+
+            # Take as many messages as fit in what is left of the window
+            budget = self._budget()
+            burst = []
+            size = 0
+            while self._queue:
+                cost = len(self._queue[0][1]) + TX_FRAME_OVERHEAD
+                if budget is not None and size + cost > budget:
+                    break
+                burst.append(self._queue.popleft())
+                size += cost
+            if not burst:
+                continue
+
+            self.bursts += 1
+            self.bytes_per_burst += (size - self.bytes_per_burst) / self.bursts
+            results = await asyncio.gather(*[self.xbee.send(addr, data, retries=0) for addr, data, _ in burst],
+                                           return_exceptions=True)
+            retry = []
+            for (addr, data, attempts), result in zip(burst, results):
+                if not isinstance(result, Exception):
+                    self.sent += 1
+                    continue
+                self.failed += 1
+                if self._retryable(result) and attempts + 1 < self.max_attempts:
+                    retry.append((addr, data, attempts + 1))
+                else:
+                    # Too big, bad address and the like won't get better
+                    self.given_up += 1
+            # Failed messages go first in the next window, as far as there
+            # is room; like in submit() the oldest go when there isn't
+            room = max(0, self.max_queued - len(self._queue))
+            if len(retry) > room:
+                self.dropped += len(retry) - room
+                retry = retry[len(retry) - room:]
+            self._queue.extendleft(reversed(retry))
+            if self.schedule.awake and self._queue and not retry:
+                # More came in while we were sending
+                self._woken.set()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Packs many telemetry samples into one DigiMesh payload.
+#
+# Sending one IMU or GPS reading per message, like init_network.js does with
+# send_message, spends most of the link on API headers, RF headers and ACKs.
+# The batcher fills each payload up to the radio's maximum RF payload (the NP
+# AT parameter) and only sends early when the oldest sample in a batch has
+# waited longer than its stream's deadline.
+#
+# Payload layout, little endian:
+#
+#   stream id  B   which stream the samples belong to
+#   sequence   H   per stream, wraps at 65536, gaps mean lost batches
+#   base time  d   timestamp of the first sample, seconds
+#   count      B   number of samples that follow
+#   count x (offset H, record)
+#                  offset from base time in units of 0.1 ms, then the sample
+#                  packed with the stream's struct format
+#
+# The offsets keep the 100 us timing of the samples and reach 6.5535 s, a
+# sample further from the base time goes into the next batch.
+#
+#   batcher = TelemetryBatcher(lambda payload: xbee.send_nowait(addr, payload))
+#   batcher.add(IMU_STREAM, time.time(), imu_sample)   # 9 flat values, see IMU_STREAM
+#   ...
+#   batcher.poll()   # every so often, flushes batches past their deadline
+
+import asyncio
+import struct
+import time
+
+HEADER = struct.Struct('<BHdB')
+OFFSET = struct.Struct('<H')
+# Seconds per offset count
+OFFSET_UNIT = 1e-4
+
+# Maximum RF payload of a DigiMesh 2.4 radio with no encryption. Ask the radio
+# with ATNP to be sure, see max_payload_from_radio().
+DEFAULT_MAX_PAYLOAD = 73
+
+# Streams the CATMAN nodes send, with the struct format of one sample. An
+# IMU sample is nine flat values, accel x/y/z, gyro x/y/z, mag x/y/z as in
+# the ChipData logs and imu_service.read_sample(). LSM9DS0.rawAll() gives
+# three lists in accel, mag, gyro order, so it has to be reordered:
+#   accel, mag, gyro = imu.rawAll(); values = accel + gyro + mag
+IMU_STREAM = 1  # raw accel, gyro and mag counts
+GPS_STREAM = 2  # lat, lon (degrees), alt (m)
+STREAM_FORMATS = {
+    IMU_STREAM: '<9h',
+    GPS_STREAM: '<ddf',
+}
+
+
+class _Stream(object):
+    def __init__(self, stream_id, fmt, deadline):
+        self.id = stream_id
+        self.record = struct.Struct(fmt)
+        self.deadline = deadline
+        self.sequence = 0
+        self.base_time = None
+        self.count = 0
+        self.buffer = bytearray()
+
+
+class TelemetryBatcher(object):
+    def __init__(self, send, max_payload=DEFAULT_MAX_PAYLOAD, deadline=1.0, clock=time.time):
+        # send(payload) is called with every finished batch
+        self.send = send
+        self.max_payload = max_payload
+        # Default deadline in seconds for streams that don't set their own
+        self.deadline = deadline
+        self.clock = clock
+        self._streams = {}
+
+        self.batches_sent = 0
+        self.samples_sent = 0
+
+        for stream_id, fmt in STREAM_FORMATS.items():
+            self.add_stream(stream_id, fmt)
+
+    def add_stream(self, stream_id, fmt, deadline=None):
+        stream = _Stream(stream_id, fmt, self.deadline if deadline is None else deadline)
+        if HEADER.size + OFFSET.size + stream.record.size > self.max_payload:
+            raise ValueError('a single {} sample does not fit in {} bytes'.format(fmt, self.max_payload))
+        self._streams[stream_id] = stream
+        return stream
+
+    def samples_per_batch(self, stream_id):
+        stream = self._streams[stream_id]
+        return min(255, (self.max_payload - HEADER.size) // (OFFSET.size + stream.record.size))
+
+    def add(self, stream_id, t, values):
+        stream = self._streams[stream_id]
+        if stream.count:
+            offset = int(round((t - stream.base_time) / OFFSET_UNIT))
+            # Flush first if the sample can't be represented in this batch
+            if offset < 0 or offset > 0xFFFF:
+                self.flush(stream_id)
+        if not stream.count:
+            stream.base_time = t
+            offset = 0
+
+        stream.buffer += OFFSET.pack(offset)
+        stream.buffer += stream.record.pack(*values)
+        stream.count += 1
+
+        if stream.count >= self.samples_per_batch(stream_id):
+            self.flush(stream_id)
+
+    def flush(self, stream_id=None):
+        # Send whatever is waiting in one stream, or in all of them
+        if stream_id is None:
+            for stream_id in list(self._streams):
+                self.flush(stream_id)
+            return
+        stream = self._streams[stream_id]
+        if not stream.count:
+            return
+        payload = HEADER.pack(stream.id, stream.sequence, stream.base_time, stream.count) + stream.buffer
+        stream.sequence = (stream.sequence + 1) & 0xFFFF
+        self.batches_sent += 1
+        self.samples_sent += stream.count
+        stream.count = 0
+        stream.base_time = None
+        stream.buffer = bytearray()
+        self.send(bytes(payload))
+
+    def next_deadline(self):
+        # Clock time at which poll() next has something to do, or None
+        due = [s.base_time + s.deadline for s in self._streams.values() if s.count]
+        return min(due) if due else None
+
+    def poll(self, now=None):
+        # Flush every stream whose oldest sample has waited past its deadline.
+        # Uses the clock the samples are stamped with.
+        now = self.clock() if now is None else now
+        for stream in self._streams.values():
+            if stream.count and now >= stream.base_time + stream.deadline:
+                self.flush(stream.id)
+
+    async def run(self, idle=0.1):
+        # Keep flushing on deadlines from inside an asyncio program
+        while True:
+            due = self.next_deadline()
+            await asyncio.sleep(idle if due is None else max(0.0, min(idle, due - self.clock())))
+            self.poll()
+
+
+def decode_batch(payload, formats=STREAM_FORMATS):
+    # Returns (stream id, sequence, [(t, values), ...])
+    stream_id, sequence, base_time, count = HEADER.unpack_from(payload, 0)
+    record = struct.Struct(formats[stream_id])
+    samples = []
+    pos = HEADER.size
+    for _ in range(count):
+        offset, = OFFSET.unpack_from(payload, pos)
+        samples.append((base_time + offset * OFFSET_UNIT, record.unpack_from(payload, pos + OFFSET.size)))
+        pos += OFFSET.size + record.size
+    return stream_id, sequence, samples
+
+
+async def max_payload_from_radio(xbee):
+    # Ask an XBeeClient's radio for its maximum RF payload
+    return int.from_bytes(await xbee.at_command('NP'), 'big')
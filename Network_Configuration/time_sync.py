@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Clock synchronisation between nodes and a time ordered merge of their logs.
+#
+# Every node stamps its samples with its own clock, which starts anywhere and
+# runs a little fast or slow, so the logs of CATMAN1 and CATMAN2 can't be
+# lined up. A small NTP style exchange fixes that: we send a REQUEST with our
+# send time t1, the peer answers with t1, its receive time t2 and its send
+# time t3, and we note our receive time t4. Then
+#
+#   offset = ((t2 - t1) + (t3 - t4)) / 2     peer clock minus ours
+#   delay  = (t4 - t1) - (t3 - t2)           round trip on the air
+#
+# The offset is only as good as the delay is symmetric, and a DigiMesh round
+# trip can take tens of milliseconds with retries, so each peer keeps a window
+# of samples and fits a line through the ones with the shortest delays: the
+# intercept is the offset, the slope the drift. A node with a GPS fix can
+# anchor the same way, feeding (local time, GPS time) pairs into a 'gps'
+# estimator, which puts every peer on GPS time.
+#
+# Messages, little endian:
+#
+#   REQUEST  magic B, type B, sequence H, t1 d
+#   REPLY    magic B, type B, sequence H, t1 d, t2 d, t3 d
+#
+#   sync = TimeSync(xbee).start()
+#   await sync.sync('0013A200415A8686')
+#   sync.save('clocks.json')
+#
+#   python3 time_sync.py merge clocks.json CATMAN1=sessions/CATMAN1/imu.txt \
+#       CATMAN2=sessions/CATMAN2/imu.txt -o merged.txt
+
+import argparse
+import asyncio
+import collections
+import heapq
+import json
+import struct
+import time
+
+from xbee_async import XBeeTimeout, to_address
+
+MAGIC = 0xA7
+
+MSG_REQUEST = 0x01
+MSG_REPLY = 0x02
+
+HEADER = struct.Struct('<BBH')
+REQUEST = struct.Struct('<d')
+REPLY = struct.Struct('<ddd')
+
+# Name of the estimator that maps our clock to GPS time
+GPS = 'gps'
+
+
+class ClockEstimator(object):
+    # Offset and drift of another clock relative to ours
+    def __init__(self, window=32, best=0.5, min_span=30.0):
+        # Keep the last window samples and fit through the best fraction of
+        # them, by delay. Samples without a delay (GPS anchors) all count.
+        # Drift is only fitted once those samples cover min_span seconds,
+        # over a short burst the delay jitter swamps it.
+        self.samples = collections.deque(maxlen=window)
+        self.best = best
+        self.min_span = min_span
+        self.offset = 0.0   # other clock minus ours at self.epoch
+        self.drift = 0.0    # seconds gained per second of our clock
+        self.epoch = 0.0
+        self.delay = None   # shortest round trip in the window
+
+    def add(self, local, offset, delay=None):
+        # One measurement at our time local, delay None if it has no
+        # round trip to judge it by
+        self.samples.append((local, offset, delay))
+        self._fit()
+
+    def _fit(self):
+        timed = [s for s in self.samples if s[2] is not None]
+        if timed:
+            samples = sorted(timed, key=lambda s: s[2])
+            samples = samples[:max(1, int(round(len(samples) * self.best)))]
+            self.delay = samples[0][2]
+        else:
+            # Nothing to rank them by, and sorting equal delays would keep
+            # just the oldest half
+            samples = list(self.samples)
+            self.delay = None
+        n = len(samples)
+        t0 = sum(s[0] for s in samples) / n
+        y0 = sum(s[1] for s in samples) / n
+        sxx = sum((s[0] - t0) ** 2 for s in samples)
+        span = max(s[0] for s in samples) - min(s[0] for s in samples)
+        # Drift needs a few samples spread out in time to mean anything,
+        # until then the offset alone is the better guess
+        if n >= 3 and span >= self.min_span and sxx > 0.0:
+            self.drift = sum((s[0] - t0) * (s[1] - y0) for s in samples) / sxx
+        else:
+            self.drift = 0.0
+        self.epoch = t0
+        self.offset = y0
+
+    def to_remote(self, local):
+        # Our timestamp on the other clock
+        return local + self.offset + self.drift * (local - self.epoch)
+
+    def to_local(self, remote):
+        # The other clock's timestamp on ours
+        return (remote - self.offset + self.drift * self.epoch) / (1.0 + self.drift)
+
+    def to_dict(self):
+        return {'offset': self.offset, 'drift': self.drift, 'epoch': self.epoch, 'delay': self.delay,
+                'samples': len(self.samples)}
+
+    @classmethod
+    def from_dict(cls, data):
+        estimator = cls()
+        estimator.offset = data['offset']
+        estimator.drift = data['drift']
+        estimator.epoch = data['epoch']
+        estimator.delay = data.get('delay')
+        return estimator
+
+
+class TimeSync(object):
+    def __init__(self, xbee, clock=time.time, timeout=2.0):
+        self.xbee = xbee
+        # The clock the node stamps its data with
+        self.clock = clock
+        self.timeout = timeout
+        # 64-bit address (or GPS) -> ClockEstimator
+        self.peers = {}
+        self._pending = {}
+        self._sequence = 0
+        self._subscription = None
+
+    def start(self):
+        # Also answers other nodes' requests, so every node should start one
+        self._subscription = self.xbee.subscribe(self._on_frame, 'rx')
+        return self
+
+    def stop(self):
+        if self._subscription is not None:
+            self.xbee.unsubscribe(self._subscription)
+            self._subscription = None
+
+    def _on_frame(self, frame):
+        now = self.clock()
+        data = frame['rf_data']
+        if len(data) < HEADER.size or data[0] != MAGIC:
+            return
+        magic, kind, sequence = HEADER.unpack_from(data, 0)
+        if kind == MSG_REQUEST and len(data) >= HEADER.size + REQUEST.size:
+            t1, = REQUEST.unpack_from(data, HEADER.size)
+            reply = HEADER.pack(MAGIC, MSG_REPLY, sequence) + REPLY.pack(t1, now, self.clock())
+            self.xbee.send_nowait(frame['source_addr_long'], reply)
+        elif kind == MSG_REPLY and len(data) >= HEADER.size + REPLY.size:
+            fut = self._pending.get(sequence)
+            if fut is not None and not fut.done():
+                fut.set_result(REPLY.unpack_from(data, HEADER.size) + (now,))
+
+    def estimator(self, peer):
+        key = peer if peer == GPS else to_address(peer)
+        estimator = self.peers.get(key)
+        if estimator is None:
+            estimator = self.peers[key] = ClockEstimator()
+        return estimator
+
+    async def exchange(self, peer):
+        # One request/reply. Returns (offset, delay) and adds it to the peer's
+        # estimator.
+        peer = to_address(peer)
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        sequence = self._sequence
+        fut = self._pending[sequence] = asyncio.get_event_loop().create_future()
+        try:
+            t1 = self.clock()
+            await self.xbee.send(peer, HEADER.pack(MAGIC, MSG_REQUEST, sequence) + REQUEST.pack(t1))
+            try:
+                t1, t2, t3, t4 = await asyncio.wait_for(fut, self.timeout)
+            except asyncio.TimeoutError:
+                raise XBeeTimeout('no time sync reply from {}'.format(peer.hex()))
+        finally:
+            self._pending.pop(sequence, None)
+        offset = ((t2 - t1) + (t3 - t4)) / 2.0
+        delay = (t4 - t1) - (t3 - t2)
+        self.estimator(peer).add((t1 + t4) / 2.0, offset, delay)
+        return offset, delay
+
+    async def sync(self, peer, count=8, interval=0.25):
+        # A few exchanges in a row. Returns the peer's estimator.
+        for i in range(count):
+            try:
+                await self.exchange(peer)
+            except XBeeTimeout:
+                pass
+            if i < count - 1:
+                await asyncio.sleep(interval)
+        return self.estimator(peer)
+
+    def anchor_gps(self, gps_time, local=None):
+        # A GPS timestamp and our clock when it was taken, e.g. from a gpsd
+        # TPV report through gps_buffer.parse_gps_time()
+        if local is None:
+            local = self.clock()
+        self.estimator(GPS).add(local, gps_time - local)
+
+    def models(self):
+        # Every clock we know as a function of ours. With a GPS anchor the
+        # models map each node's timestamps straight to GPS time.
+        gps = self.peers.get(GPS)
+        out = {}
+        for key, estimator in self.peers.items():
+            if key == GPS:
+                continue
+            out[key.hex().upper()] = estimator.to_dict()
+        out['local'] = ClockEstimator().to_dict()
+        if gps is not None:
+            out[GPS] = gps.to_dict()
+        return out
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.models(), f, indent=1, sort_keys=True)
+
+
+class ClockModels(object):
+    # Maps timestamps of each node onto one timeline, from a file written by
+    # TimeSync.save(). Keys are 64-bit addresses in hex, node names that
+    # route_table knows, or 'local' for the node that ran the sync.
+    def __init__(self, models=None, names=None):
+        self.models = dict((key, ClockEstimator.from_dict(value)) for key, value in (models or {}).items())
+        self.names = names or {}
+        self.gps = self.models.pop(GPS, None)
+
+    @classmethod
+    def load(cls, path, names=None):
+        with open(path) as f:
+            return cls(json.load(f), names)
+
+    def corrector(self, node):
+        # Function taking node's timestamps to the common timeline
+        key = self.names.get(node, node)
+        model = self.models.get(key, self.models.get(key.upper()))
+        if model is None:
+            raise KeyError('no clock model for {}'.format(node))
+        gps = self.gps
+        if gps is None:
+            return model.to_local
+        return lambda t: gps.to_remote(model.to_local(t))
+
+
+def read_log(path, correct, node=None):
+    # Yields (corrected time, node, original line) for a tab separated log
+    # with the timestamp first, skipping the header line
+    with open(path) as f:
+        for line in f:
+            field = line.split('\t', 1)[0]
+            try:
+                t = float(field)
+            except ValueError:
+                continue
+            yield correct(t), node, line
+
+
+def merge_logs(sources):
+    # Streaming k-way merge of logs that are each in time order. sources is
+    # a list of (node, path, correct). Memory holds one line per log.
+    # Correcting is a line with positive slope, so it keeps each log ordered.
+    streams = [read_log(path, correct, node) for node, path, correct in sources]
+    return heapq.merge(*streams, key=lambda item: item[0])
+
+
+if __name__ == '__main__':
+    from link_tuner import load_config
+    from xbee_devices import xbeeDevicesMacAddress
+
+    link = load_config()
+    parser = argparse.ArgumentParser(description='Synchronise node clocks and merge their logs')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('sync', help='measure the clocks of peers')
+    run.add_argument('peers', nargs='+', help='node names or 64-bit addresses')
+    run.add_argument('--port', default='/dev/serial0')
+    run.add_argument('--baud', type=int, default=link['baudrate'], help='default from link_tuner.py')
+    run.add_argument('--count', type=int, default=16)
+    run.add_argument('--out', default='clocks.json')
+    merge = sub.add_parser('merge', help='merge logs onto one timeline')
+    merge.add_argument('models', help='file written by sync')
+    merge.add_argument('logs', nargs='+', help='NODE=path, NODE a name, address or local')
+    merge.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    if args.command == 'sync':
+        from xbee_async import XBeeClient
+
+        async def main():
+            async with XBeeClient(args.port, args.baud, rtscts=link['rtscts']) as xbee:
+                sync = TimeSync(xbee).start()
+                for peer in args.peers:
+                    estimator = await sync.sync(xbeeDevicesMacAddress.get(peer, peer), args.count)
+                    print('{}: offset {:+.6f} s  drift {:+.2f} ppm  delay {}'.format(
+                        peer, estimator.offset, estimator.drift * 1e6, estimator.delay))
+                sync.stop()
+                sync.save(args.out)
+
+        asyncio.run(main())
+    else:
+        import sys
+        models = ClockModels.load(args.models, xbeeDevicesMacAddress)
+        sources = []
+        for item in args.logs:
+            node, path = item.split('=', 1)
+            sources.append((node, path, models.corrector(node)))
+        out = open(args.output, 'w') if args.output else sys.stdout
+        out.write('Time\tNode\tData\n')
+        for t, node, line in merge_logs(sources):
+            out.write('{:.6f}\t{}\t{}'.format(t, node, line.partition('\t')[2] or '\n'))
+        if out is not sys.stdout:
+            out.close()
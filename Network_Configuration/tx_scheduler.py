@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+# Transmit scheduler sharing the radio between commands, telemetry and bulk
+# transfers.
+#
+# Every message is queued under a traffic class. The worker always serves the
+# most important class that has something queued and that is within its rate
+# limit (a token bucket in bytes per second), and only keeps a few frames in
+# flight at the radio, so a control command never waits behind more than
+# those few frames of a log transfer and the radio's buffer can't overflow.
+# Each class has a bounded queue with its own policy for when it fills up.
+#
+#   scheduler = TxScheduler(xbee)
+#   scheduler.start()
+#   await scheduler.send(addr, b'reboot', CONTROL)
+#   await send_file(scheduler.channel(BULK), addr, 'session.log')
+#   print(scheduler.metrics())
+
+import asyncio
+import collections
+import time
+
+from xbee_async import XBeeError
+
+CONTROL = 0
+TELEMETRY = 1
+BULK = 2
+CLASS_NAMES = {CONTROL: 'control', TELEMETRY: 'telemetry', BULK: 'bulk'}
+
+# What to do when a class's queue is full
+DROP_OLDEST = 'drop_oldest'  # make room by dropping the oldest queued message
+DROP_NEWEST = 'drop_newest'  # refuse the new message
+BLOCK = 'block'              # make the sender wait for room (send() only)
+
+
+class DroppedError(XBeeError):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        # rate in bytes per second, None for no limit. burst is how many
+        # bytes can go out back to back, by default one second's worth.
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.clock = clock
+        self.tokens = self.burst
+        self.stamp = clock()
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, size):
+        # Seconds until size bytes may be sent, 0 if right now
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        # A message bigger than the burst waits for a full bucket
+        need = min(size, self.burst)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self, size):
+        if self.rate is not None:
+            self._refill()
+            self.tokens -= size
+
+
+class TrafficClass(object):
+    def __init__(self, priority, rate=None, burst=None, depth=64, policy=DROP_NEWEST):
+        self.priority = priority
+        self.name = CLASS_NAMES.get(priority, str(priority))
+        self.bucket = TokenBucket(rate, burst)
+        self.depth = depth
+        self.policy = policy
+        self.queue = collections.deque()
+        self.room = None
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.wait_total = 0.0
+
+    def metrics(self):
+        return {
+            'queued': len(self.queue),
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'bytes_sent': self.bytes_sent,
+            'mean_wait': self.wait_total / self.sent if self.sent else 0.0,
+        }
+
+
+def default_classes():
+    # Commands are never limited. Stale telemetry is worth less than fresh,
+    # so it drops its oldest. Bulk transfers get backpressure instead of
+    # losses and are capped so telemetry always gets a share of a 9600 baud
+    # link (about 960 bytes a second before framing).
+    return [
+        TrafficClass(CONTROL, depth=32, policy=DROP_NEWEST),
+        TrafficClass(TELEMETRY, depth=256, policy=DROP_OLDEST),
+        TrafficClass(BULK, rate=600, burst=1200, depth=64, policy=BLOCK),
+    ]
+
+
+class TxScheduler(object):
+    def __init__(self, xbee, classes=None, max_in_flight=4):
+        self.xbee = xbee
+        self.classes = dict((c.priority, c) for c in (classes or default_classes()))
+        self._order = sorted(self.classes)
+        # Frames handed to the radio and not yet confirmed by a TX status
+        self.max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._wakeup = None
+        self._worker = None
+
+    # ------------------------------------------------------------ queueing
+
+    def submit(self, addr, data, priority=TELEMETRY, **kwargs):
+        # Queue a message. Returns a future for its TX status, which fails
+        # with DroppedError if the message is dropped from a full queue.
+        tc = self.classes[priority]
+        fut = asyncio.get_event_loop().create_future()
+        if len(tc.queue) >= tc.depth:
+            if tc.policy == DROP_OLDEST:
+                self._drop(tc, tc.queue.popleft())
+            else:
+                tc.dropped += 1
+                fut.set_exception(DroppedError('{} queue full'.format(tc.name)))
+                return fut
+        tc.queue.append((addr, data, kwargs, fut, time.monotonic()))
+        tc.enqueued += 1
+        self._wake()
+        return fut
+
+    async def send(self, addr, data, priority=TELEMETRY, **kwargs):
+        # Queue a message and wait for its TX status. For BLOCK classes this
+        # waits for room in the queue instead of dropping.
+        tc = self.classes[priority]
+        while tc.policy == BLOCK and len(tc.queue) >= tc.depth:
+            if tc.room is None:
+                tc.room = asyncio.Event()
+            tc.room.clear()
+            await tc.room.wait()
+        return await self.submit(addr, data, priority, **kwargs)
+
+    def _drop(self, tc, item):
+        tc.dropped += 1
+        fut = item[3]
+        if not fut.done():
+            fut.set_exception(DroppedError('dropped from full {} queue'.format(tc.name)))
+
+    def channel(self, priority):
+        # Something that looks like the XBeeClient, but sends at priority.
+        # Hand it to code written against the client, e.g. send_file().
+        return _Channel(self, priority)
+
+    # -------------------------------------------------------------- worker
+
+    def start(self):
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+        return self
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for tc in self.classes.values():
+            while tc.queue:
+                self._drop(tc, tc.queue.popleft())
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _next(self):
+        # (class, None) for the class to serve now, or (None, seconds to wait)
+        wait = None
+        for priority in self._order:
+            tc = self.classes[priority]
+            if not tc.queue:
+                continue
+            delay = tc.bucket.wait_time(len(tc.queue[0][1]))
+            if delay == 0:
+                return tc, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if self._in_flight >= self.max_in_flight:
+                await self._wakeup.wait()
+                continue
+            tc, wait = self._next()
+            if tc is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            addr, data, kwargs, fut, queued_at = tc.queue.popleft()
+            if tc.room is not None:
+                tc.room.set()
+            if fut.done():
+                continue
+            tc.bucket.take(len(data))
+            tc.wait_total += time.monotonic() - queued_at
+            self._in_flight += 1
+            asyncio.ensure_future(self._transmit(tc, addr, data, kwargs, fut))
+
+    async def _transmit(self, tc, addr, data, kwargs, fut):
+        try:
+            status = await self.xbee.send(addr, data, **kwargs)
+        except Exception as e:
+            tc.failed += 1
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            tc.sent += 1
+            tc.bytes_sent += len(data)
+            if not fut.done():
+                fut.set_result(status)
+        finally:
+            self._in_flight -= 1
+            self._wake()
+
+    def metrics(self):
+        out = dict((tc.name, tc.metrics()) for tc in self.classes.values())
+        out['in_flight'] = self._in_flight
+        return out
+
+
+class _Channel(object):
+    def __init__(self, scheduler, priority):
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def send(self, addr, data, **kwargs):
+        return self._scheduler.send(addr, data, self._priority, **kwargs)
+
+    def send_nowait(self, addr, data, **kwargs):
+        fut = self._scheduler.submit(addr, data, self._priority, **kwargs)
+        # Nobody waits on it, so don't let a failure be reported as unhandled
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler.xbee, name)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+
+# asyncio client for XBee DigiMesh radios in API mode.
+#
+# customSender.py and the Beta Version scripts write one message and then poll
+# the serial port until something comes back, so only one message is ever on
+# the air. This client keeps up to 255 transmit requests in flight at once and
+# uses the frame ID of each request to match the TX status frame back to the
+# coroutine that sent it.
+#
+#   xbee = XBeeClient('/dev/serial0', 9600)
+#   await xbee.open()
+#   xbee.subscribe(print, 'rx')
+#   status = await xbee.send('0013A200415A8686', b'hello')
+
+import asyncio
+import logging
+import struct
+
+import serial
+
+from xbee_codec import FrameDecoder, FrameEncoder
+
+log = logging.getLogger(__name__)
+
+BROADCAST_ADDRESS = bytes.fromhex('000000000000FFFF')
+UNKNOWN_ADDRESS_16 = b'\xff\xfe'
+
+# Frame types, see the DigiMesh API reference
+FRAME_AT_COMMAND = 0x08
+FRAME_AT_COMMAND_QUEUE = 0x09
+FRAME_AT_COMMAND_RESPONSE = 0x88
+FRAME_REMOTE_AT_COMMAND = 0x17
+FRAME_REMOTE_AT_COMMAND_RESPONSE = 0x97
+FRAME_MODEM_STATUS = 0x8A
+FRAME_TRANSMIT_REQUEST = 0x10
+FRAME_TRANSMIT_STATUS = 0x8B
+FRAME_RECEIVE_PACKET = 0x90
+
+# Names used for the 'id' field of decoded frames, same as the xbee package
+FRAME_NAMES = {
+    FRAME_AT_COMMAND_RESPONSE: 'at_response',
+    FRAME_REMOTE_AT_COMMAND_RESPONSE: 'remote_at_response',
+    FRAME_MODEM_STATUS: 'status',
+    FRAME_TRANSMIT_STATUS: 'tx_status',
+    FRAME_RECEIVE_PACKET: 'rx',
+}
+
+# Shortest frame data of each type that decode_frame reads fields from
+FRAME_MIN_LENGTHS = {
+    FRAME_AT_COMMAND_RESPONSE: 5,
+    FRAME_REMOTE_AT_COMMAND_RESPONSE: 15,
+    FRAME_MODEM_STATUS: 2,
+    FRAME_TRANSMIT_STATUS: 7,
+    FRAME_RECEIVE_PACKET: 12,
+}
+
+# Seconds a frame ID whose request timed out is kept out of use, so a late
+# response to it isn't taken for the response to the next request
+FRAME_ID_QUARANTINE = 5.0
+
+# Delivery status of a TX status frame
+DELIVERY_STATUS_SUCCESS = 0x00
+DELIVERY_STATUS_MAC_ACK_FAILURE = 0x01
+DELIVERY_STATUS_INVALID_ADDR = 0x15
+DELIVERY_STATUS_NETWORK_ACK_FAILURE = 0x21
+DELIVERY_STATUS_ROUTE_NOT_FOUND = 0x25
+DELIVERY_STATUS_PAYLOAD_TOO_LARGE = 0x74
+DELIVERY_STATUS_STRINGS = {
+    DELIVERY_STATUS_SUCCESS: 'success',
+    DELIVERY_STATUS_MAC_ACK_FAILURE: 'MAC ACK failure',
+    DELIVERY_STATUS_INVALID_ADDR: 'invalid address',
+    DELIVERY_STATUS_NETWORK_ACK_FAILURE: 'network ACK failure',
+    DELIVERY_STATUS_ROUTE_NOT_FOUND: 'route not found',
+    DELIVERY_STATUS_PAYLOAD_TOO_LARGE: 'payload too large',
+}
+# Failures that may go away if the frame is simply sent again
+RETRY_STATUSES = (DELIVERY_STATUS_MAC_ACK_FAILURE,
+                  DELIVERY_STATUS_NETWORK_ACK_FAILURE,
+                  DELIVERY_STATUS_ROUTE_NOT_FOUND)
+
+# Modem status values
+MODEM_STATUS_HARDWARE_RESET = 0x00
+MODEM_STATUS_WATCHDOG_RESET = 0x01
+MODEM_STATUS_NETWORK_WAKE = 0x0B
+MODEM_STATUS_NETWORK_SLEEP = 0x0C
+
+# AT command response status
+AT_STATUS_OK = 0x00
+
+
+class XBeeError(Exception):
+    pass
+
+
+class XBeeTimeout(XBeeError):
+    pass
+
+
+class DeliveryError(XBeeError):
+    def __init__(self, status):
+        super(DeliveryError, self).__init__(
+            DELIVERY_STATUS_STRINGS.get(status, 'delivery status 0x{:02X}'.format(status)))
+        self.status = status
+
+
+def to_address(addr):
+    # Addresses may be given as 16 hex digits, like the entries of
+    # xbeeDevicesMacAddress, or as 8 raw bytes
+    if isinstance(addr, str):
+        addr = bytes.fromhex(addr)
+    addr = bytes(addr)
+    if len(addr) != 8:
+        raise ValueError('64-bit address must be 8 bytes, got {}'.format(len(addr)))
+    return addr
+
+
+def decode_frame(frame_data):
+    # Turn raw frame data into a dict like the ones the xbee package produces.
+    # rf_data is a memoryview into the decoder's receive buffer, not a copy.
+    # A frame too short for its type comes back as 'unknown' with
+    # malformed=True and its bytes in 'data'.
+    ftype = frame_data[0] if len(frame_data) else None
+    if ftype is None or len(frame_data) < FRAME_MIN_LENGTHS.get(ftype, 1):
+        return {'id': 'unknown', 'frame_type': ftype, 'malformed': True, 'data': frame_data[1:]}
+    frame = {'id': FRAME_NAMES.get(ftype, 'unknown'), 'frame_type': ftype}
+    if ftype == FRAME_RECEIVE_PACKET:
+        frame['source_addr_long'] = bytes(frame_data[1:9])
+        frame['options'] = frame_data[11]
+        frame['rf_data'] = frame_data[12:]
+    elif ftype == FRAME_TRANSMIT_STATUS:
+        frame['frame_id'] = frame_data[1]
+        frame['retries'] = frame_data[4]
+        frame['deliver_status'] = frame_data[5]
+        frame['discover_status'] = frame_data[6]
+    elif ftype == FRAME_AT_COMMAND_RESPONSE:
+        frame['frame_id'] = frame_data[1]
+        frame['command'] = bytes(frame_data[2:4])
+        frame['status'] = frame_data[4]
+        frame['parameter'] = bytes(frame_data[5:])
+    elif ftype == FRAME_REMOTE_AT_COMMAND_RESPONSE:
+        frame['frame_id'] = frame_data[1]
+        frame['source_addr_long'] = bytes(frame_data[2:10])
+        frame['command'] = bytes(frame_data[12:14])
+        frame['status'] = frame_data[14]
+        frame['parameter'] = bytes(frame_data[15:])
+    elif ftype == FRAME_MODEM_STATUS:
+        frame['status'] = frame_data[1]
+    else:
+        frame['data'] = frame_data[1:]
+    return frame
+
+
+def parse_node_discovery(parameter):
+    # One ND response: MY, SH+SL, NI (zero terminated), parent address,
+    # device type, status, profile id, manufacturer id, then optionally the
+    # device type identifier (DD) and the RSSI of the last hop (NO option)
+    end = parameter.index(b'\x00', 10)
+    node = {
+        'network_addr': struct.unpack_from('>H', parameter, 0)[0],
+        'addr': bytes(parameter[2:10]),
+        'ni': bytes(parameter[10:end]).decode('ascii', 'replace'),
+    }
+    node['parent_net_addr'], node['device_type'], _, node['profile_id'], node['manufacturer_id'] = \
+        struct.unpack_from('>HBBHH', parameter, end + 1)
+    extra = parameter[end + 9:]
+    if len(extra) in (1, 5):
+        node['rssi'] = -extra[-1]
+    return node
+
+
+class XBeeClient(object):
+    def __init__(self, port, baudrate=9600, escaped=True, timeout=5.0, retries=2,
+                 max_in_flight=255, broadcast_radius=0, rtscts=False, loop=None):
+        # port is a device path, or an already open serial.Serial
+        self.port = port
+        self.baudrate = baudrate
+        self.rtscts = rtscts
+        self.escaped = escaped
+        # Seconds to wait for a response frame, and how many times a transmit
+        # that timed out or failed with a retryable status is sent again
+        self.timeout = timeout
+        self.retries = retries
+        self.max_in_flight = min(max_in_flight, 255)
+        self.broadcast_radius = broadcast_radius
+        self.loop = loop
+
+        self.ser = None
+        self._decoder = FrameDecoder(escaped)
+        self._encoder = FrameEncoder(escaped)
+        self._writing = False
+        self.reading_paused = False
+        # frame_id -> future waiting for the response to that frame, or a list
+        # collecting every response (ND answers once per node)
+        self._pending = {}
+        # IDs of transmit requests the radio is still working on
+        self._on_air = set()
+        # frame_id -> loop time until which it isn't handed out again
+        self._quarantine = {}
+        self._next_id = 1
+        self._slots = None
+        # (callback, frame names or None)
+        self._subscribers = []
+
+        # Counters, handy when tuning the link
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.checksum_errors = 0
+        self.malformed_frames = 0
+        self.callback_errors = 0
+
+    # ------------------------------------------------------------------ port
+
+    async def open(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if isinstance(self.port, str):
+            # timeout=0 and write_timeout=0 make reads and writes non-blocking,
+            # the event loop tells us when the port is ready
+            self.ser = serial.Serial(self.port, self.baudrate, rtscts=self.rtscts,
+                                     timeout=0, write_timeout=0)
+        else:
+            self.ser = self.port
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.loop.add_reader(self.ser.fileno(), self._on_readable)
+        return self
+
+    def close(self):
+        if self.ser is None:
+            return
+        if not self.reading_paused:
+            self.loop.remove_reader(self.ser.fileno())
+        self.reading_paused = False
+        if self._writing:
+            self.loop.remove_writer(self.ser.fileno())
+            self._writing = False
+        for fut in self._pending.values():
+            if isinstance(fut, asyncio.Future) and not fut.done():
+                fut.set_exception(XBeeError('port closed'))
+        self._pending.clear()
+        self._on_air.clear()
+        self._quarantine.clear()
+        if isinstance(self.port, str):
+            self.ser.close()
+        self.ser = None
+
+    def pause_reading(self):
+        # Stop reading the port. With RTS/CTS enabled the radio then holds on
+        # to incoming frames instead of us losing them.
+        if self.ser is not None and not self.reading_paused:
+            self.loop.remove_reader(self.ser.fileno())
+            self.reading_paused = True
+
+    def resume_reading(self):
+        if self.ser is not None and self.reading_paused:
+            self.loop.add_reader(self.ser.fileno(), self._on_readable)
+            self.reading_paused = False
+
+    def reconfigure(self, baudrate=None, rtscts=None):
+        # Change the settings of the open port, e.g. to follow an ATBD change.
+        # Half received frames from before the switch are thrown away.
+        if baudrate is not None:
+            self.baudrate = baudrate
+            self.ser.baudrate = baudrate
+        if rtscts is not None:
+            self.rtscts = rtscts
+            self.ser.rtscts = rtscts
+        self.ser.reset_input_buffer()
+        self._decoder.reset()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _on_writable(self):
+        # Frames queued since the last write are already sitting escaped in
+        # the encoder's buffer, so they all go out in one write
+        txbuf = self._encoder.buffer
+        n = self.ser.write(txbuf) or 0
+        del txbuf[:n]
+        if txbuf and not self._writing:
+            self.loop.add_writer(self.ser.fileno(), self._on_writable)
+            self._writing = True
+        elif not txbuf and self._writing:
+            self.loop.remove_writer(self.ser.fileno())
+            self._writing = False
+
+    def _on_readable(self):
+        data = self.ser.read(self.ser.in_waiting or 1)
+        for frame_data in self._decoder.feed(data):
+            self._dispatch(frame_data)
+        self.checksum_errors = self._decoder.checksum_errors
+
+    # ------------------------------------------------------------ receiving
+
+    def _dispatch(self, frame_data):
+        self.frames_received += 1
+        frame = decode_frame(frame_data)
+        if frame.get('malformed'):
+            self.malformed_frames += 1
+        fid = frame.get('frame_id')
+        if fid:
+            self._on_air.discard(fid)
+            fut = self._pending.get(fid)
+            if isinstance(fut, list):
+                fut.append(frame)
+            elif fut is not None and not fut.done():
+                fut.set_result(frame)
+        for callback, names in list(self._subscribers):
+            if names is None or frame['id'] in names:
+                # One broken subscriber mustn't stop the others, or the
+                # reader, from getting the frame
+                try:
+                    callback(frame)
+                except Exception:
+                    self.callback_errors += 1
+                    log.exception('subscriber %r failed on a %s frame', callback, frame['id'])
+
+    def subscribe(self, callback, frame_types=None):
+        # Call callback(frame) for every received frame, or only those whose
+        # 'id' is one of frame_types, e.g. 'rx' or ('rx', 'status')
+        if isinstance(frame_types, str):
+            frame_types = (frame_types,)
+        entry = (callback, frozenset(frame_types) if frame_types else None)
+        self._subscribers.append(entry)
+        return entry
+
+    def unsubscribe(self, entry):
+        self._subscribers.remove(entry)
+
+    def queue(self, frame_types='rx', maxsize=0):
+        # asyncio.Queue fed with received frames. When a bounded queue is full
+        # the oldest frame is dropped so a slow reader never stalls the port.
+        q = asyncio.Queue(maxsize)
+
+        def put(frame):
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(frame)
+        q.subscription = self.subscribe(put, frame_types)
+        return q
+
+    # -------------------------------------------------------------- sending
+
+    def _allocate_id(self):
+        # Frame ID 0 means "no response", so IDs run from 1 to 255. IDs of
+        # timed out requests sit out their quarantine unless nothing else is
+        # free, then the one released soonest is used.
+        now = self.loop.time()
+        for fid, until in list(self._quarantine.items()):
+            if until <= now:
+                del self._quarantine[fid]
+        for _ in range(255):
+            fid = self._next_id
+            self._next_id = fid % 255 + 1
+            if fid not in self._pending and fid not in self._quarantine:
+                return fid
+        free = [fid for fid in self._quarantine if fid not in self._pending]
+        if free:
+            fid = min(free, key=self._quarantine.get)
+            del self._quarantine[fid]
+            return fid
+        raise XBeeError('no free frame IDs')
+
+    async def request(self, frame_data, timeout=None):
+        # Send one frame whose second byte is the frame ID and wait for the
+        # response with the same ID. frame_data[1] is filled in here.
+        async with self._slots:
+            fid = self._allocate_id()
+            frame_data = bytearray(frame_data)
+            frame_data[1] = fid
+            fut = self.loop.create_future()
+            self._pending[fid] = fut
+            if frame_data[0] in (FRAME_TRANSMIT_REQUEST, FRAME_REMOTE_AT_COMMAND):
+                self._on_air.add(fid)
+            try:
+                self.send_frame(frame_data)
+                return await asyncio.wait_for(fut, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                self._quarantine[fid] = self.loop.time() + FRAME_ID_QUARANTINE
+                raise XBeeTimeout('no response to frame {}'.format(fid))
+            finally:
+                self._pending.pop(fid, None)
+                self._on_air.discard(fid)
+
+    @property
+    def on_air(self):
+        # Transmissions waiting for their status. Fire and forget sends
+        # (send_nowait) can't be seen here.
+        return len(self._on_air)
+
+    def send_frame(self, *parts):
+        # Queue raw frame data, optionally in parts, for transmission without
+        # waiting for anything
+        self._encoder.append(*parts)
+        self.frames_sent += 1
+        if not self._writing:
+            self._on_writable()
+
+    def transmit_request(self, addr, data, frame_id=0, options=0):
+        return (struct.pack('>BB8s2sBB', FRAME_TRANSMIT_REQUEST, frame_id, to_address(addr),
+                            UNKNOWN_ADDRESS_16, self.broadcast_radius, options) + bytes(data))
+
+    async def send(self, addr, data, timeout=None, retries=None, options=0):
+        # Send data to addr and wait for its TX status. Returns the TX status
+        # frame on success, raises DeliveryError or XBeeTimeout once the
+        # retries are used up. Any number of sends may be awaited at once.
+        retries = self.retries if retries is None else retries
+        frame = self.transmit_request(addr, data, 0, options)
+        for attempt in range(retries + 1):
+            try:
+                status = await self.request(frame, timeout)
+            except XBeeTimeout:
+                if attempt == retries:
+                    raise
+                continue
+            if status['deliver_status'] == DELIVERY_STATUS_SUCCESS:
+                return status
+            if status['deliver_status'] not in RETRY_STATUSES or attempt == retries:
+                raise DeliveryError(status['deliver_status'])
+
+    def send_nowait(self, addr, data, options=0):
+        # Fire and forget, the radio sends no TX status for frame ID 0
+        self.send_frame(self.transmit_request(addr, data, 0, options))
+
+    async def broadcast(self, data, timeout=None):
+        return await self.send(BROADCAST_ADDRESS, data, timeout, retries=0)
+
+    async def at_command(self, command, parameter=b'', timeout=None, queue=False):
+        # Run an AT command on the local radio, returns the parameter bytes.
+        # With queue=True a new value is only stored, and takes effect with
+        # the next non-queued command (e.g. AC).
+        ftype = FRAME_AT_COMMAND_QUEUE if queue else FRAME_AT_COMMAND
+        frame = struct.pack('>BB', ftype, 0) + _as_bytes(command) + _as_bytes(parameter)
+        response = await self.request(frame, timeout)
+        if response['status'] != AT_STATUS_OK:
+            raise XBeeError('AT{} failed with status {}'.format(
+                _as_bytes(command).decode('ascii'), response['status']))
+        return response['parameter']
+
+    async def discover_nodes(self, timeout=None):
+        # Network discovery (ND). Every node answers separately within the
+        # discovery timeout NT (in 100 ms units), so collect for that long.
+        if timeout is None:
+            timeout = int.from_bytes(await self.at_command('NT'), 'big') / 10.0 + 1.0
+        async with self._slots:
+            fid = self._allocate_id()
+            responses = self._pending[fid] = []
+            try:
+                self.send_frame(struct.pack('>BB', FRAME_AT_COMMAND, fid) + b'ND')
+                await asyncio.sleep(timeout)
+            finally:
+                self._pending.pop(fid, None)
+        return [parse_node_discovery(r['parameter']) for r in responses
+                if r['status'] == AT_STATUS_OK and r['parameter']]
+
+    async def remote_at_command(self, addr, command, parameter=b'', apply=True, timeout=None):
+        frame = (struct.pack('>BB8s2sB', FRAME_REMOTE_AT_COMMAND, 0, to_address(addr),
+                             UNKNOWN_ADDRESS_16, 0x02 if apply else 0x00)
+                 + _as_bytes(command) + _as_bytes(parameter))
+        response = await self.request(frame, timeout)
+        if response['status'] != AT_STATUS_OK:
+            raise XBeeError('remote AT{} failed with status {}'.format(
+                _as_bytes(command).decode('ascii'), response['status']))
+        return response['parameter']
+
+
+def _as_bytes(value):
+    if isinstance(value, str):
+        return value.encode('ascii')
+    if isinstance(value, int):
+        # AT parameters are big endian with no leading zero bytes
+        return value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big')
+    return bytes(value)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Send each command line argument as a message to every known CATMAN node
+    # and print whatever arrives in the meantime
+    from xbee_devices import xbeeDevicesMacAddress
+
+    async def main():
+        async with XBeeClient('/dev/serial0', 9600) as xbee:
+            xbee.subscribe(print, 'rx')
+            sends = [xbee.send(addr, arg.encode('ascii'))
+                     for arg in sys.argv[1:] for addr in xbeeDevicesMacAddress.values()]
+            for result in await asyncio.gather(*sends, return_exceptions=True):
+                print(result)
+
+    asyncio.run(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# XBee API frame encoder/decoder, for API mode 1 (AP=1) and escaped API mode
+# 2 (AP=2).
+#
+# The xbee package parses one byte at a time in Python, which is a lot of work
+# for a Pi Zero at 115200 baud. Here the receive buffer is scanned with
+# bytes.find for start delimiters, escapes are undone with bytes.translate on
+# the few frames that have any, and payloads are handed out as memoryviews of
+# the receive buffer so nothing is copied per frame.
+#
+#   decoder = FrameDecoder(escaped=True)
+#   for frame_data in decoder.feed(ser.read(ser.in_waiting or 1)):
+#       frame_type = frame_data[0]
+
+import re
+import struct
+
+START_BYTE = 0x7E
+ESCAPE_BYTE = 0x7D
+XON = 0x11
+XOFF = 0x13
+
+_START = b'\x7e'
+_ESCAPE = b'\x7d'
+# bytes.translate table flipping bit 5, which is how escaped bytes are stored
+_XOR20 = bytes(b ^ 0x20 for b in range(256))
+_ESCAPE_RE = re.compile(b'[\x7e\x7d\x11\x13]')
+_ESCAPED = dict((bytes((b,)), bytes((ESCAPE_BYTE, b ^ 0x20))) for b in (START_BYTE, ESCAPE_BYTE, XON, XOFF))
+
+# Largest frame we accept, anything longer is treated as line noise. The
+# biggest DigiMesh frames (NP=256 payloads plus headers) are well under this.
+MAX_FRAME_LENGTH = 1024
+
+
+def checksum(*parts):
+    total = 0
+    for part in parts:
+        total += sum(part)
+    return 0xFF - (total & 0xFF)
+
+
+def escape(data):
+    # Escape 0x7E, 0x7D, XON and XOFF. Most frames contain none of them, in
+    # which case the search runs in C and the data is returned as is.
+    if _ESCAPE_RE.search(data) is None:
+        return data
+    return _ESCAPE_RE.sub(lambda m: _ESCAPED[m.group()], data)
+
+
+def unescape(data):
+    # Undo escape(). Every 0x7D is followed by a byte to flip, so after a split
+    # on 0x7D the first byte of every part but the first one needs flipping.
+    if ESCAPE_BYTE not in data:
+        return data
+    parts = bytes(data).split(_ESCAPE)
+    out = bytearray(parts[0])
+    for part in parts[1:]:
+        out += part[:1].translate(_XOR20)
+        out += part[1:]
+    return bytes(out)
+
+
+def encode_frame(frame_data, escaped=True):
+    # One complete frame as bytes
+    out = bytearray()
+    FrameEncoder(escaped).append_into(out, frame_data)
+    return bytes(out)
+
+
+class FrameEncoder(object):
+    # Builds frames into one reusable bytearray, so a batch of frames becomes
+    # a single serial write:
+    #
+    #   encoder.append(header, payload)
+    #   encoder.append(other_frame)
+    #   ser.write(encoder.take())
+    def __init__(self, escaped=True):
+        self.escaped = escaped
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def append(self, *parts):
+        # Frame data may be given in parts (e.g. API header and payload), which
+        # saves concatenating them first
+        self.append_into(self.buffer, *parts)
+
+    def append_into(self, out, *parts):
+        length = 0
+        for part in parts:
+            length += len(part)
+        if length > 0xFFFF:
+            raise ValueError('frame data too long: {} bytes'.format(length))
+        out.append(START_BYTE)
+        header = struct.pack('>H', length)
+        trailer = bytes((checksum(*parts),))
+        if self.escaped:
+            out += escape(header)
+            for part in parts:
+                out += escape(part)
+            out += escape(trailer)
+        else:
+            out += header
+            for part in parts:
+                out += part
+            out += trailer
+        return out
+
+    def take(self):
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+
+class FrameDecoder(object):
+    # Incremental decoder. feed() takes whatever arrived on the serial port and
+    # returns the frame data (frame type byte onwards, without length and
+    # checksum) of every complete frame as a memoryview. The views point into
+    # an immutable bytes object, so they stay valid after later feeds.
+    def __init__(self, escaped=True, max_length=MAX_FRAME_LENGTH):
+        self.escaped = escaped
+        self.max_length = max_length
+        self._pending = b''
+
+        self.frames = 0
+        self.checksum_errors = 0
+        self.discarded_bytes = 0
+
+    def reset(self):
+        self._pending = b''
+
+    def feed(self, data):
+        # One copy per feed to join the leftover with the new data. Frames
+        # are then sliced out of it without copying.
+        buf = self._pending + bytes(data) if self._pending else bytes(data)
+        if self.escaped:
+            frames, rest = self._scan_escaped(buf)
+        else:
+            frames, rest = self._scan_unescaped(buf)
+        self._pending = buf[rest:]
+        return frames
+
+    def _check(self, body, length):
+        # body is length(2) + frame data + checksum
+        if sum(body[2:length + 3]) & 0xFF != 0xFF:
+            self.checksum_errors += 1
+            return None
+        self.frames += 1
+        return body[2:length + 2]
+
+    def _scan_escaped(self, buf):
+        # In API mode 2 a 0x7E byte is always a start delimiter, so each frame
+        # is simply everything between one 0x7E and the next.
+        frames = []
+        view = memoryview(buf)
+        start = buf.find(_START)
+        if start < 0:
+            self.discarded_bytes += len(buf)
+            return frames, len(buf)
+        self.discarded_bytes += start
+
+        while True:
+            end = buf.find(_START, start + 1)
+            last = end < 0
+            if last:
+                end = len(buf)
+
+            if buf.find(_ESCAPE, start + 1, end) < 0:
+                body = view[start + 1:end]
+            else:
+                if last and buf[end - 1] == ESCAPE_BYTE:
+                    # The byte after the escape hasn't arrived yet
+                    return frames, start
+                body = memoryview(unescape(view[start + 1:end]))
+
+            if len(body) < 2:
+                if last:
+                    return frames, start
+                self.discarded_bytes += end - start
+                start = end
+                continue
+            length = (body[0] << 8) | body[1]
+            if length > self.max_length:
+                self.discarded_bytes += end - start
+                if last:
+                    return frames, end
+                start = end
+                continue
+            if len(body) < length + 3:
+                if last:
+                    return frames, start
+                # Cut short by the next start delimiter
+                self.discarded_bytes += end - start
+                start = end
+                continue
+
+            self.discarded_bytes += len(body) - (length + 3)
+            frame = self._check(body, length)
+            if frame is not None:
+                frames.append(frame)
+            if last:
+                return frames, end
+            start = end
+
+    def _scan_unescaped(self, buf):
+        # In API mode 1 0x7E may also turn up inside a frame, so we have to
+        # trust the length field and only resynchronise on a bad checksum.
+        frames = []
+        view = memoryview(buf)
+        pos = 0
+        while True:
+            start = buf.find(_START, pos)
+            if start < 0:
+                self.discarded_bytes += len(buf) - pos
+                return frames, len(buf)
+            self.discarded_bytes += start - pos
+            if len(buf) - start < 3:
+                return frames, start
+            length = (buf[start + 1] << 8) | buf[start + 2]
+            if length > self.max_length:
+                self.discarded_bytes += 1
+                pos = start + 1
+                continue
+            end = start + length + 4
+            if end > len(buf):
+                return frames, start
+            frame = self._check(view[start + 1:end], length)
+            if frame is None:
+                self.discarded_bytes += 1
+                pos = start + 1
+                continue
+            frames.append(frame)
+            pos = end
+
+
+if __name__ == '__main__':
+    import time
+
+    # Decode a few seconds' worth of 115200 baud receive frames and report
+    # how much CPU it takes per second of link time
+    baud = 115200
+    seconds = 10
+    payload = bytes(range(64))
+    frame_data = b'\x90' + bytes.fromhex('0013A200415A8686') + b'\xff\xfe\x01' + payload
+    for escaped in (False, True):
+        stream = encode_frame(frame_data, escaped) * (baud // 10 * seconds // (len(frame_data) + 6))
+        decoder = FrameDecoder(escaped)
+        started = time.time()
+        count = 0
+        for i in range(0, len(stream), 256):
+            count += len(decoder.feed(stream[i:i + 256]))
+        took = time.time() - started
+        print('AP={}: {} frames, {:.1f} ms of CPU per second at {} baud'.format(
+            2 if escaped else 1, count, took * 1000 / seconds, baud))
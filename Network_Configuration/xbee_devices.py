@@ -0,0 +1,6 @@
+# 64-bit addresses of the CATMAN nodes' radios, by node name (NI).
+#
+# The same table as in customSender.py, shared by the asyncio tools so that
+# none of them has to import another tool just for the addresses.
+
+xbeeDevicesMacAddress = {'CATMAN2': '0013A200415A8686', 'CATMAN1': '0013A2004104746F'}
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# Simulated XBee DigiMesh network on pseudo-terminals.
+#
+# Testing the networking code needs "at least one other XBee on the network".
+# This runs any number of virtual radios on one Linux box, each behind its own
+# pty, so anything that opens a serial port (the Python scripts, XBeeClient,
+# the node digimesh module) can talk to it unmodified. Point it at the pty, or
+# at the symlink made with --link-dir, instead of /dev/serial0.
+#
+# Each virtual radio speaks the API frame protocol (AP=1 or escaped AP=2):
+# local and remote AT commands including ND and DB, transmit requests with TX
+# status and receive packets. AP=0 gives transparent mode, where whatever is
+# written is sent to DH/DL and whatever arrives is written out as is, which is
+# what customSender.py and receiverScript.py use. Between the radios the
+# network models per link bandwidth, latency, loss with MAC retries and RSSI,
+# and routes over several hops when nodes are not neighbours.
+#
+#   python3 xbee_sim.py CATMAN1 CATMAN2 CATMAN3 --links CATMAN1:CATMAN2 \
+#       CATMAN2:CATMAN3 --loss 0.05 --link-dir /tmp/xbee
+#
+# Without --links every node hears every other node.
+
+import argparse
+import asyncio
+import collections
+import os
+import random
+import struct
+import tty
+
+from xbee_async import (AT_STATUS_OK, BROADCAST_ADDRESS, DELIVERY_STATUS_MAC_ACK_FAILURE,
+                        DELIVERY_STATUS_PAYLOAD_TOO_LARGE, DELIVERY_STATUS_ROUTE_NOT_FOUND,
+                        DELIVERY_STATUS_SUCCESS, FRAME_AT_COMMAND, FRAME_AT_COMMAND_QUEUE,
+                        FRAME_AT_COMMAND_RESPONSE, FRAME_MODEM_STATUS, FRAME_RECEIVE_PACKET,
+                        FRAME_REMOTE_AT_COMMAND, FRAME_REMOTE_AT_COMMAND_RESPONSE,
+                        FRAME_TRANSMIT_REQUEST, FRAME_TRANSMIT_STATUS, MODEM_STATUS_HARDWARE_RESET,
+                        UNKNOWN_ADDRESS_16)
+from xbee_codec import FrameDecoder, encode_frame
+
+AT_STATUS_ERROR = 1
+AT_STATUS_INVALID_COMMAND = 2
+AT_STATUS_TX_FAILURE = 4
+
+# Serial rate for each ATBD value
+BAUD_RATES = {0: 1200, 1: 2400, 2: 4800, 3: 9600, 4: 19200, 5: 38400, 6: 57600, 7: 115200, 8: 230400}
+
+# Parameters that can only be read
+READ_ONLY_PARAMS = ('SH', 'SL', 'MY', 'NP', 'DB', 'SS', 'VR', 'HV', 'DD')
+
+# Receive options
+RX_ACKNOWLEDGED = 0x01
+RX_BROADCAST = 0x02
+
+# Defaults for a fresh radio. NT is shorter than a real radio's so tests
+# don't wait 13 seconds for every discovery.
+DEFAULT_PARAMS = {
+    'MY': 0xFFFE, 'NP': 73, 'NT': 0x19, 'BD': 3, 'D6': 0, 'D7': 0,
+    'DH': 0, 'DL': 0xFFFF, 'ST': 0x7D0, 'SP': 0xC8, 'SS': 0, 'DB': 0,
+    'CH': 0x0C, 'ID': 0x7FFF, 'MT': 3, 'RR': 10, 'NH': 7, 'BH': 0,
+    'VR': 0x8075, 'HV': 0x1E42, 'DD': 0x50000,
+}
+
+
+class Link(object):
+    def __init__(self, bandwidth=3000.0, latency=0.01, loss=0.0, rssi=-50):
+        # Bytes per second on air, seconds per hop, chance that one attempt
+        # is lost, and the RSSI the receiver reports
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.loss = loss
+        self.rssi = rssi
+        # One frame on the air at a time
+        self.busy = asyncio.Lock()
+
+
+class SimNetwork(object):
+    def __init__(self, mac_retries=3, rng=None):
+        self.mac_retries = mac_retries
+        self.rng = rng or random.Random()
+        self.nodes = collections.OrderedDict()
+        self.links = {}
+
+    def add_node(self, name, addr=None, ap=2, **kwargs):
+        if addr is None:
+            addr = bytes.fromhex('0013A200') + struct.pack('>I', 0x40000000 + len(self.nodes) + 1)
+        node = SimNode(self, name, addr, ap, **kwargs)
+        self.nodes[addr] = node
+        return node
+
+    def connect(self, a, b, **kwargs):
+        link = Link(**kwargs)
+        self.links[a.addr, b.addr] = self.links[b.addr, a.addr] = link
+        return link
+
+    def connect_all(self, **kwargs):
+        nodes = list(self.nodes.values())
+        for i, a in enumerate(nodes):
+            for b in nodes[i + 1:]:
+                self.connect(a, b, **kwargs)
+
+    def neighbours(self, addr):
+        return [b for (a, b) in self.links if a == addr]
+
+    def route(self, src, dst):
+        # Fewest hops, breadth first. None when unreachable.
+        previous = {src: None}
+        todo = collections.deque([src])
+        while todo:
+            here = todo.popleft()
+            if here == dst:
+                path = []
+                while here is not None:
+                    path.append(here)
+                    here = previous[here]
+                return path[::-1]
+            for there in self.neighbours(here):
+                if there not in previous:
+                    previous[there] = here
+                    todo.append(there)
+        return None
+
+    async def _hop(self, a, b, size):
+        # One hop with MAC level retries. Returns the RSSI or None if lost.
+        link = self.links[a, b]
+        for _ in range(self.mac_retries + 1):
+            async with link.busy:
+                await asyncio.sleep(size / link.bandwidth)
+            await asyncio.sleep(link.latency)
+            if self.rng.random() >= link.loss:
+                return link.rssi
+        return None
+
+    async def unicast(self, src, dst, data):
+        # Returns (delivery status, RSSI of the last hop)
+        if dst not in self.nodes:
+            return DELIVERY_STATUS_ROUTE_NOT_FOUND, None
+        path = self.route(src, dst)
+        if path is None:
+            return DELIVERY_STATUS_ROUTE_NOT_FOUND, None
+        rssi = None
+        for a, b in zip(path, path[1:]):
+            rssi = await self._hop(a, b, len(data))
+            if rssi is None:
+                return DELIVERY_STATUS_MAC_ACK_FAILURE, None
+        return DELIVERY_STATUS_SUCCESS, rssi
+
+    async def broadcast(self, src, data, deliver):
+        # Flood hop by hop, every node that hears it gets it once
+        seen = set([src])
+        frontier = [src]
+        while frontier:
+            hops = []
+            for a in frontier:
+                for b in self.neighbours(a):
+                    if b not in seen:
+                        seen.add(b)
+                        hops.append((a, b))
+            results = await asyncio.gather(*[self._hop(a, b, len(data)) for a, b in hops])
+            frontier = []
+            for (a, b), rssi in zip(hops, results):
+                if rssi is not None:
+                    deliver(self.nodes[b], rssi)
+                    frontier.append(b)
+
+
+class SimNode(object):
+    def __init__(self, network, name, addr, ap=2, max_payload=73):
+        self.network = network
+        self.name = name
+        self.addr = addr
+        self.params = dict(DEFAULT_PARAMS)
+        self.params.update({'NI': name, 'SH': struct.unpack('>I', addr[:4])[0],
+                            'SL': struct.unpack('>I', addr[4:])[0], 'AP': ap, 'NP': max_payload})
+        # Values set with queued AT commands (0x09), applied by the next
+        # immediate one
+        self.queued = {}
+        self.master = None
+        self.slave = None
+        self.path = None
+        self._decoder = FrameDecoder(ap == 2)
+        self._out = asyncio.Queue()
+        self._tasks = []
+
+        self.frames_in = 0
+        self.frames_out = 0
+
+    @property
+    def ap(self):
+        return self.params['AP']
+
+    @property
+    def baudrate(self):
+        return BAUD_RATES.get(self.params['BD'], 9600)
+
+    # ------------------------------------------------------------- serial
+
+    def open(self, link_dir=None):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        # Keeping our own handle on the slave side keeps the pty alive while
+        # clients open and close it
+        self.path = os.ttyname(self.slave)
+        if link_dir:
+            os.makedirs(link_dir, exist_ok=True)
+            link = os.path.join(link_dir, self.name)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.path, link)
+            self.path = link
+        loop = asyncio.get_event_loop()
+        loop.add_reader(self.master, self._on_readable)
+        self._tasks.append(asyncio.ensure_future(self._writer()))
+        if self.ap:
+            self._send(bytes((FRAME_MODEM_STATUS, MODEM_STATUS_HARDWARE_RESET)))
+        return self
+
+    def close(self):
+        if self.master is None:
+            return
+        asyncio.get_event_loop().remove_reader(self.master)
+        for task in self._tasks:
+            task.cancel()
+        os.close(self.master)
+        os.close(self.slave)
+        self.master = None
+
+    async def _writer(self):
+        # Pace output at the serial rate, 10 bits per byte
+        while True:
+            data = await self._out.get()
+            view = memoryview(data)
+            while view:
+                try:
+                    n = os.write(self.master, view)
+                except BlockingIOError:
+                    n = 0
+                view = view[n:]
+                await asyncio.sleep(max(n, 1) * 10.0 / self.baudrate)
+
+    def _write(self, data):
+        self._out.put_nowait(bytes(data))
+
+    def _send(self, frame_data):
+        self.frames_out += 1
+        self._write(encode_frame(frame_data, self.ap == 2))
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        if not self.ap:
+            self._spawn(self._transparent(data))
+            return
+        self._decoder.escaped = self.ap == 2
+        for frame_data in self._decoder.feed(data):
+            self.frames_in += 1
+            self._handle(bytes(frame_data))
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.append(task)
+        task.add_done_callback(self._tasks.remove)
+
+    # ------------------------------------------------------------- frames
+
+    def _handle(self, frame):
+        ftype = frame[0]
+        if ftype in (FRAME_AT_COMMAND, FRAME_AT_COMMAND_QUEUE):
+            fid, command, parameter = frame[1], frame[2:4].decode('ascii', 'replace'), frame[4:]
+            if ftype == FRAME_AT_COMMAND_QUEUE and parameter:
+                status, value = self.queue(command, parameter)
+            else:
+                if ftype == FRAME_AT_COMMAND:
+                    self.apply_queued()
+                if command == 'ND':
+                    self._spawn(self._discover(fid))
+                    return
+                status, value = self.at(command, parameter)
+            if fid:
+                self._send(struct.pack('>BB', FRAME_AT_COMMAND_RESPONSE, fid) + frame[2:4]
+                           + bytes((status,)) + value)
+        elif ftype == FRAME_REMOTE_AT_COMMAND:
+            self._spawn(self._remote_at(frame))
+        elif ftype == FRAME_TRANSMIT_REQUEST:
+            fid, dest = frame[1], frame[2:10]
+            self._spawn(self._transmit(fid, dest, frame[14:]))
+
+    def queue(self, command, parameter):
+        # Store a new value for apply_queued()
+        if command not in self.params:
+            return AT_STATUS_INVALID_COMMAND, b''
+        if command in READ_ONLY_PARAMS:
+            return AT_STATUS_ERROR, b''
+        self.queued[command] = parameter
+        return AT_STATUS_OK, b''
+
+    def apply_queued(self):
+        queued, self.queued = self.queued, {}
+        for command, parameter in queued.items():
+            self.at(command, parameter)
+
+    def at(self, command, parameter=b''):
+        # Query or set one parameter. Returns (status, value bytes).
+        if command in ('AC', 'WR', 'CN', 'FR', 'RE'):
+            if command == 'RE':
+                self.params.update(DEFAULT_PARAMS)
+            return AT_STATUS_OK, b''
+        if command not in self.params:
+            return AT_STATUS_INVALID_COMMAND, b''
+        current = self.params[command]
+        if parameter:
+            if command in READ_ONLY_PARAMS:
+                return AT_STATUS_ERROR, b''
+            if isinstance(current, str):
+                self.params[command] = parameter.decode('ascii', 'replace')
+            else:
+                if command == 'AP' and parameter[-1] > 2:
+                    return AT_STATUS_ERROR, b''
+                self.params[command] = int.from_bytes(parameter, 'big')
+            return AT_STATUS_OK, b''
+        if isinstance(current, str):
+            return AT_STATUS_OK, current.encode('ascii')
+        width = 4 if command in ('SH', 'SL', 'DD') else max(1, (current.bit_length() + 7) // 8)
+        return AT_STATUS_OK, current.to_bytes(width, 'big')
+
+    def discovery_record(self, rssi=None):
+        # This node's ND answer, same layout as the real radio's
+        record = (struct.pack('>H', self.params['MY']) + self.addr + self.params['NI'].encode('ascii')
+                  + b'\x00' + struct.pack('>HBBHH', 0xFFFE, 1, 0, 0xC105, 0x101E))
+        if rssi is not None:
+            record += bytes((min(255, -rssi),))
+        return record
+
+    async def _discover(self, fid):
+        # Every reachable node answers at a random time within NT
+        timeout = self.params['NT'] / 10.0
+        answers = []
+        for addr, node in self.network.nodes.items():
+            if addr == self.addr or self.network.route(self.addr, addr) is None:
+                continue
+            answers.append((self.network.rng.uniform(0, timeout * 0.8), node))
+        elapsed = 0.0
+        for delay, node in sorted(answers, key=lambda a: a[0]):
+            await asyncio.sleep(delay - elapsed)
+            elapsed = delay
+            path = self.network.route(self.addr, node.addr)
+            link = self.network.links[path[-2], path[-1]]
+            self._send(struct.pack('>BB', FRAME_AT_COMMAND_RESPONSE, fid) + b'ND'
+                       + bytes((AT_STATUS_OK,)) + node.discovery_record(link.rssi))
+
+    async def _remote_at(self, frame):
+        fid, dest, options, command, parameter = frame[1], frame[2:10], frame[12], frame[13:15], frame[15:]
+        status, rssi = await self.network.unicast(self.addr, dest, frame)
+        if status == DELIVERY_STATUS_SUCCESS:
+            target = self.network.nodes[dest]
+            at_status, value = target.at(command.decode('ascii', 'replace'), parameter)
+            status, _ = await self.network.unicast(dest, self.addr, value)
+        if status != DELIVERY_STATUS_SUCCESS:
+            at_status, value = AT_STATUS_TX_FAILURE, b''
+        if fid:
+            self._send(struct.pack('>BB', FRAME_REMOTE_AT_COMMAND_RESPONSE, fid) + dest + UNKNOWN_ADDRESS_16
+                       + command + bytes((at_status,)) + value)
+
+    async def _transmit(self, fid, dest, data):
+        if len(data) > self.params['NP']:
+            status = DELIVERY_STATUS_PAYLOAD_TOO_LARGE
+        elif dest == BROADCAST_ADDRESS:
+            await self.network.broadcast(self.addr, data,
+                                         lambda node, rssi: node.receive(self.addr, data, rssi, True))
+            status = DELIVERY_STATUS_SUCCESS
+        else:
+            status, rssi = await self.network.unicast(self.addr, dest, data)
+            if status == DELIVERY_STATUS_SUCCESS:
+                self.network.nodes[dest].receive(self.addr, data, rssi, False)
+        if fid:
+            self._send(struct.pack('>BBHBBB', FRAME_TRANSMIT_STATUS, fid, 0xFFFE, 0, status, 0))
+
+    def receive(self, src, data, rssi, broadcast):
+        self.params['DB'] = min(255, -rssi)
+        if not self.ap:
+            self._write(data)
+            return
+        options = RX_BROADCAST if broadcast else RX_ACKNOWLEDGED
+        self._send(bytes((FRAME_RECEIVE_PACKET,)) + src + UNKNOWN_ADDRESS_16 + bytes((options,)) + data)
+
+    async def _transparent(self, data):
+        # Transparent mode sends to DH/DL in payload sized pieces
+        dest = struct.pack('>II', self.params['DH'], self.params['DL'])
+        if dest == b'\x00' * 6 + b'\xff\xff':
+            dest = BROADCAST_ADDRESS
+        for i in range(0, len(data), self.params['NP']):
+            await self._transmit(0, dest, data[i:i + self.params['NP']])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate an XBee DigiMesh network on ptys')
+    parser.add_argument('nodes', nargs='+', help='node identifiers, e.g. CATMAN1 CATMAN2')
+    parser.add_argument('--links', nargs='*', help='A:B pairs of neighbours, default all pairs')
+    parser.add_argument('--api', type=int, default=2, choices=(0, 1, 2), help='AP mode of every node')
+    parser.add_argument('--bandwidth', type=float, default=3000.0, help='bytes per second per link')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per hop')
+    parser.add_argument('--loss', type=float, default=0.0, help='chance one attempt is lost')
+    parser.add_argument('--rssi', type=int, default=-50)
+    parser.add_argument('--max-payload', type=int, default=73)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--link-dir', help='make a symlink per node here, e.g. /tmp/xbee/CATMAN1')
+    args = parser.parse_args()
+
+    async def main():
+        network = SimNetwork(rng=random.Random(args.seed))
+        for name in args.nodes:
+            network.add_node(name, ap=args.api, max_payload=args.max_payload)
+        link_options = dict(bandwidth=args.bandwidth, latency=args.latency, loss=args.loss, rssi=args.rssi)
+        if args.links:
+            by_name = dict((node.name, node) for node in network.nodes.values())
+            for pair in args.links:
+                a, b = pair.split(':')
+                network.connect(by_name[a], by_name[b], **link_options)
+        else:
+            network.connect_all(**link_options)
+        for node in network.nodes.values():
+            node.open(args.link_dir)
+            print('{:10s} {}  {}'.format(node.name, node.addr.hex().upper(), node.path))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            for node in network.nodes.values():
+                node.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
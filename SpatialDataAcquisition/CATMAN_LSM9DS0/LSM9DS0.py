@@ -28,6 +28,8 @@
 
 import Adafruit_GPIO.I2C as I2C
 import math
+import struct
+import time
 
 class LSM9DS0(object):
     # The same address is used for both the magnetometer and accelerometer, but
@@ -39,14 +41,29 @@ class LSM9DS0(object):
     #LSM9DS0 gyrometer registers
     LSM9DS0_WHO_AM_I_G	      =	0x0F
     LSM9DS0_CTRL_REG1_G	      =	0x20
+    LSM9DS0_CTRL_REG2_G       = 0x21
     LSM9DS0_CTRL_REG3_G	      =	0x22
     LSM9DS0_CTRL_REG4_G	      =	0x23
+    LSM9DS0_CTRL_REG5_G       = 0x24
+    LSM9DS0_REFERENCE_G       = 0x25
+    LSM9DS0_STATUS_REG_G      = 0x27
     LSM9DS0_OUT_X_L_G	      =	0x28
     LSM9DS0_OUT_X_H_G	      =	0x29
     LSM9DS0_OUT_Y_L_G	      =	0x2A
     LSM9DS0_OUT_Y_H_G	      =	0x2B
     LSM9DS0_OUT_Z_L_G	      =	0x2C
     LSM9DS0_OUT_Z_H_G	      =	0x2D
+    LSM9DS0_FIFO_CTRL_REG_G   = 0x2E
+    LSM9DS0_FIFO_SRC_REG_G    = 0x2F
+    LSM9DS0_INT1_CFG_G        = 0x30
+    LSM9DS0_INT1_SRC_G        = 0x31
+    LSM9DS0_INT1_THS_XH_G     = 0x32
+    LSM9DS0_INT1_THS_XL_G     = 0x33
+    LSM9DS0_INT1_THS_YH_G     = 0x34
+    LSM9DS0_INT1_THS_YL_G     = 0x35
+    LSM9DS0_INT1_THS_ZH_G     = 0x36
+    LSM9DS0_INT1_THS_ZL_G     = 0x37
+    LSM9DS0_INT1_DURATION_G   = 0x38
 
     # LSM9DS0 temperature addresses
     LSM9DS0_OUT_TEMP_L_XM	  =	0x05
@@ -65,13 +82,46 @@ class LSM9DS0(object):
     LSM9DS0_WHO_AM_I_XM	      =	0x0F
     LSM9DS0_INT_CTRL_REG_M    =	0x12
     LSM9DS0_INT_SRC_REG_M	  =	0x13
+    LSM9DS0_INT_THS_L_M       = 0x14
+    LSM9DS0_INT_THS_H_M       = 0x15
+    LSM9DS0_OFFSET_X_L_M      = 0x16
+    LSM9DS0_OFFSET_X_H_M      = 0x17
+    LSM9DS0_OFFSET_Y_L_M      = 0x18
+    LSM9DS0_OFFSET_Y_H_M      = 0x19
+    LSM9DS0_OFFSET_Z_L_M      = 0x1A
+    LSM9DS0_OFFSET_Z_H_M      = 0x1B
+    LSM9DS0_REFERENCE_X_XM    = 0x1C
+    LSM9DS0_REFERENCE_Y_XM    = 0x1D
+    LSM9DS0_REFERENCE_Z_XM    = 0x1E
+    LSM9DS0_CTRL_REG0_XM      = 0x1F
     LSM9DS0_CTRL_REG1_XM      =	0x20
     LSM9DS0_CTRL_REG2_XM	  =	0x21
+    LSM9DS0_CTRL_REG3_XM      = 0x22
+    LSM9DS0_CTRL_REG4_XM      = 0x23
     LSM9DS0_CTRL_REG5_XM	  =	0x24
     LSM9DS0_CTRL_REG6_XM	  =	0x25
     LSM9DS0_CTRL_REG7_XM	  =	0x26
+    LSM9DS0_FIFO_CTRL_REG_XM  = 0x2E
+    LSM9DS0_FIFO_SRC_REG_XM   = 0x2F
+    LSM9DS0_INT_GEN_1_REG_XM  = 0x30
+    LSM9DS0_INT_GEN_1_SRC_XM  = 0x31
+    LSM9DS0_INT_GEN_1_THS_XM  = 0x32
+    LSM9DS0_INT_GEN_1_DURATION_XM = 0x33
+    LSM9DS0_INT_GEN_2_REG_XM  = 0x34
+    LSM9DS0_INT_GEN_2_SRC_XM  = 0x35
+    LSM9DS0_INT_GEN_2_THS_XM  = 0x36
+    LSM9DS0_INT_GEN_2_DURATION_XM = 0x37
+    LSM9DS0_CLICK_CFG_XM      = 0x38
+    LSM9DS0_CLICK_SRC_XM      = 0x39
+    LSM9DS0_CLICK_THS_XM      = 0x3A
+    LSM9DS0_TIME_LIMIT_XM     = 0x3B
+    LSM9DS0_TIME_LATENCY_XM   = 0x3C
+    LSM9DS0_TIME_WINDOW_XM    = 0x3D
+    LSM9DS0_ACT_THS_XM        = 0x3E
+    LSM9DS0_ACT_DUR_XM        = 0x3F
 
     # Accelerometer addresses
+    LSM9DS0_STATUS_REG_A      = 0x27
     LSM9DS0_OUT_X_L_A	      =	0x28
     LSM9DS0_OUT_X_H_A	      =	0x29
     LSM9DS0_OUT_Y_L_A	      =	0x2A
@@ -116,6 +166,44 @@ class LSM9DS0(object):
     LSM9DS0_GYROSCALE_500DPS             = 0b01 << 4
     LSM9DS0_GYROSCALE_2000DPS            = 0b10 << 4
 
+    # Full scale and output data rate for each setting of the range and
+    # rate bits, and the gyro's sensitivity in dps per count
+    ACCEL_RANGES_G    = {0b000: 2, 0b001: 4, 0b010: 6, 0b011: 8, 0b100: 16}
+    ACCEL_RATES_HZ    = {0b0001: 3.125, 0b0010: 6.25, 0b0011: 12.5, 0b0100: 25, 0b0101: 50,
+                         0b0110: 100, 0b0111: 200, 0b1000: 400, 0b1001: 800, 0b1010: 1600}
+    GYRO_SCALES_DPS   = {0b00: 245, 0b01: 500, 0b10: 2000, 0b11: 2000}
+    GYRO_SENSITIVITY  = {245: 0.00875, 500: 0.0175, 2000: 0.07}
+    GYRO_RATES_HZ     = {0b00: 95, 0b01: 190, 0b10: 380, 0b11: 760}
+
+    # Bits of INT_GEN_1_REG_XM / INT1_CFG_G and their source registers. A
+    # high event is an axis going over the threshold.
+    LSM9DS0_INT_XHIE        = 0b00000010
+    LSM9DS0_INT_YHIE        = 0b00001000
+    LSM9DS0_INT_ZHIE        = 0b00100000
+    LSM9DS0_INT_IA          = 0b01000000   # interrupt active, in the source registers
+    LSM9DS0_GYRO_INT_LATCH  = 0b01000000   # latch until INT1_SRC_G is read, in INT1_CFG_G
+    LSM9DS0_GYRO_INT_PIN    = 0b10000000   # gyro interrupt on the INT_G pin, in CTRL_REG3_G
+    LSM9DS0_ACCEL_INT_LATCH = 0b00000001   # latch INT_GEN_1, in CTRL_REG5_XM
+    LSM9DS0_ACCEL_INT_PIN   = 0b00100000   # INT_GEN_1 on the INT1_XM pin, in CTRL_REG3_XM
+    LSM9DS0_ACCEL_INT_HPF   = 0b00000010   # HPIS1, high-pass filtered data to INT_GEN_1, in CTRL_REG0_XM
+    LSM9DS0_ACCEL_HPM_BITS  = 0b11000000   # AHPM, high-pass filter mode, in CTRL_REG7_XM (00 normal)
+
+    # Expected WHO_AM_I answers
+    LSM9DS0_WHO_AM_I_G_VALUE             = 0xD4
+    LSM9DS0_WHO_AM_I_XM_VALUE            = 0x49
+
+    # Setting the top bit of the register address makes the chip step
+    # through the following registers in one multi-byte read
+    LSM9DS0_AUTO_INCREMENT               = 0x80
+
+    # The register map as (first register, count) blocks per device, read by
+    # snapshot(). Reserved registers inside a block read back harmlessly.
+    # Block reads are at most 32 bytes on the Pi's SMBus.
+    SNAPSHOT_BLOCKS = {
+        'gyro': ((0x0F, 1), (0x20, 25)),
+        'xm':   ((0x05, 11), (0x12, 32), (0x32, 14)),
+    }
+
     # Debug set to false for the moment. Change to find bugs
     def __init__(self, busnum=None):
         # Each feature is given a call name. Although The magnetometer and
@@ -200,3 +288,212 @@ class LSM9DS0(object):
         temp = self.mag.readList(self.LSM9DS0_OUT_TEMP_L_XM) | self.mag.readList(self.LSM9DS0_OUT_TEMP_H_XM) << 8
 
         return temp
+
+    # Current settings, read back from the control registers
+    def accelRange(self):
+        return self.ACCEL_RANGES_G[(self.accel.readU8(self.LSM9DS0_CTRL_REG2_XM) >> 3) & 0b111]
+
+    def accelRate(self):
+        return self.ACCEL_RATES_HZ.get(self.accel.readU8(self.LSM9DS0_CTRL_REG1_XM) >> 4, 0)
+
+    def gyroScale(self):
+        return self.GYRO_SCALES_DPS[(self.gyro.readU8(self.LSM9DS0_CTRL_REG4_G) >> 4) & 0b11]
+
+    def gyroRate(self):
+        return self.GYRO_RATES_HZ[self.gyro.readU8(self.LSM9DS0_CTRL_REG1_G) >> 6]
+
+    @classmethod
+    def _axisBits(cls, axes):
+        bits = 0
+        for axis, bit in (('x', cls.LSM9DS0_INT_XHIE), ('y', cls.LSM9DS0_INT_YHIE), ('z', cls.LSM9DS0_INT_ZHIE)):
+            if axis in axes.lower():
+                bits |= bit
+        return bits
+
+    # Make the accelerometer's interrupt generator 1 fire when any of the
+    # given axes is above threshold_g for duration_s, and put it on the
+    # INT1_XM pin. The threshold has 7 bits of full scale / 128, the
+    # duration counts samples at the current rate. The generator sees the
+    # high-pass filtered acceleration, so the threshold is on changes and
+    # gravity doesn't keep the axis it lies along over it; raw values would
+    # hold the pin high and give a single edge. A latched interrupt
+    # stays high until accelInterruptSource() is read, so only latch when
+    # something reads it after every event, otherwise later edges are lost.
+    def enableAccelInterrupt(self, threshold_g, duration_s=0.0, axes='xyz', latch=False):
+        lsb = self.accelRange() / 128.0
+        ths = max(0, min(127, int(round(threshold_g / lsb))))
+        duration = max(0, min(127, int(round(duration_s * self.accelRate()))))
+        self.accel.write8(self.LSM9DS0_INT_GEN_1_THS_XM, ths)
+        self.accel.write8(self.LSM9DS0_INT_GEN_1_DURATION_XM, duration)
+        self.accel.write8(self.LSM9DS0_INT_GEN_1_REG_XM, self._axisBits(axes))  # OR of the axes
+        # Filter in normal mode, routed to the interrupt generator only (the
+        # output registers stay unfiltered). Reading REFERENCE_X resets it.
+        reg7 = self.accel.readU8(self.LSM9DS0_CTRL_REG7_XM)
+        self.accel.write8(self.LSM9DS0_CTRL_REG7_XM, reg7 & ~self.LSM9DS0_ACCEL_HPM_BITS)
+        reg0 = self.accel.readU8(self.LSM9DS0_CTRL_REG0_XM)
+        self.accel.write8(self.LSM9DS0_CTRL_REG0_XM, reg0 | self.LSM9DS0_ACCEL_INT_HPF)
+        self.accel.readU8(self.LSM9DS0_REFERENCE_X_XM)
+        reg5 = self.accel.readU8(self.LSM9DS0_CTRL_REG5_XM)
+        reg5 = reg5 | self.LSM9DS0_ACCEL_INT_LATCH if latch else reg5 & ~self.LSM9DS0_ACCEL_INT_LATCH
+        self.accel.write8(self.LSM9DS0_CTRL_REG5_XM, reg5)
+        reg3 = self.accel.readU8(self.LSM9DS0_CTRL_REG3_XM)
+        self.accel.write8(self.LSM9DS0_CTRL_REG3_XM, reg3 | self.LSM9DS0_ACCEL_INT_PIN)
+        return ths * lsb, duration
+
+    def disableAccelInterrupt(self):
+        self.accel.write8(self.LSM9DS0_INT_GEN_1_REG_XM, 0)
+        reg0 = self.accel.readU8(self.LSM9DS0_CTRL_REG0_XM)
+        self.accel.write8(self.LSM9DS0_CTRL_REG0_XM, reg0 & ~self.LSM9DS0_ACCEL_INT_HPF)
+        reg3 = self.accel.readU8(self.LSM9DS0_CTRL_REG3_XM)
+        self.accel.write8(self.LSM9DS0_CTRL_REG3_XM, reg3 & ~self.LSM9DS0_ACCEL_INT_PIN)
+
+    # Same for the gyro, threshold in degrees per second. The gyro's
+    # threshold is 15 bits in output counts. Latching as for the
+    # accelerometer, cleared by gyroInterruptSource().
+    def enableGyroInterrupt(self, threshold_dps, duration_s=0.0, axes='xyz', latch=False):
+        counts = max(0, min(0x7FFF, int(round(threshold_dps / self.GYRO_SENSITIVITY[self.gyroScale()]))))
+        duration = max(0, min(127, int(round(duration_s * self.gyroRate()))))
+        for register in (self.LSM9DS0_INT1_THS_XH_G, self.LSM9DS0_INT1_THS_YH_G, self.LSM9DS0_INT1_THS_ZH_G):
+            self.gyro.write8(register, counts >> 8)
+            self.gyro.write8(register + 1, counts & 0xFF)
+        # WAIT bit so the interrupt also needs duration samples to clear
+        self.gyro.write8(self.LSM9DS0_INT1_DURATION_G, (0x80 if duration else 0) | duration)
+        self.gyro.write8(self.LSM9DS0_INT1_CFG_G,
+                         self._axisBits(axes) | (self.LSM9DS0_GYRO_INT_LATCH if latch else 0))
+        reg3 = self.gyro.readU8(self.LSM9DS0_CTRL_REG3_G)
+        self.gyro.write8(self.LSM9DS0_CTRL_REG3_G, reg3 | self.LSM9DS0_GYRO_INT_PIN)
+        return counts * self.GYRO_SENSITIVITY[self.gyroScale()], duration
+
+    def disableGyroInterrupt(self):
+        self.gyro.write8(self.LSM9DS0_INT1_CFG_G, 0)
+        reg3 = self.gyro.readU8(self.LSM9DS0_CTRL_REG3_G)
+        self.gyro.write8(self.LSM9DS0_CTRL_REG3_G, reg3 & ~self.LSM9DS0_GYRO_INT_PIN)
+
+    # Source registers: IA plus which axes went high. Reading them clears
+    # a latched interrupt.
+    def accelInterruptSource(self):
+        return self.accel.readU8(self.LSM9DS0_INT_GEN_1_SRC_XM)
+
+    def gyroInterruptSource(self):
+        return self.gyro.readU8(self.LSM9DS0_INT1_SRC_G)
+
+    # Capture the whole register map of both devices in a handful of block
+    # reads (5 bus transactions instead of one per register). Note that
+    # reading the interrupt source registers clears latched interrupts.
+    def snapshot(self):
+        devices = {'gyro': self.gyro, 'xm': self.accel}
+        images = {}
+        for name, blocks in self.SNAPSHOT_BLOCKS.items():
+            image = RegisterImage()
+            for first, count in blocks:
+                data = devices[name].readList(first | self.LSM9DS0_AUTO_INCREMENT, count)
+                image.set(first, data)
+            images[name] = image
+        return RegisterSnapshot(images['gyro'], images['xm'])
+
+    # Quick boot time check: both devices answer with the right WHO_AM_I
+    def healthy(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        return (snapshot.gyro.get(self.LSM9DS0_WHO_AM_I_G) == self.LSM9DS0_WHO_AM_I_G_VALUE and
+                snapshot.xm.get(self.LSM9DS0_WHO_AM_I_XM) == self.LSM9DS0_WHO_AM_I_XM_VALUE)
+
+
+# Register names by device and address, from the constants on LSM9DS0. Gyro
+# registers end in _G, the rest (_XM, _M, _A) belong to the accel/mag device.
+def register_names():
+    names = {'gyro': {}, 'xm': {}}
+    for attr in sorted(dir(LSM9DS0)):
+        value = getattr(LSM9DS0, attr)
+        if not attr.startswith('LSM9DS0_') or not isinstance(value, int) or attr.endswith('_VALUE'):
+            continue
+        name = attr[len('LSM9DS0_'):]
+        if name.endswith('_G'):
+            device = 'gyro'
+        elif name.endswith(('_XM', '_M', '_A')):
+            device = 'xm'
+        else:
+            continue
+        names[device].setdefault(value, name)
+    return names
+
+
+class RegisterImage(object):
+    # 64 register values of one device and which of them were read
+    def __init__(self, values=None, valid=0):
+        self.values = bytearray(values or bytes(64))
+        self.valid = valid
+
+    def set(self, first, data):
+        for i, value in enumerate(data):
+            self.values[first + i] = value
+            self.valid |= 1 << (first + i)
+
+    def get(self, register):
+        if not self.valid >> register & 1:
+            return None
+        return self.values[register]
+
+    def items(self):
+        return [(r, self.values[r]) for r in range(64) if self.valid >> r & 1]
+
+
+class RegisterSnapshot(object):
+    # Both devices' registers at one point in time. Saved as 156 bytes:
+    # magic, time, then per device a 64-bit valid mask and 64 values.
+    FORMAT = struct.Struct('<4sdQ64sQ64s')
+    MAGIC = b'LSM0'
+
+    def __init__(self, gyro, xm, timestamp=None):
+        self.gyro = gyro
+        self.xm = xm
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def device(self, name):
+        return self.gyro if name == 'gyro' else self.xm
+
+    def pack(self):
+        return self.FORMAT.pack(self.MAGIC, self.timestamp, self.gyro.valid, bytes(self.gyro.values),
+                                self.xm.valid, bytes(self.xm.values))
+
+    @classmethod
+    def unpack(cls, data):
+        magic, timestamp, gvalid, gvalues, xvalid, xvalues = cls.FORMAT.unpack(data)
+        if magic != cls.MAGIC:
+            raise ValueError('not an LSM9DS0 register snapshot')
+        return cls(RegisterImage(gvalues, gvalid), RegisterImage(xvalues, xvalid), timestamp)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.pack())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.unpack(f.read())
+
+    # Registers that differ, as (device, register, name, old, new). Only
+    # registers read in both snapshots are compared. Output registers
+    # (sample data) change all the time, leave them out with outputs=False.
+    def diff(self, other, outputs=False):
+        names = register_names()
+        changes = []
+        for device in ('gyro', 'xm'):
+            mine, theirs = self.device(device), other.device(device)
+            for register, value in mine.items():
+                new = theirs.get(register)
+                if new is None or new == value:
+                    continue
+                name = names[device].get(register, '0x{:02X}'.format(register))
+                if not outputs and name.startswith(('OUT_', 'STATUS_', 'FIFO_SRC')):
+                    continue
+                changes.append((device, register, name, value, new))
+        return changes
+
+    def dump(self):
+        names = register_names()
+        lines = []
+        for device in ('gyro', 'xm'):
+            for register, value in self.device(device).items():
+                lines.append('{:4s} 0x{:02X} {:24s} 0x{:02X}'.format(
+                    device, register, names[device].get(register, ''), value))
+        return '\n'.join(lines)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Event capture: keep only the samples around disturbances.
+#
+# Instead of logging everything, the last few seconds of samples are kept in
+# a ring in memory. When something happens the ring (the pre-trigger part)
+# and the samples of the next few seconds (post-trigger) are saved as one
+# event file, and a line with the event's metadata goes into events.jsonl.
+# A trigger during the post-trigger window extends the event instead of
+# starting a new one, up to max_length.
+#
+# Triggers come from
+#
+#   - the LSM9DS0's own interrupt generators (accelerometer INT_GEN_1 on the
+#     INT1_XM pin, high-pass filtered so its threshold is on change, not on
+#     gravity; gyro INT1 on the INT_G pin), programmed by arm() and wired to
+#     GPIO pins, see HardwareTrigger,
+#   - a software check of each block of samples against thresholds, which
+#     needs no wiring and no bus access, or
+#   - anyone calling trigger().
+#
+# The samples come from imu_service.py, so capturing adds no bus traffic:
+#
+#   python3 event_capture.py --arm --accel-g 0.25 --gyro-dps 30   # once, before the service
+#   python3 imu_service.py serve &
+#   python3 event_capture.py --out events --pre 2 --post 5 --int-xm-pin 20 --int-g-pin 21
+#
+# Event files are .npz with 'times', 'samples' ((n, 9) int16, columns as in
+# the ChipData logs: accel, gyro, mag) and 'meta', the same JSON as in
+# events.jsonl.
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+AXES = 9
+ACCEL = slice(0, 3)
+GYRO = slice(3, 6)
+
+
+class EventCapture(object):
+    def __init__(self, directory, rate=100.0, pre=2.0, post=5.0, max_length=60.0,
+                 accel_threshold=None, gyro_threshold=None, baseline=0.02):
+        # rate is the sample rate the ring is sized for. Thresholds are in
+        # raw counts, for the accelerometer as the distance from its slowly
+        # moving baseline (gravity), for the gyro as the rate itself. None
+        # turns the software trigger for that sensor off.
+        self.directory = directory
+        self.rate = rate
+        self.pre = pre
+        self.post = post
+        self.max_length = max_length
+        self.accel_threshold = accel_threshold
+        self.gyro_threshold = gyro_threshold
+        self.baseline_weight = baseline
+        self._baseline = None
+
+        size = max(1, int(round(pre * rate)))
+        self._times = np.zeros(size)
+        self._samples = np.zeros((size, AXES), np.int16)
+        self._count = 0
+
+        self._event = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+        self.events = 0
+        self.samples_seen = 0
+        self.samples_saved = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # ------------------------------------------------------------- triggers
+
+    def trigger(self, source, **info):
+        # Trigger at the first sample taken from now on. Safe to call from
+        # other threads, e.g. a GPIO edge callback.
+        with self._lock:
+            self._pending.append((time.time(), source, info))
+
+    def _check(self, samples):
+        # Which samples are over a software threshold, as (kind, mask)
+        # pairs, one per sensor checked
+        overs = []
+        if self.accel_threshold is not None:
+            if self._baseline is None:
+                self._baseline = samples[0, ACCEL].astype(float)
+            over = np.abs(samples[:, ACCEL] - self._baseline).max(axis=1) > self.accel_threshold
+            overs.append(('accel', over))
+            # Follow slow changes (orientation) but not the disturbance
+            quiet = samples[~over, ACCEL]
+            if len(quiet):
+                self._baseline += self.baseline_weight * (quiet.mean(axis=0) - self._baseline)
+        if self.gyro_threshold is not None:
+            over = np.abs(samples[:, GYRO].astype(np.int32)).max(axis=1) > self.gyro_threshold
+            overs.append(('gyro', over))
+        return overs
+
+    # -------------------------------------------------------------- samples
+
+    def _remember(self, t, samples):
+        # Keep the newest len(ring) samples
+        size = len(self._times)
+        n = len(t)
+        if n >= size:
+            self._times[:] = t[-size:]
+            self._samples[:] = samples[-size:]
+            self._count = size
+            return
+        start = self._count % size
+        end = start + n
+        if end <= size:
+            self._times[start:end] = t
+            self._samples[start:end] = samples
+        else:
+            split = size - start
+            self._times[start:], self._times[:end - size] = t[:split], t[split:]
+            self._samples[start:], self._samples[:end - size] = samples[:split], samples[split:]
+        self._count += n
+
+    def _history(self):
+        # Ring contents, oldest first
+        size = len(self._times)
+        if self._count < size:
+            return self._times[:self._count].copy(), self._samples[:self._count].copy()
+        start = self._count % size
+        order = np.r_[start:size, 0:start]
+        return self._times[order], self._samples[order]
+
+    def feed(self, t, samples):
+        # A block of samples, (n,) times and (n, 9) counts. Returns the
+        # paths of events finished by it.
+        t = np.asarray(t, float)
+        samples = np.asarray(samples, np.int16)
+        self.samples_seen += len(t)
+        finished = []
+        with self._lock:
+            pending, self._pending = self._pending, []
+        # Every trigger at the sample it happened at, in order. One that
+        # came after the last sample of the block waits for the next block.
+        triggers = []
+        for when, source, info in pending:
+            index = int(np.searchsorted(t, when))
+            if index < len(t):
+                triggers.append((index, when, source, info))
+            else:
+                with self._lock:
+                    self._pending.append((when, source, info))
+        overs = self._check(samples) if len(t) else []
+        hits = np.zeros(len(t), bool)
+        for kind, over in overs:
+            hits |= over
+
+        # An event can finish part way through the block; the rest of it
+        # goes round again, so a later disturbance starts its own event.
+        start = 0
+        while start < len(t):
+            part_t, part_s = t[start:], samples[start:]
+            found = [trigger for trigger in triggers if trigger[0] >= start]
+            if hits[start:].any():
+                first = start + int(np.argmax(hits[start:]))
+                kinds = [kind for kind, over in overs if over[first]]
+                found.append((first, float(t[first]), '+'.join(kinds), {'peak': samples[first].tolist()}))
+            for trigger in sorted(found, key=lambda trigger: trigger[0]):
+                index, when, source, info = trigger
+                if self._event is not None and when > self._event['until']:
+                    break
+                if trigger in triggers:
+                    triggers.remove(trigger)
+                self._start_or_extend(index - start, when, part_t, part_s, source, info)
+            if self._event is None:
+                break
+            event = self._event
+            # A part that started the event already gave its first part
+            skip = event.pop('skip', 0)
+            keep = part_t[skip:] <= event['until']
+            event['times'].append(part_t[skip:][keep])
+            event['samples'].append(part_s[skip:][keep])
+            if keep.all() and part_t[-1] < event['until']:
+                break
+            finished.append(self._finish())
+            used = skip + int(keep.sum())
+            self._remember(part_t[:used], part_s[:used])
+            start += used
+        self._remember(t[start:], samples[start:])
+        return finished
+
+    def _start_or_extend(self, index, when, t, samples, source, info):
+        if self._event is not None:
+            event = self._event
+            event['until'] = min(when + self.post, event['start'] + self.max_length)
+            event['triggers'].append({'time': when, 'source': source, **info})
+            return
+        # Pre-trigger part: the ring plus this block up to the trigger
+        times, history = self._history()
+        keep = times >= when - self.pre
+        self._event = {
+            'start': when,
+            'until': when + self.post,
+            'triggers': [{'time': when, 'source': source, **info}],
+            'times': [times[keep], t[:index]],
+            'samples': [history[keep], samples[:index]],
+            'skip': index,
+        }
+
+    def _finish(self):
+        event, self._event = self._event, None
+        times = np.concatenate(event['times'])
+        samples = np.concatenate(event['samples'])
+        self.events += 1
+        self.samples_saved += len(times)
+        peak = np.abs(samples.astype(np.int32)).max(axis=0) if len(samples) else np.zeros(AXES, int)
+        name = 'event_{}_{:04d}'.format(time.strftime('%Y%m%d-%H%M%S', time.gmtime(event['start'])),
+                                        self.events)
+        meta = {
+            'name': name,
+            'start': event['start'],
+            'first': float(times[0]) if len(times) else None,
+            'last': float(times[-1]) if len(times) else None,
+            'samples': len(times),
+            'pre': self.pre,
+            'post': self.post,
+            'triggers': event['triggers'],
+            'peak': peak.tolist(),
+        }
+        path = os.path.join(self.directory, name + '.npz')
+        np.savez_compressed(path, times=times, samples=samples, meta=json.dumps(meta))
+        with open(os.path.join(self.directory, 'events.jsonl'), 'a') as f:
+            f.write(json.dumps(meta) + '\n')
+        return path
+
+    def flush(self):
+        # Save an event still collecting post-trigger samples, e.g. at exit
+        if self._event is not None:
+            return self._finish()
+        return None
+
+
+class HardwareTrigger(object):
+    # Turns edges of the LSM9DS0 interrupt pins into triggers. The source
+    # registers aren't read here, since the bus belongs to the IMU service,
+    # so the interrupts have to be unlatched (see arm()) to give an edge for
+    # every event.
+    def __init__(self, capture, pins):
+        # pins: {BCM pin: source name}, e.g. {20: 'int1_xm', 21: 'int_g'}
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.capture = capture
+        self.pins = pins
+        GPIO.setmode(GPIO.BCM)
+        for pin, source in pins.items():
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            GPIO.add_event_detect(pin, GPIO.RISING, callback=self._edge)
+
+    def _edge(self, pin):
+        self.capture.trigger(self.pins[pin], pin=pin)
+
+    def close(self):
+        for pin in self.pins:
+            self.GPIO.remove_event_detect(pin)
+
+
+def arm(imu, accel_g=None, gyro_dps=None, duration=0.0):
+    # Program the interrupt generators. Returns the thresholds as set,
+    # after rounding to what the registers can hold. Unlatched, since
+    # nothing reads the source registers to clear a latch.
+    armed = {}
+    if accel_g is not None:
+        armed['accel_g'], armed['accel_duration'] = imu.enableAccelInterrupt(accel_g, duration, latch=False)
+    if gyro_dps is not None:
+        armed['gyro_dps'], armed['gyro_duration'] = imu.enableGyroInterrupt(gyro_dps, duration, latch=False)
+    return armed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save the samples around disturbances')
+    parser.add_argument('--out', default='events')
+    parser.add_argument('--pre', type=float, default=2.0, help='seconds kept before a trigger')
+    parser.add_argument('--post', type=float, default=5.0, help='seconds kept after a trigger')
+    parser.add_argument('--accel', type=float, help='software trigger, counts off the baseline')
+    parser.add_argument('--gyro', type=float, help='software trigger, counts')
+    parser.add_argument('--arm', action='store_true', help='program the interrupt generators and exit')
+    parser.add_argument('--accel-g', type=float, help='hardware threshold for --arm, change in g (high-passed)')
+    parser.add_argument('--gyro-dps', type=float, help='hardware threshold for --arm')
+    parser.add_argument('--duration', type=float, default=0.0, help='seconds over threshold, for --arm')
+    parser.add_argument('--int-xm-pin', type=int, help='BCM pin wired to INT1_XM')
+    parser.add_argument('--int-g-pin', type=int, help='BCM pin wired to INT_G')
+    parser.add_argument('--name', default='catman_imu', help='IMU service to read from')
+    args = parser.parse_args()
+
+    if args.arm:
+        import CATMAN_LSM9DS0
+        print(arm(CATMAN_LSM9DS0.LSM9DS0(), args.accel_g, args.gyro_dps, args.duration))
+    else:
+        from imu_service import IMUClient
+        client = IMUClient(args.name)
+        capture = EventCapture(args.out, client.rate or 100.0, args.pre, args.post,
+                               accel_threshold=args.accel, gyro_threshold=args.gyro)
+        pins = {}
+        if args.int_xm_pin is not None:
+            pins[args.int_xm_pin] = 'int1_xm'
+        if args.int_g_pin is not None:
+            pins[args.int_g_pin] = 'int_g'
+        hardware = HardwareTrigger(capture, pins) if pins else None
+        try:
+            while True:
+                client.wait()
+                for path in capture.feed(*client.read_copy()):
+                    print(path)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            capture.flush()
+            if hardware is not None:
+                hardware.close()
+            client.close()
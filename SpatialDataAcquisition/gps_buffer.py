@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+# Time indexed buffer of GPS fixes, used to georeference IMU samples.
+#
+# The GPS only gives us a fix about once a second while the IMU can run at
+# 1600Hz, so rather than searching for the nearest fix one sample at a time we
+# keep the last few hundred fixes in numpy arrays and interpolate a whole block
+# of IMU timestamps in one call.
+#
+#   fixes = GPSFixBuffer()
+#   fixes.add_report(report)                    # gpsd TPV report
+#   pos, vel, flags = fixes.interpolate(imu_t)  # imu_t is an array of times
+
+from bisect import bisect_right
+from calendar import timegm
+from math import cos, radians, sin
+from time import strptime
+
+import numpy as np
+
+EARTH_RADIUS = 6371000.0  # metres
+
+# Smallest cos(latitude) used when dead reckoning east velocity into
+# longitude, so that it stays finite at the poles (about 89.9 degrees)
+MIN_COS_LAT = 1e-3
+
+# Confidence flags returned for every interpolated timestamp
+FIX_INTERPOLATED = 0  # between two fixes
+FIX_EXTRAPOLATED = 1  # after the newest fix, dead reckoned from its velocity
+FIX_STALE = 2         # too far from any fix to be trusted
+FIX_NONE = 3          # before the first fix or no fixes at all, values are NaN
+
+
+class GPSFixBuffer(object):
+    # Fixes are kept in a ring, but every value is written twice, at i and at
+    # i + capacity. That way the fixes in time order are always one contiguous
+    # slice of the arrays and lookups never have to copy or unwrap the ring.
+    def __init__(self, capacity=256, stale_after=2.0):
+        if capacity < 2:
+            raise ValueError("capacity must be at least 2")
+        self.capacity = capacity
+        # Seconds away from a fix after which results are flagged as stale
+        self.stale_after = stale_after
+
+        self._t = np.zeros(2 * capacity)
+        self._pos = np.zeros((2 * capacity, 3))  # lat, lon (degrees), alt (m)
+        self._vel = np.zeros((2 * capacity, 3))  # north, east, up (m/s)
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+
+    # Time ordered views of the buffered fixes
+    @property
+    def times(self):
+        return self._t[self._start:self._start + self._count]
+
+    @property
+    def positions(self):
+        return self._pos[self._start:self._start + self._count]
+
+    @property
+    def velocities(self):
+        return self._vel[self._start:self._start + self._count]
+
+    def add(self, t, lat, lon, alt=0.0, vn=0.0, ve=0.0, vu=0.0):
+        # Fixes must arrive in time order. gpsd happily repeats the last fix,
+        # so anything not newer than the newest fix is dropped and False is
+        # returned.
+        if self._count and t <= self._t[self._start + self._count - 1]:
+            return False
+
+        if self._count == self.capacity:
+            # Overwrite the oldest fix
+            i = self._start
+            self._start = (self._start + 1) % self.capacity
+        else:
+            i = (self._start + self._count) % self.capacity
+            self._count += 1
+
+        for j in (i, i + self.capacity):
+            self._t[j] = t
+            self._pos[j] = (lat, lon, alt)
+            self._vel[j] = (vn, ve, vu)
+        return True
+
+    def add_report(self, report, t=None):
+        # Add a gpsd TPV report. Speed and track are turned into north/east
+        # velocity and climb into vertical velocity. Unless t is given the
+        # report's own UTC time is used.
+        if report.get('class') != 'TPV' or 'lat' not in report or 'lon' not in report:
+            return False
+        if t is None:
+            if 'time' not in report:
+                return False
+            t = parse_gps_time(report['time'])
+
+        speed = report.get('speed', 0.0) or 0.0
+        track = radians(report.get('track', 0.0) or 0.0)
+        return self.add(t, report['lat'], report['lon'], report.get('alt', 0.0) or 0.0,
+                        speed * cos(track), speed * sin(track), report.get('climb', 0.0) or 0.0)
+
+    def latest(self):
+        # (t, position, velocity) of the newest fix, or None
+        if not self._count:
+            return None
+        i = self._start + self._count - 1
+        return self._t[i], self._pos[i].copy(), self._vel[i].copy()
+
+    def nearest(self, t):
+        # Index into times/positions/velocities of the fix closest to t
+        if not self._count:
+            return None
+        times = self.times
+        i = bisect_right(times, t)
+        if i == 0:
+            return 0
+        if i == self._count:
+            return self._count - 1
+        return i if times[i] - t < t - times[i - 1] else i - 1
+
+    def interpolate(self, ts):
+        # Interpolate position and velocity onto an array of timestamps.
+        # Returns (positions (n, 3), velocities (n, 3), flags (n,)).
+        ts = np.asarray(ts, dtype=float)
+        scalar = ts.ndim == 0
+        ts = np.atleast_1d(ts)
+        n = len(ts)
+
+        pos = np.full((n, 3), np.nan)
+        vel = np.full((n, 3), np.nan)
+        flags = np.full(n, FIX_NONE, dtype=np.uint8)
+        if not self._count:
+            return (pos[0], vel[0], flags[0]) if scalar else (pos, vel, flags)
+
+        times, fpos, fvel = self.times, self.positions, self.velocities
+        idx = np.searchsorted(times, ts, side='right')
+
+        # Between two fixes, linear interpolation of both position and velocity
+        inside = (idx > 0) & (idx < self._count)
+        if inside.any():
+            hi = idx[inside]
+            lo = hi - 1
+            t0, t1 = times[lo], times[hi]
+            w = ((ts[inside] - t0) / (t1 - t0))[:, None]
+            # Longitude the short way round, so crossing the antimeridian
+            # (179.9 -> -179.9) doesn't sweep through 0
+            delta = fpos[hi] - fpos[lo]
+            delta[:, 1] = wrap_longitude(delta[:, 1])
+            p = fpos[lo] + w * delta
+            p[:, 1] = wrap_longitude(p[:, 1])
+            pos[inside] = p
+            vel[inside] = fvel[lo] + w * (fvel[hi] - fvel[lo])
+            gap = np.minimum(ts[inside] - t0, t1 - ts[inside])
+            flags[inside] = np.where((t1 - t0 > 2 * self.stale_after) & (gap > self.stale_after),
+                                     FIX_STALE, FIX_INTERPOLATED)
+
+        # At or after the newest fix, dead reckon from its velocity
+        after = idx == self._count
+        if after.any():
+            t0 = times[-1]
+            dt = ts[after] - t0
+            lat0, lon0, alt0 = fpos[-1]
+            vn, ve, vu = fvel[-1]
+            p = np.empty((len(dt), 3))
+            p[:, 0] = np.clip(lat0 + np.degrees(vn * dt / EARTH_RADIUS), -90.0, 90.0)
+            coslat = max(cos(radians(lat0)), MIN_COS_LAT)
+            p[:, 1] = wrap_longitude(lon0 + np.degrees(ve * dt / (EARTH_RADIUS * coslat)))
+            p[:, 2] = alt0 + vu * dt
+            pos[after] = p
+            vel[after] = fvel[-1]
+            flags[after] = np.where(dt == 0, FIX_INTERPOLATED,
+                                    np.where(dt > self.stale_after, FIX_STALE, FIX_EXTRAPOLATED))
+
+        # Before the first fix we know nothing, unless it is within the stale
+        # window in which case the first fix is held
+        before = (idx == 0) & (times[0] - ts <= self.stale_after)
+        if before.any():
+            pos[before] = fpos[0]
+            vel[before] = fvel[0]
+            flags[before] = FIX_EXTRAPOLATED
+
+        if scalar:
+            return pos[0], vel[0], flags[0]
+        return pos, vel, flags
+
+
+def wrap_longitude(lon):
+    # Longitude in degrees folded into [-180, 180)
+    return (np.asarray(lon) + 180.0) % 360.0 - 180.0
+
+
+def parse_gps_time(value):
+    # gpsd reports time as an ISO 8601 UTC string, e.g. 2017-04-01T12:00:00.000Z
+    if not isinstance(value, str):
+        return float(value)
+    value = value.rstrip('Z')
+    frac = 0.0
+    if '.' in value:
+        value, digits = value.split('.', 1)
+        frac = float('0.' + digits)
+    return timegm(strptime(value, '%Y-%m-%dT%H:%M:%S')) + frac
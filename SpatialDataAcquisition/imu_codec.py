@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Lossless compression of raw LSM9DS0 sample blocks.
+#
+# A block is an (n, 9) array of int16 counts, columns as in the ChipData logs:
+# accel x/y/z, gyro x/y/z, mag x/y/z. Between two readings each axis only
+# moves by a few counts, so we send per axis deltas instead of the values.
+# The deltas are zigzag mapped to unsigned numbers (0, -1, 1, -2, ... become
+# 0, 1, 2, 3, ...) and then either
+#
+#   - written as varints, 7 bits per byte, or
+#   - bit packed, each axis with just enough bits for its largest delta,
+#
+# and optionally squeezed once more with raw deflate. Everything is done on
+# whole numpy arrays, there are no per sample loops.
+#
+# Block layout:
+#
+#   magic      B   0xC9
+#   flags      B   FLAG_* bits below
+#   sequence   B   block counter, so the decoder notices a missing block
+#   rows       H   number of samples in the block
+#   first row  9h  only in keyframes, raw values of the first sample
+#   widths     9B  only when bit packed, bits per axis
+#   data           deltas, axis by axis
+#
+# A keyframe carries its own first sample. Other blocks continue from the last
+# sample of the previous block, which saves 18 bytes but means they can only
+# be decoded in order.
+#
+#   encoder = IMUEncoder()
+#   decoder = IMUDecoder()
+#   block = decoder.decode(encoder.encode(samples))
+
+import struct
+import zlib
+
+import numpy as np
+
+AXES = 9
+MAGIC = 0xC9
+
+FLAG_BITPACK = 0x01
+FLAG_DEFLATE = 0x02
+FLAG_KEYFRAME = 0x04
+
+HEADER = struct.Struct('<BBBH')
+FIRST_ROW = struct.Struct('<9h')
+
+# Raw deflate (no zlib header or checksum, the radio frames have their own)
+# with Huffman coding only. The zigzag deltas are mostly small and repeat
+# rarely, so string matching costs time and buys almost nothing.
+DEFLATE_WBITS = -15
+DEFLATE_STRATEGY = zlib.Z_HUFFMAN_ONLY
+
+
+class IMUCodecError(Exception):
+    pass
+
+
+def zigzag(values):
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint32)
+
+
+def unzigzag(values):
+    values = values.astype(np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+
+def varint_encode(values):
+    # values: 1-D array of unsigned ints below 2**35
+    values = values.astype(np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 5):
+        nbytes += values >= (1 << (7 * k))
+    ends = np.cumsum(nbytes)
+    starts = ends - nbytes
+    out = np.empty(int(ends[-1]) if len(values) else 0, dtype=np.uint8)
+    for k in range(5):
+        have = nbytes > k
+        if not have.any():
+            break
+        byte = (values[have] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        byte |= np.where(nbytes[have] > k + 1, 0x80, 0).astype(np.uint64)
+        out[starts[have] + k] = byte
+    return out.tobytes()
+
+
+def varint_decode(data, count):
+    data = np.frombuffer(data, dtype=np.uint8)
+    last = np.flatnonzero((data & 0x80) == 0)
+    if len(last) < count:
+        raise IMUCodecError('varint data ends early')
+    last = last[:count]
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64), 0
+    used = int(last[-1]) + 1
+    data = data[:used]
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = last[:-1] + 1
+    # Position of every byte inside its varint
+    index = np.repeat(np.arange(count), np.diff(np.append(starts, used)))
+    k = np.arange(used) - starts[index]
+    shifted = (data & 0x7F).astype(np.uint64) << (7 * k).astype(np.uint64)
+    return np.bitwise_or.reduceat(shifted, starts), used
+
+
+def bitpack(values, width):
+    # Pack unsigned values using width bits each, least significant bit first
+    if width == 0 or len(values) == 0:
+        return b''
+    bits = (values.astype(np.uint32)[:, None] >> np.arange(width, dtype=np.uint32)) & 1
+    return np.packbits(bits.astype(np.uint8).ravel(), bitorder='little').tobytes()
+
+
+def bitunpack(data, count, width):
+    if width == 0:
+        return np.zeros(count, dtype=np.uint32), 0
+    used = (count * width + 7) // 8
+    raw = np.frombuffer(data, dtype=np.uint8, count=used)
+    bits = np.unpackbits(raw, count=count * width, bitorder='little').reshape(count, width)
+    return (bits.astype(np.uint32) << np.arange(width, dtype=np.uint32)).sum(axis=1, dtype=np.uint32), used
+
+
+class IMUEncoder(object):
+    def __init__(self, bitpack=True, deflate=False, keyframe_interval=1):
+        self.bitpack = bitpack
+        # deflate is only kept when it actually makes the block smaller
+        self.deflate = deflate
+        # Every Nth block is a keyframe, 1 makes every block decodable alone
+        self.keyframe_interval = keyframe_interval
+        self.sequence = 0
+        self._last = None
+
+    def encode(self, block):
+        block = np.asarray(block)
+        if block.ndim != 2 or block.shape[1] != AXES:
+            raise ValueError('expected an (n, 9) block, got {}'.format(block.shape))
+        if len(block) > 0xFFFF:
+            raise ValueError('at most 65535 rows per block')
+        block = block.astype(np.int16)
+
+        keyframe = self._last is None or self.sequence % self.keyframe_interval == 0
+        flags = FLAG_KEYFRAME if keyframe else 0
+        head = b''
+        if not len(block):
+            deltas = np.zeros((0, AXES), dtype=np.int32)
+        elif keyframe:
+            head = FIRST_ROW.pack(*block[0].tolist())
+            deltas = np.diff(block.astype(np.int32), axis=0)
+        else:
+            deltas = np.diff(np.vstack((self._last, block)).astype(np.int32), axis=0)
+
+        # Axis by axis, which keeps similar numbers together for deflate
+        zz = zigzag(deltas.T)
+        if self.bitpack:
+            flags |= FLAG_BITPACK
+            widths = [int(col.max()).bit_length() if len(col) else 0 for col in zz]
+            body = bytes(widths) + b''.join(bitpack(col, w) for col, w in zip(zz, widths))
+        else:
+            body = varint_encode(zz.ravel())
+
+        if self.deflate:
+            packer = zlib.compressobj(9, zlib.DEFLATED, DEFLATE_WBITS, 9, DEFLATE_STRATEGY)
+            squeezed = packer.compress(body) + packer.flush()
+            if len(squeezed) < len(body):
+                flags |= FLAG_DEFLATE
+                body = squeezed
+
+        if len(block):
+            self._last = block[-1:].copy()
+        header = HEADER.pack(MAGIC, flags, self.sequence, len(block))
+        self.sequence = (self.sequence + 1) & 0xFF
+        return header + head + body
+
+
+class IMUDecoder(object):
+    def __init__(self):
+        self._last = None
+        self._sequence = None
+
+    def decode(self, data):
+        data = bytes(data)
+        if len(data) < HEADER.size:
+            raise IMUCodecError('block too short')
+        magic, flags, sequence, rows = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise IMUCodecError('not an IMU block')
+        pos = HEADER.size
+
+        keyframe = flags & FLAG_KEYFRAME
+        if not keyframe:
+            if self._last is None:
+                raise IMUCodecError('block {} needs the block before it'.format(sequence))
+            if sequence != (self._sequence + 1) & 0xFF:
+                raise IMUCodecError('block {} follows block {}, wait for a keyframe'.format(
+                    sequence, self._sequence))
+        if keyframe and rows:
+            first = np.array(FIRST_ROW.unpack_from(data, pos), dtype=np.int32)
+            pos += FIRST_ROW.size
+            count = rows - 1
+        else:
+            first = self._last
+            count = rows
+
+        body = data[pos:]
+        if flags & FLAG_DEFLATE:
+            body = zlib.decompress(body, DEFLATE_WBITS)
+
+        if flags & FLAG_BITPACK:
+            widths = body[:AXES]
+            pos = AXES
+            zz = np.empty((AXES, count), dtype=np.uint32)
+            for axis, width in enumerate(widths):
+                zz[axis], used = bitunpack(body[pos:], count, width)
+                pos += used
+        else:
+            values, used = varint_decode(body, AXES * count)
+            zz = values.reshape(AXES, count)
+
+        deltas = unzigzag(zz).T
+        if rows:
+            if keyframe:
+                block = np.vstack((first, first + np.cumsum(deltas, axis=0)))
+            else:
+                block = first + np.cumsum(deltas, axis=0)
+            block = block.astype(np.int16)
+            self._last = block[-1].astype(np.int32)
+        else:
+            block = np.zeros((0, AXES), dtype=np.int16)
+        self._sequence = sequence
+        return block
+
+
+def load_chipdata(path):
+    # The ChipData logs are tab separated: time, then the nine raw values
+    data = np.loadtxt(path, skiprows=1)
+    return data[:, 0], data[:, 1:10].astype(np.int16)
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import time
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = sys.argv[1:] or [os.path.join(here, 'Quinn_DataAcquisition', name)
+                             for name in ('ChipData1000.txt', 'ChipData1000_MoreSen.txt')]
+    block_rows = 100
+
+    for path in paths:
+        t, samples = load_chipdata(path)
+        text_size = os.path.getsize(path)
+        raw_size = samples.nbytes
+        print('{}: {} samples, {} bytes as text, {} bytes as int16'.format(
+            os.path.basename(path), len(samples), text_size, raw_size))
+        for name, options in (('varint', dict(bitpack=False)),
+                              ('bitpack', dict(bitpack=True)),
+                              ('varint+deflate', dict(bitpack=False, deflate=True)),
+                              ('bitpack+deflate', dict(bitpack=True, deflate=True))):
+            encoder = IMUEncoder(keyframe_interval=1, **options)
+            decoder = IMUDecoder()
+            started = time.time()
+            blocks = [encoder.encode(samples[i:i + block_rows])
+                      for i in range(0, len(samples), block_rows)]
+            encode_time = time.time() - started
+            started = time.time()
+            decoded = np.vstack([decoder.decode(b) for b in blocks])
+            decode_time = time.time() - started
+            assert (decoded == samples).all(), 'round trip failed'
+            size = sum(len(b) for b in blocks)
+            print('  {:16s} {:6d} bytes  {:4.1f}x int16  {:5.1f}x text  '
+                  'encode {:5.2f} ms  decode {:5.2f} ms'.format(
+                      name, size, raw_size / float(size), text_size / float(size),
+                      encode_time * 1000, decode_time * 1000))
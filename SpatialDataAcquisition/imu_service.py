@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+# One process owns the LSM9DS0 and shares its samples through shared memory.
+#
+# Every acquisition script builds its own LSM9DS0(), which rewrites the
+# control registers and fights over the I2C bus when two of them run at once.
+# The service is the only one talking to the sensor. It writes each sample
+# into a ring buffer in shared memory and then bumps a sequence counter; that
+# counter is the only thing readers look at, there are no locks. Any number
+# of readers (logger, fusion, telemetry, live display) attach by name, start
+# at once from the current position and get numpy views straight into the
+# ring. A reader that falls more than a ring behind finds out from the
+# counter how many samples it missed.
+#
+# Columns are as in the ChipData logs: accel x/y/z, gyro x/y/z, mag x/y/z.
+#
+#   python3 imu_service.py serve --rate 100
+#
+#   client = IMUClient()
+#   t, samples = client.read()      # everything new since the last read
+#   ...use them...
+#   if not client.valid():          # overwritten while we were using them
+#   client.overruns                 # samples we never saw
+#
+# Layout of the shared memory, little endian:
+#
+#   header   8 x uint64   magic, capacity, sequence, rate in mHz, writer pid,
+#                         last write in ns (CLOCK_REALTIME), 2 spare
+#   times    capacity x float64
+#   samples  capacity x 9 x int16
+#
+# Sample k (counting from 0) lives in slot k % capacity, and sequence is the
+# number of samples written so far. The writer fills a slot before bumping
+# the sequence, a reader copying samples [a, b) knows they were all intact if
+# the sequence is still below a + capacity afterwards.
+
+import argparse
+import os
+import signal
+import struct
+import sys
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+AXES = 9
+DEFAULT_NAME = 'catman_imu'
+DEFAULT_CAPACITY = 4096
+
+MAGIC = 0x494D5552494E4731   # 'IMURING1'
+HEADER_WORDS = 8
+H_MAGIC, H_CAPACITY, H_SEQUENCE, H_RATE, H_PID, H_STAMP = range(6)
+
+
+class RingError(Exception):
+    pass
+
+
+def _layout(capacity):
+    header = HEADER_WORDS * 8
+    times = capacity * 8
+    samples = capacity * AXES * 2
+    return header, times, samples
+
+
+def _views(buf, capacity):
+    header, times, samples = _layout(capacity)
+    return (np.ndarray((HEADER_WORDS,), np.uint64, buf, 0),
+            np.ndarray((capacity,), np.float64, buf, header),
+            np.ndarray((capacity, AXES), np.int16, buf, header + times))
+
+
+def _attach(name):
+    # Attach without registering with the resource tracker, which would
+    # otherwise remove the ring when a reader exits (Python < 3.13)
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except (ImportError, AttributeError):
+            pass
+        return shm
+
+
+class SampleRing(object):
+    # The writer's side
+    def __init__(self, name=DEFAULT_NAME, capacity=DEFAULT_CAPACITY, rate=0.0):
+        size = sum(_layout(capacity))
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a service that died, or one that is running
+            old = _attach(name)
+            pid = int(np.ndarray((HEADER_WORDS,), np.uint64, old.buf)[H_PID]) if old.size >= 64 else 0
+            old.close()
+            if pid and _alive(pid):
+                raise RingError('{} is already served by pid {}'.format(name, pid))
+            stale = _attach(name)
+            stale.unlink()
+            stale.close()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = name
+        self.capacity = capacity
+        self.header, self.times, self.samples = _views(self.shm.buf, capacity)
+        self.header[:] = 0
+        self.header[H_CAPACITY] = capacity
+        self.header[H_RATE] = int(rate * 1000)
+        self.header[H_PID] = os.getpid()
+        # Magic last, readers wait for it
+        self.header[H_MAGIC] = MAGIC
+        self.sequence = 0
+
+    def write(self, t, sample):
+        slot = self.sequence % self.capacity
+        self.times[slot] = t
+        self.samples[slot] = sample
+        self.sequence += 1
+        self.header[H_STAMP] = time.time_ns()
+        self.header[H_SEQUENCE] = self.sequence
+
+    def write_block(self, t, samples):
+        # Several samples at once, e.g. from the FIFO
+        n = len(t)
+        slots = (self.sequence + np.arange(n)) % self.capacity
+        self.times[slots] = t
+        self.samples[slots] = samples
+        self.sequence += n
+        self.header[H_STAMP] = time.time_ns()
+        self.header[H_SEQUENCE] = self.sequence
+
+    def close(self):
+        self.header[H_PID] = 0
+        del self.header, self.times, self.samples
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class IMUClient(object):
+    # A reader. Attaching costs nothing on the bus and returns at once.
+    def __init__(self, name=DEFAULT_NAME, backlog=0, timeout=5.0):
+        # backlog: how many samples from before we attached to start with
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.shm = _attach(name)
+                header = np.ndarray((HEADER_WORDS,), np.uint64, self.shm.buf)
+                if header[H_MAGIC] == MAGIC:
+                    break
+                del header
+                self.shm.close()
+            except FileNotFoundError:
+                pass
+            if time.monotonic() > deadline:
+                raise RingError('no IMU service running as {}'.format(name))
+            time.sleep(0.05)
+        self.capacity = int(header[H_CAPACITY])
+        del header
+        self.header, self.times, self.samples = _views(self.shm.buf, self.capacity)
+        self.rate = int(self.header[H_RATE]) / 1000.0
+        head = self.sequence()
+        self.position = max(0, head - min(backlog, self.capacity - 1))
+        self._last = (self.position, self.position)
+        self.overruns = 0
+
+    def sequence(self):
+        return int(self.header[H_SEQUENCE])
+
+    def age(self):
+        # Seconds since the service last wrote a sample
+        return max(0.0, time.time() - int(self.header[H_STAMP]) / 1e9)
+
+    def alive(self):
+        pid = int(self.header[H_PID])
+        return bool(pid) and _alive(pid)
+
+    def available(self):
+        return self.sequence() - self.position
+
+    def read(self, max_samples=None):
+        # New samples since the last read as (times, samples), views into
+        # the ring. They stop at the end of the ring, the next read carries
+        # on from the start. Call valid() once done with them.
+        head = self.sequence()
+        if head - self.position >= self.capacity:
+            # Lapped, everything before head - capacity is gone. Leave a
+            # little room so the writer isn't about to overwrite our start.
+            skip = head - self.capacity + max(1, self.capacity // 16) - self.position
+            self.overruns += skip
+            self.position += skip
+        slot = self.position % self.capacity
+        n = min(head - self.position, self.capacity - slot)
+        if max_samples is not None:
+            n = min(n, max_samples)
+        self._last = (self.position, self.position + n)
+        self.position += n
+        return self.times[slot:slot + n], self.samples[slot:slot + n]
+
+    def valid(self):
+        # True if the samples of the last read were not overwritten while in
+        # use. If not, copy next time (read_copy) or read more often.
+        return self.sequence() < self._last[0] + self.capacity
+
+    def read_copy(self, max_samples=None):
+        # Like read() but returns copies, checked to be intact
+        t, samples = self.read(max_samples)
+        t, samples = t.copy(), samples.copy()
+        if not self.valid():
+            # Some of the start was overwritten during the copy, drop it
+            lost = self.sequence() - self.capacity - self._last[0] + 1
+            lost = min(len(t), max(0, lost))
+            self.overruns += lost
+            t, samples = t[lost:], samples[lost:]
+        return t, samples
+
+    def latest(self, n):
+        # Copies of the newest n samples, without moving our position
+        head = self.sequence()
+        n = min(n, head, self.capacity - 1)
+        slots = np.arange(head - n, head) % self.capacity
+        t, samples = self.times[slots], self.samples[slots]
+        if self.sequence() >= head - n + self.capacity:
+            raise RingError('overwritten while reading, the reader is too slow')
+        return t, samples
+
+    def wait(self, timeout=None, poll=0.002):
+        # Block until there is something new. Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sequence() == self.position:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def close(self):
+        del self.header, self.times, self.samples
+        self.shm.close()
+
+
+# ------------------------------------------------------------------ service
+
+# Output registers of each device, read with auto-increment (top bit set)
+_OUT = struct.Struct('<3h')
+
+
+def read_sample(imu):
+    # One sample in three block reads instead of eighteen single bytes, also
+    # so that low and high bytes of an axis come from the same conversion
+    out = []
+    for device, register in ((imu.accel, imu.LSM9DS0_OUT_X_L_A), (imu.gyro, imu.LSM9DS0_OUT_X_L_G),
+                             (imu.mag, imu.LSM9DS0_OUT_X_L_M)):
+        out.extend(_OUT.unpack(bytes(device.readList(register | 0x80, 6))))
+    return out
+
+
+class IMUService(object):
+    def __init__(self, imu, rate=100.0, name=DEFAULT_NAME, capacity=DEFAULT_CAPACITY, clock=time.time,
+                 read=read_sample):
+        self.imu = imu
+        # read(imu) returns one sample of nine values
+        self.read = read
+        self.rate = rate
+        self.clock = clock
+        self.ring = SampleRing(name, capacity, rate)
+        self.errors = 0
+        self.late = 0
+
+    def run(self, count=None):
+        period = 1.0 / self.rate
+        next_tick = time.monotonic()
+        n = 0
+        try:
+            while count is None or n < count:
+                try:
+                    sample = self.read(self.imu)
+                except IOError:
+                    self.errors += 1
+                else:
+                    self.ring.write(self.clock(), sample)
+                    n += 1
+                next_tick += period
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind, don't try to catch up with a burst
+                    self.late += 1
+                    next_tick = time.monotonic()
+        finally:
+            self.ring.close()
+
+
+class ReplayIMU(object):
+    # Stands in for the sensor, playing a ChipData log in a loop
+    def __init__(self, path):
+        from imu_codec import load_chipdata
+        self.t, self.samples = load_chipdata(path)
+        self.i = 0
+
+    def next(self):
+        sample = self.samples[self.i % len(self.samples)]
+        self.i += 1
+        return sample
+
+    @staticmethod
+    def read(imu):
+        return imu.next()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Share the LSM9DS0 between processes')
+    sub = parser.add_subparsers(dest='command')
+    # Both ends have to agree on the ring's name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--name', default=DEFAULT_NAME, help='shared memory name of the ring')
+    serve = sub.add_parser('serve', parents=[common])
+    serve.add_argument('--rate', type=float, default=100.0, help='samples per second')
+    serve.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY)
+    serve.add_argument('--replay', help='play a ChipData log instead of reading the sensor')
+    tail = sub.add_parser('tail', parents=[common])
+    # No command at all tails the default ring
+    parser.set_defaults(name=DEFAULT_NAME)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        # Run as a service, stop cleanly on SIGTERM so the ring is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if args.replay:
+            source = ReplayIMU(args.replay)
+            service = IMUService(source, args.rate, args.name, args.capacity, read=source.read)
+        else:
+            import CATMAN_LSM9DS0
+            service = IMUService(CATMAN_LSM9DS0.LSM9DS0(), args.rate, args.name, args.capacity)
+        try:
+            service.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        client = IMUClient(args.name)
+        print('Time, Acc, GYR, Mag')
+        try:
+            while True:
+                client.wait()
+                t, samples = client.read_copy()
+                for ti, row in zip(t, samples):
+                    print('{:.6f}\t{}'.format(ti, '\t'.join(str(v) for v in row)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# Streaming vibration spectra of the IMU samples.
+#
+# Blocks of (n, 9) raw samples come in and a running Welch estimate of the
+# power spectral density of every axis is kept: the stream is cut into
+# overlapping segments, each segment has its mean removed, is multiplied by
+# a Hann window and goes through an rFFT, and the squared magnitudes are
+# summed. Memory is one segment of leftover samples plus the sums, whatever
+# the length of the stream. All segments of a block are transformed in one
+# numpy call, which keeps up with the full 1600 Hz accelerometer rate on a
+# Pi.
+#
+# Every `cadence` seconds the sums turn into band powers (the PSD integrated
+# over a few frequency bands) per axis, and start over. Band powers are sent
+# instead of samples: six bands times nine axes, packed as half dB steps,
+# fit in one DigiMesh payload.
+#
+#   psd = WelchPSD(rate=100)
+#   for summary in psd.feed(samples, t):
+#       xbee.send_nowait(addr, summary.pack())
+#
+# Packed summary, little endian:
+#
+#   start time  d   time of the first sample in the summary
+#   segments    H   number of segments averaged
+#   bands       B   number of bands
+#   axes        B   number of axes
+#   bands x axes B  band power in dB above FLOOR_DB, STEP_DB per count, axis
+#                   by axis within each band
+
+import struct
+
+import numpy as np
+
+AXES = 9
+AXIS_NAMES = ('acc_x', 'acc_y', 'acc_z', 'gyr_x', 'gyr_y', 'gyr_z', 'mag_x', 'mag_y', 'mag_z')
+
+SUMMARY = struct.Struct('<dHBB')
+FLOOR_DB = -40.0
+STEP_DB = 0.5
+
+
+def default_bands(rate, count=6, lowest=0.5):
+    # Log spaced band edges from lowest up to Nyquist
+    return np.geomspace(lowest, rate / 2.0, count + 1)
+
+
+class BandSummary(object):
+    def __init__(self, start, end, segments, edges, power):
+        self.start = start
+        self.end = end
+        self.segments = segments
+        # Band edges in Hz, and (bands, axes) power in counts squared
+        self.edges = edges
+        self.power = power
+
+    def rms(self):
+        # Root of the band power, in counts, per band and axis
+        return np.sqrt(self.power)
+
+    def pack(self, floor=FLOOR_DB, step=STEP_DB):
+        with np.errstate(divide='ignore'):
+            db = 10.0 * np.log10(self.power)
+        levels = np.clip(np.round((db - floor) / step), 0, 255).astype(np.uint8)
+        bands, axes = self.power.shape
+        return SUMMARY.pack(self.start, min(self.segments, 0xFFFF), bands, axes) + levels.tobytes()
+
+    @classmethod
+    def unpack(cls, payload, edges=None, floor=FLOOR_DB, step=STEP_DB):
+        # Band edges aren't sent, both ends have to agree on them
+        start, segments, bands, axes = SUMMARY.unpack_from(payload, 0)
+        levels = np.frombuffer(payload, np.uint8, bands * axes, SUMMARY.size).reshape(bands, axes)
+        power = 10.0 ** ((levels * step + floor) / 10.0)
+        return cls(start, None, segments, edges, power)
+
+
+class WelchPSD(object):
+    def __init__(self, rate, nperseg=256, overlap=0.5, cadence=10.0, edges=None, axes=AXES):
+        self.rate = float(rate)
+        self.nperseg = nperseg
+        self.hop = max(1, int(round(nperseg * (1.0 - overlap))))
+        # Samples per summary
+        self.cadence = max(nperseg, int(round(cadence * rate)))
+        self.axes = axes
+
+        self.window = np.hanning(nperseg + 1)[:-1]  # periodic Hann
+        # Density scaling as in scipy.signal.welch: one sided, so double
+        # everything but DC and Nyquist
+        self.scale = np.full(nperseg // 2 + 1, 2.0 / (self.rate * (self.window ** 2).sum()))
+        self.scale[0] /= 2.0
+        if nperseg % 2 == 0:
+            self.scale[-1] /= 2.0
+        self.freqs = np.fft.rfftfreq(nperseg, 1.0 / self.rate)
+
+        edges = default_bands(self.rate) if edges is None else np.asarray(edges, float)
+        self.edges = edges
+        # Which frequency bins go into which band
+        self._band_of = np.digitize(self.freqs, edges) - 1
+        self._bands = len(edges) - 1
+
+        self._tail = np.zeros((0, axes))
+        self._tail_start = None
+        self._sum = np.zeros((len(self.freqs), axes))
+        self._segments = 0
+        self._consumed = 0          # samples since the summary started
+        self._summary_start = None
+
+        self.samples = 0
+        self.summaries = 0
+
+    def feed(self, samples, t=None):
+        # Add a block of (n, axes) samples, t its (n,) times if known.
+        # Returns the summaries finished by this block.
+        samples = np.asarray(samples, float).reshape(-1, self.axes)
+        n = len(samples)
+        if t is None:
+            t = (self.samples + np.arange(n)) / self.rate
+        t = np.asarray(t, float)
+        self.samples += n
+        out = []
+        start = 0
+        while start < n:
+            # Never let a segment straddle two summaries
+            room = self.cadence - self._consumed
+            take = min(n - start, room)
+            self._add(samples[start:start + take], t[start:start + take])
+            start += take
+            if self._consumed >= self.cadence:
+                out.append(self._summarise(t[start - 1]))
+        return out
+
+    def _add(self, samples, t):
+        if not len(samples):
+            return
+        if self._summary_start is None:
+            self._summary_start = t[0]
+        self._consumed += len(samples)
+        data = np.concatenate((self._tail, samples)) if len(self._tail) else samples
+        count = 0 if len(data) < self.nperseg else (len(data) - self.nperseg) // self.hop + 1
+        if count:
+            segments = np.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis=0)[::self.hop][:count]
+            # segments is (count, axes, nperseg)
+            segments = segments - segments.mean(axis=2, keepdims=True)
+            spectra = np.fft.rfft(segments * self.window, axis=2)
+            self._sum += (spectra.real ** 2 + spectra.imag ** 2).sum(axis=0).T
+            self._segments += count
+        # Keep what the next segment needs
+        self._tail = data[count * self.hop:].copy()
+
+    def psd(self):
+        # Current (frequencies, (frequencies, axes)) density estimate
+        if not self._segments:
+            return self.freqs, np.zeros_like(self._sum)
+        return self.freqs, self._sum * self.scale[:, None] / self._segments
+
+    def band_power(self, psd):
+        df = self.rate / self.nperseg
+        power = np.zeros((self._bands, self.axes))
+        inside = (self._band_of >= 0) & (self._band_of < self._bands)
+        np.add.at(power, self._band_of[inside], psd[inside] * df)
+        return power
+
+    def _summarise(self, end):
+        freqs, psd = self.psd()
+        summary = BandSummary(self._summary_start, end, self._segments, self.edges, self.band_power(psd))
+        self._sum[:] = 0
+        self._segments = 0
+        self._consumed = 0
+        self._summary_start = None
+        # Segments don't reach across summaries
+        self._tail = self._tail[:0]
+        self.summaries += 1
+        return summary
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import time
+
+    from imu_codec import load_chipdata
+
+    parser = argparse.ArgumentParser(description='Band powers of IMU data')
+    parser.add_argument('path', nargs='?', help='ChipData log, otherwise read from imu_service')
+    parser.add_argument('--rate', type=float, default=100.0)
+    parser.add_argument('--nperseg', type=int, default=128)
+    parser.add_argument('--cadence', type=float, default=5.0)
+    args = parser.parse_args()
+
+    def show(summary):
+        print('{:.2f}  {} segments  {} bytes packed'.format(summary.start, summary.segments, len(summary.pack())))
+        print('  band (Hz)    ' + ' '.join('{:>7s}'.format(name) for name in AXIS_NAMES))
+        for i, row in enumerate(summary.rms()):
+            print('  {:5.1f}-{:5.1f} '.format(summary.edges[i], summary.edges[i + 1]) +
+                  ' '.join('{:7.2f}'.format(v) for v in row))
+
+    psd = WelchPSD(args.rate, args.nperseg, cadence=args.cadence)
+    if args.path:
+        t, samples = load_chipdata(args.path)
+        started = time.perf_counter()
+        summaries = []
+        for i in range(0, len(samples), 50):
+            summaries += psd.feed(samples[i:i + 50], t[i:i + 50])
+        elapsed = time.perf_counter() - started
+        for summary in summaries:
+            show(summary)
+        print('{}: {} samples in {:.1f} ms'.format(os.path.basename(args.path), len(samples), elapsed * 1e3))
+    else:
+        from imu_service import IMUClient
+        client = IMUClient()
+        psd = WelchPSD(client.rate or args.rate, args.nperseg, cadence=args.cadence)
+        try:
+            while True:
+                client.wait()
+                t, samples = client.read_copy()
+                for summary in psd.feed(samples, t):
+                    show(summary)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.close()
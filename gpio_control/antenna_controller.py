@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+#
+# Antenna switching controller
+#
+# The antenna switch is driven by BCM pins 13 and 19, one pin per antenna as
+# in test_gpio.py. Instead of switching on a timer this keeps a quality
+# estimate per antenna from what the XBee tells us anyway: the RSSI of
+# received packets (ATDB, asked right after a frame came in) and whether our
+# transmissions were delivered (TX status). Every sample counts for the
+# antenna that was connected at the time.
+#
+# A switch needs the other antenna to be clearly better (hysteresis) and the
+# current one to have been in use for a while (dwell), so the switch doesn't
+# flap between two antennas that are about as good. Estimates of the unused
+# antenna go stale as the CubeSat turns, so every so often it is tried for a
+# few samples (probing). Switches wait until no transmission is waiting for
+# its status and nothing has been received for a moment, so they don't cut
+# a frame in half; if the link doesn't go quiet soon the switch is left for
+# a later decision. Then both pins are written back to back, which takes
+# microseconds.
+#
+#   controller = AntennaController(xbee)
+#   await controller.start()
+#
+#   python3 antenna_controller.py --port /dev/serial0
+#   python3 antenna_controller.py --fake --port /tmp/xbee/CATMAN1
+#
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Network_Configuration'))
+from xbee_async import DELIVERY_STATUS_SUCCESS, XBeeError  # noqa: E402
+
+# BCM pin of each antenna
+ANTENNA_PINS = (13, 19)
+
+
+class RPiGPIO(object):
+    # The real pins, through RPi.GPIO
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+    def setup(self, pin):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def output(self, pin, high):
+        self.GPIO.output(pin, self.GPIO.HIGH if high else self.GPIO.LOW)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class FakeGPIO(object):
+    # Remembers pin levels and every change, for testing without a Pi
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.levels = {}
+        self.log = []
+
+    def setup(self, pin):
+        self.levels[pin] = False
+
+    def output(self, pin, high):
+        if pin not in self.levels:
+            raise ValueError('pin {} not set up'.format(pin))
+        self.levels[pin] = bool(high)
+        self.log.append((self.clock(), pin, bool(high)))
+
+    def cleanup(self):
+        pass
+
+
+class AntennaStats(object):
+    def __init__(self, alpha=0.2):
+        # Weight of a new sample in the moving averages
+        self.alpha = alpha
+        self.rssi = None          # dBm
+        self.success = None       # fraction of transmissions delivered
+        self.samples = 0
+        self.updated = 0.0
+
+    def _average(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    def add_rssi(self, rssi, now):
+        self.rssi = self._average(self.rssi, rssi)
+        self.samples += 1
+        self.updated = now
+
+    def add_delivery(self, delivered, now):
+        self.success = self._average(self.success, 1.0 if delivered else 0.0)
+        self.samples += 1
+        self.updated = now
+
+    def metrics(self):
+        # Which of 'rssi' and 'success' we have samples of
+        return {name for name in ('rssi', 'success') if getattr(self, name) is not None}
+
+    def score(self, metrics=None):
+        # One percent of delivery ratio counts as much as one dB. Only the
+        # given metrics count, so two antennas are compared on what both
+        # have. None when one of them is unknown or nothing is known.
+        metrics = self.metrics() if metrics is None else set(metrics)
+        if not metrics or not metrics <= self.metrics():
+            return None
+        return (100.0 * self.success if 'success' in metrics else 0.0) + \
+            (self.rssi if 'rssi' in metrics else 0.0)
+
+
+def compare(a, b):
+    # (score of a, score of b) on the metrics both have, or None if they
+    # have none in common
+    common = a.metrics() & b.metrics()
+    if not common:
+        return None
+    return a.score(common), b.score(common)
+
+
+class AntennaController(object):
+    def __init__(self, xbee, gpio=None, pins=ANTENNA_PINS, alpha=0.2, hysteresis=3.0, dwell=2.0,
+                 probe_interval=30.0, probe_samples=6, probe_timeout=2.0, guard=0.005,
+                 max_wait=0.5, rssi_interval=0.1, settle=0.05, clock=time.monotonic):
+        self.xbee = xbee
+        self.gpio = gpio or RPiGPIO()
+        self.pins = pins
+        self.stats = [AntennaStats(alpha) for _ in pins]
+        # Score margin the other antenna needs before we switch to it, and
+        # seconds to stay on an antenna after switching
+        self.hysteresis = hysteresis
+        self.dwell = dwell
+        # Try the unused antenna when its estimate is this old, until it got
+        # probe_samples samples or probe_timeout seconds passed
+        self.probe_interval = probe_interval
+        self.probe_samples = probe_samples
+        self.probe_timeout = probe_timeout
+        # Quiet time needed on the serial port before a switch, and how long
+        # to wait for it at most
+        self.guard = guard
+        self.max_wait = max_wait
+        self.rssi_interval = rssi_interval
+        # Samples this soon after a switch may belong to either antenna
+        self.settle = settle
+        self.clock = clock
+
+        self.active = None
+        self.switched_at = 0.0
+        self._last_rx = 0.0
+        self._rssi_asked = 0.0
+        self._probing = None
+        self._subscription = None
+        self._task = None
+
+        self.switches = 0
+        self.probes = 0
+        self.switch_latency = 0.0   # seconds, the last pin update
+        self.deferred = 0           # switches that had to wait for quiet
+        self.abandoned = 0          # switches given up, never quiet enough
+
+    async def start(self, antenna=0, interval=0.1):
+        for pin in self.pins:
+            self.gpio.setup(pin)
+        self._set_pins(antenna)
+        self._subscription = self.xbee.subscribe(self._on_frame, ('rx', 'tx_status'))
+        self._task = asyncio.ensure_future(self._run(interval))
+        return self
+
+    def stop(self):
+        if self._subscription is not None:
+            self.xbee.unsubscribe(self._subscription)
+            self._subscription = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # ------------------------------------------------------------- samples
+
+    def _settled(self, now):
+        return now - self.switched_at >= self.settle
+
+    def _on_frame(self, frame):
+        now = self.clock()
+        if frame['id'] == 'rx':
+            self._last_rx = now
+            if self._settled(now) and now - self._rssi_asked >= self.rssi_interval:
+                self._rssi_asked = now
+                asyncio.ensure_future(self._sample_rssi(self.active))
+        elif frame['id'] == 'tx_status' and self._settled(now):
+            self.stats[self.active].add_delivery(frame['deliver_status'] == DELIVERY_STATUS_SUCCESS, now)
+
+    async def _sample_rssi(self, antenna):
+        try:
+            db = await self.xbee.at_command('DB', timeout=1.0)
+        except XBeeError:
+            return
+        if db and self.active == antenna:
+            self.stats[antenna].add_rssi(-db[-1], self.clock())
+
+    # ------------------------------------------------------------ switching
+
+    def _set_pins(self, antenna):
+        # Break before make: the old antenna is off before the new one is on
+        started = time.perf_counter()
+        for i, pin in enumerate(self.pins):
+            if i != antenna:
+                self.gpio.output(pin, False)
+        self.gpio.output(self.pins[antenna], True)
+        self.switch_latency = time.perf_counter() - started
+        self.active = antenna
+        self.switched_at = self.clock()
+
+    def _quiet(self):
+        return self.xbee.on_air == 0 and self.clock() - self._last_rx >= self.guard
+
+    async def switch(self, antenna):
+        # Switch once no frame is in the air. If that doesn't happen within
+        # max_wait, give up and leave it to the next step(); a switch must
+        # never cut a frame. Returns True if the pins were changed.
+        if antenna == self.active:
+            return False
+        deadline = self.clock() + self.max_wait
+        if not self._quiet():
+            self.deferred += 1
+            while not self._quiet():
+                if self.clock() >= deadline:
+                    self.abandoned += 1
+                    return False
+                await asyncio.sleep(self.guard / 2)
+        self._set_pins(antenna)
+        self.switches += 1
+        return True
+
+    def choose(self):
+        # The antenna we should be on now, from the estimates alone: the one
+        # furthest ahead of the current one, if that is by more than the
+        # hysteresis. Antennas with no metric in common aren't compared.
+        current = self.stats[self.active]
+        best, best_margin = self.active, self.hysteresis
+        for i, stats in enumerate(self.stats):
+            if i == self.active or not stats.metrics():
+                continue
+            if not current.metrics():
+                # Anything known beats nothing known
+                return i
+            scores = compare(stats, current)
+            if scores is not None and scores[0] - scores[1] > best_margin:
+                best, best_margin = i, scores[0] - scores[1]
+        return best
+
+    async def step(self):
+        # One decision. Called every interval by the background task.
+        now = self.clock()
+        if self._probing is not None:
+            antenna, started, samples = self._probing
+            if self.stats[antenna].samples - samples < self.probe_samples and now - started < self.probe_timeout:
+                return
+            self._probing = None
+            # Back to the better of the two, judged without hysteresis since
+            # the probe was our choice, not the link's. If the probe didn't
+            # tell us anything comparable, go back too.
+            other = 1 - antenna if len(self.stats) == 2 else self.choose()
+            scores = compare(self.stats[antenna], self.stats[other])
+            if scores is None or scores[1] > scores[0]:
+                if not await self.switch(other):
+                    # Try again next step
+                    self._probing = (antenna, started, samples)
+            return
+        if now - self.switched_at < self.dwell:
+            return
+        target = self.choose()
+        if target != self.active:
+            await self.switch(target)
+            return
+        for i, stats in enumerate(self.stats):
+            if i != self.active and now - stats.updated >= self.probe_interval:
+                if await self.switch(i):
+                    self.probes += 1
+                    self._probing = (i, self.clock(), stats.samples)
+                return
+
+    async def _run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.step()
+
+    def report(self):
+        parts = []
+        for i, stats in enumerate(self.stats):
+            parts.append('{}{}: rssi {} success {} score {}'.format(
+                '*' if i == self.active else ' ', i,
+                '{:.1f}'.format(stats.rssi) if stats.rssi is not None else '-',
+                '{:.2f}'.format(stats.success) if stats.success is not None else '-',
+                '{:.1f}'.format(stats.score()) if stats.score() is not None else '-'))
+        parts.append('switches {} probes {} deferred {} abandoned {} last switch {:.1f} us'.format(
+            self.switches, self.probes, self.deferred, self.abandoned, self.switch_latency * 1e6))
+        return '  '.join(parts)
+
+
+if __name__ == '__main__':
+    from xbee_async import XBeeClient
+
+    parser = argparse.ArgumentParser(description='Pick the better antenna from XBee link quality')
+    parser.add_argument('--port', default='/dev/serial0')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--fake', action='store_true', help='use fake GPIO instead of the Pi pins')
+    parser.add_argument('--report', type=float, default=5.0)
+    args = parser.parse_args()
+
+    async def main():
+        gpio = FakeGPIO() if args.fake else RPiGPIO()
+        async with XBeeClient(args.port, args.baud) as xbee:
+            controller = await AntennaController(xbee, gpio).start()
+            try:
+                while True:
+                    await asyncio.sleep(args.report)
+                    print(controller.report())
+            finally:
+                controller.stop()
+                gpio.cleanup()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
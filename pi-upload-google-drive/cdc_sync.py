@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+# Deduplicating sync of log trees using content-defined chunks.
+#
+# uploader.py cuts files at fixed offsets, which is fine for finished logs
+# but not for the copies of the same data lying around in
+# SpatialDataAcquisition, pos_data and repeated captures, or for logs that
+# keep growing: insert a byte near the start and every fixed chunk after it
+# changes. Here the cut points are chosen by the content itself. A gear
+# rolling hash runs over the data and a chunk ends wherever the hash of the
+# last 32 bytes has its low bits all zero (within a minimum and maximum
+# size), so the same bytes get the same cuts wherever they are in whichever
+# file. Appending to a log only changes its last chunk, and a file copied to
+# another directory costs nothing at all.
+#
+# A local index remembers how every file was chunked and which chunks the
+# remote side already has, so only new chunks are checked and sent. It keeps
+# that apart for every destination synced to. The remote is any uploader.py
+# backend: a directory or the upload_server.py stand-in.
+#
+#   python3 cdc_sync.py ../SpatialDataAcquisition ../pos_data --dest /mnt/usb/logs
+#   python3 cdc_sync.py /home/pi/sessions --url http://groundstation:8000
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from uploader import DirectoryBackend, HTTPBackend, MissingChunks, UploadError
+
+DEFAULT_MIN_SIZE = 2048
+DEFAULT_AVG_SIZE = 8192
+DEFAULT_MAX_SIZE = 65536
+
+# Bytes of history the hash depends on
+WINDOW = 32
+
+# Fixed random table for the gear hash. Changing it changes every cut.
+GEAR = np.random.RandomState(0x5EED).randint(0, 1 << 32, 256, dtype=np.uint64).astype(np.uint32)
+
+READ_SIZE = 1 << 22
+
+
+def gear_hash(data):
+    # Hash at every position of data, uint32. The hash at i is
+    # sum(GEAR[data[i - k]] << k for k < 32), i.e. the rolling
+    # h = (h << 1) + GEAR[byte], computed for all positions at once.
+    g = GEAR[np.frombuffer(data, np.uint8)]
+    h = g.copy()
+    for k in range(1, WINDOW):
+        h[k:] += g[:-k] << np.uint32(k)
+    return h
+
+
+class Chunker(object):
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, avg_size=DEFAULT_AVG_SIZE, max_size=DEFAULT_MAX_SIZE):
+        if min_size < WINDOW or not min_size <= avg_size <= max_size:
+            raise ValueError('need {} <= min_size <= avg_size <= max_size'.format(WINDOW))
+        self.min_size = min_size
+        self.max_size = max_size
+        # Cut where the hash is 0 under the mask. Past min_size a cut is
+        # expected every 2**bits bytes.
+        bits = max(1, int(round(np.log2(max(avg_size - min_size, 2)))))
+        self.mask = np.uint32((1 << bits) - 1)
+
+    def cuts(self, data, final=True):
+        # Chunk end offsets in data, which starts at a chunk boundary. With
+        # final=False the tail after the last real cut is left for the next
+        # call.
+        candidates = np.flatnonzero((gear_hash(data) & self.mask) == 0) + 1
+        cuts = []
+        start = 0
+        n = len(data)
+        while n - start > 0:
+            i = np.searchsorted(candidates, start + self.min_size, 'left')
+            if i < len(candidates) and candidates[i] <= start + self.max_size:
+                end = int(candidates[i])
+            elif n - start >= self.max_size:
+                end = start + self.max_size
+            elif final:
+                end = n
+            else:
+                break
+            cuts.append(end)
+            start = end
+        return cuts
+
+    def chunks(self, f):
+        # Yields (offset, data) for a file object, reading in big blocks
+        buffer = b''
+        offset = 0
+        while True:
+            block = f.read(READ_SIZE)
+            buffer += block
+            final = not block
+            start = 0
+            for end in self.cuts(buffer, final):
+                yield offset + start, buffer[start:end]
+                start = end
+            offset += start
+            buffer = buffer[start:]
+            if final:
+                return
+
+
+class ChunkIndex(object):
+    # Local record of files and chunks sent to one destination (a backend's
+    # location()), kept as JSON next to the data. The same file holds the
+    # records of other destinations, untouched.
+    def __init__(self, path, location):
+        self.path = path
+        self.location = location
+        # name -> {'size', 'mtime', 'sha256', 'chunks': [[digest, size], ...]}
+        self.files = {}
+        # Digests the remote side is known to have
+        self.remote = set()
+        self._others = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._others = json.load(f).get('destinations', {})
+            mine = self._others.pop(location, None)
+            if mine is not None:
+                self.files = mine['files']
+                self.remote = set(mine['remote'])
+
+    def save(self):
+        destinations = dict(self._others)
+        destinations[self.location] = {'files': self.files, 'remote': sorted(self.remote)}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'destinations': destinations}, f)
+        os.replace(tmp, self.path)
+
+
+class ChunkSync(object):
+    def __init__(self, backend, index, chunker=None, save_every=256):
+        if index.location != backend.location():
+            raise ValueError('index is for {}, not {}'.format(index.location, backend.location()))
+        self.backend = backend
+        self.index = index
+        self.chunker = chunker or Chunker()
+        # Save the index after this many chunks sent, so an interrupted big
+        # file doesn't have to ask about all of them again
+        self.save_every = save_every
+        self._unsaved = 0
+
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        self.chunks_sent = 0
+        self.chunks_skipped = 0
+
+    def _send(self, digest, data):
+        # Send one chunk unless the remote has it
+        if digest not in self.index.remote and not self.backend.has_chunk(digest):
+            self.backend.put_chunk(digest, data)
+            self.chunks_sent += 1
+            self.bytes_sent += len(data)
+            self._unsaved += 1
+        else:
+            self.chunks_skipped += 1
+            self.bytes_skipped += len(data)
+        self.index.remote.add(digest)
+        if self._unsaved >= self.save_every:
+            self.index.save()
+            self._unsaved = 0
+
+    def _resend(self, path, chunks, missing):
+        # Send the chunks the remote lost again, read back from the file
+        missing = set(missing)
+        self.index.remote -= missing
+        offset = 0
+        with open(path, 'rb') as f:
+            for digest, size in chunks:
+                if digest in missing:
+                    f.seek(offset)
+                    data = f.read(size)
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        raise UploadError('{} changed while syncing'.format(path))
+                    self._send(digest, data)
+                offset += size
+
+    def sync_file(self, path, name):
+        # Returns False if the file is unchanged since the last sync
+        stat = os.stat(path)
+        entry = self.index.files.get(name)
+        if entry is not None and (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+            return False
+
+        whole = hashlib.sha256()
+        chunks = []
+        with open(path, 'rb') as f:
+            for offset, data in self.chunker.chunks(f):
+                digest = hashlib.sha256(data).hexdigest()
+                whole.update(data)
+                chunks.append([digest, len(data)])
+                self._send(digest, data)
+        size = sum(c[1] for c in chunks)
+        manifest = {'size': size, 'sha256': whole.hexdigest(), 'chunks': [c[0] for c in chunks]}
+        try:
+            self.backend.put_file(name, manifest)
+        except MissingChunks as e:
+            # The index said the remote had them, but it doesn't (any more).
+            # Send them again, once.
+            self._resend(path, chunks, e.missing)
+            self.backend.put_file(name, manifest)
+        self.index.files[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': whole.hexdigest(),
+                                  'chunks': chunks}
+        self.index.save()
+        self._unsaved = 0
+        return True
+
+    def sync_tree(self, directory, prefix=None):
+        # Sync every file under directory as prefix/relative path. Returns
+        # the names that were sent.
+        prefix = prefix if prefix is not None else os.path.basename(os.path.abspath(directory))
+        synced = []
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__pycache__')
+            for filename in sorted(files):
+                if filename.startswith('.') or filename.endswith(('.tmp', '.pyc')):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.join(prefix, os.path.relpath(path, directory))
+                if self.sync_file(path, name):
+                    synced.append(name)
+        return synced
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync directories, sending only chunks the remote lacks')
+    parser.add_argument('directories', nargs='+')
+    parser.add_argument('--url', help='upload server, e.g. http://groundstation:8000')
+    parser.add_argument('--dest', help='sync into this directory instead')
+    parser.add_argument('--index', default='.cdc_index.json', help='local chunk index, kept per destination')
+    parser.add_argument('--min-size', type=int, default=DEFAULT_MIN_SIZE)
+    parser.add_argument('--avg-size', type=int, default=DEFAULT_AVG_SIZE)
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_SIZE)
+    args = parser.parse_args()
+
+    if args.url:
+        backend = HTTPBackend(args.url)
+    elif args.dest:
+        backend = DirectoryBackend(args.dest)
+    else:
+        parser.error('give --url or --dest')
+    index = ChunkIndex(args.index, backend.location())
+    sync = ChunkSync(backend, index, Chunker(args.min_size, args.avg_size, args.max_size))
+    try:
+        for directory in args.directories:
+            for name in sync.sync_tree(directory):
+                print('synced', name)
+    finally:
+        backend.close()
+    print('sent {} chunks, {} bytes; {} bytes already there'.format(
+        sync.chunks_sent, sync.bytes_sent, sync.bytes_skipped))
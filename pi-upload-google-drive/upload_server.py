@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Stand-in upload server for uploader.py.
+#
+# Stores chunks by SHA-256 and assembles files from their manifests, see
+# HTTPBackend in uploader.py for the protocol. Good enough to receive logs on
+# the ground station laptop and to test the uploader against. --fail drops
+# that fraction of requests half way through, like flaky Wi-Fi does.
+#
+#   python3 upload_server.py received --port 8000 --fail 0.1
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from uploader import UploadError, assemble
+
+
+def is_digest(value):
+    # A chunk name: 64 lowercase hex characters, nothing that could be a path
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the uploader's connection pool is worth something
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _flaky(self):
+        if random.random() < self.server.fail:
+            self.close_connection = True
+            return True
+        return False
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.server.directory, 'chunks', digest)
+
+    def _file_path(self, name):
+        # Resolved like assemble() does, None if it would leave files/
+        files = os.path.realpath(os.path.join(self.server.directory, 'files'))
+        path = os.path.realpath(os.path.join(files, os.path.normpath('/' + name).lstrip('/')))
+        if os.path.commonpath((files, path)) != files:
+            return None
+        return path
+
+    def _route(self):
+        parts = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] not in ('chunks', 'files') or not parts[1]:
+            return None, None
+        if parts[0] == 'chunks' and not is_digest(parts[1]):
+            return None, None
+        return parts
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self):
+        kind, name = self._route()
+        if kind == 'chunks':
+            path = self._chunk_path(name)
+        else:
+            path = self._file_path(name) if kind == 'files' else None
+        self._reply(200 if path is not None and os.path.isfile(path) else 404)
+
+    def do_GET(self):
+        kind, name = self._route()
+        if kind == 'chunks':
+            path = self._chunk_path(name)
+        else:
+            path = self._file_path(name) if kind == 'files' else None
+        if path is None or not os.path.isfile(path):
+            self._reply(404)
+            return
+        with open(path, 'rb') as f:
+            self._reply(200, f.read())
+
+    def do_PUT(self):
+        kind, name = self._route()
+        if kind is None:
+            self._reply(404)
+            return
+        body = self._body()
+        if self._flaky():
+            # Drop the connection without an answer
+            return
+        if kind == 'chunks':
+            if hashlib.sha256(body).hexdigest() != name:
+                self._reply(400, b'hash mismatch')
+                return
+            path = self._chunk_path(name)
+            tmp = '{}.{}.tmp'.format(path, id(self))
+            with open(tmp, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, path)
+            self._reply(201)
+        else:
+            try:
+                manifest = json.loads(body.decode('utf-8'))
+                if not isinstance(manifest['chunks'], list) or not all(is_digest(d) for d in manifest['chunks']):
+                    raise ValueError('bad chunk digest in manifest')
+                missing = [d for d in manifest['chunks'] if not os.path.exists(self._chunk_path(d))]
+                if missing:
+                    self._reply(409, json.dumps({'missing': missing}).encode('utf-8'))
+                    return
+                assemble(os.path.join(self.server.directory, 'files'), name, manifest, self._chunk_path)
+            except (ValueError, KeyError, UploadError) as e:
+                self._reply(400, str(e).encode('utf-8'))
+                return
+            self._reply(201)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(directory, host='0.0.0.0', port=8000, fail=0.0, verbose=False):
+    os.makedirs(os.path.join(directory, 'chunks'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'files'), exist_ok=True)
+    server = ThreadingHTTPServer((host, port), UploadHandler)
+    server.daemon_threads = True
+    server.directory = directory
+    server.fail = fail
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Receive uploads from uploader.py')
+    parser.add_argument('directory')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of uploads to drop')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = make_server(args.directory, args.host, args.port, args.fail, args.verbose)
+    print('serving {} on {}:{}'.format(args.directory, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
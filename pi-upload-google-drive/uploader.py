@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+
+# Background uploader for session logs.
+#
+# Watches the session directory and uploads every finished file. Files are
+# cut into fixed size chunks named by their SHA-256, so a chunk that is
+# already in storage is never sent twice, and the chunks go up several at a
+# time over a small pool of kept-alive HTTP connections. What has been
+# uploaded is recorded in a manifest per file under the state directory
+# (one per destination), written after every chunk, so when the Wi-Fi drops half way through a
+# 200 MB log the next attempt carries on from where it stopped instead of
+# starting over. If the destination lost chunks the manifest says are there,
+# they are sent again. A token bucket shared by all workers, charged per
+# slice as the bytes are written, keeps the total under a bandwidth cap so
+# the uploads don't starve the ground station link.
+#
+# Where the chunks go is up to the backend. HTTPBackend talks to anything
+# that speaks the small protocol of upload_server.py (which is also the
+# stand-in for tests), DirectoryBackend copies into a directory, e.g. a
+# folder synced to Google Drive.
+#
+#   python3 uploader.py /home/pi/sessions --url http://groundstation:8000 \
+#       --limit 200000
+#
+# A file is only uploaded once its size and modification time have not
+# changed for --settle seconds, so logs still being written are left alone.
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_STATE_DIR = '.upload_state'
+
+# Bytes written at a time, each slice is charged to the rate limiter
+WRITE_SLICE = 16384
+
+
+class UploadError(Exception):
+    pass
+
+
+class MissingChunks(UploadError):
+    # put_file() found chunks missing on the destination
+    def __init__(self, name, missing):
+        super(MissingChunks, self).__init__('{}: {} chunks missing'.format(name, len(missing)))
+        self.missing = missing
+
+
+class RateLimiter(object):
+    # Token bucket in bytes per second, shared between threads
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.clock = clock
+        self.tokens = self.burst
+        self.stamp = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        # Block until size bytes may be sent. Sizes above the burst wait for
+        # a full bucket and then take it all.
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                need = min(size, self.burst)
+                if self.tokens >= need:
+                    self.tokens -= size
+                    return
+                wait = (need - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# ---------------------------------------------------------------- backends
+
+class Backend(object):
+    # Where the chunks and file manifests go. Methods are called from
+    # several worker threads at once.
+
+    # Set by the user of the backend to throttle put_chunk()
+    limiter = None
+
+    def location(self):
+        # Identifies the destination, to keep separate records per destination
+        raise NotImplementedError
+
+    def _slices(self, data):
+        # data in WRITE_SLICE pieces, each allowed through the limiter first
+        view = memoryview(data)
+        for start in range(0, len(view), WRITE_SLICE):
+            piece = view[start:start + WRITE_SLICE]
+            if self.limiter is not None:
+                self.limiter.acquire(len(piece))
+            yield piece
+
+    def has_chunk(self, digest):
+        raise NotImplementedError
+
+    def put_chunk(self, digest, data):
+        raise NotImplementedError
+
+    def put_file(self, name, manifest):
+        # Called once all chunks of a file are stored. manifest has 'size',
+        # 'sha256' and 'chunks', the list of chunk digests in order. Raises
+        # MissingChunks if the destination lacks some of them.
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DirectoryBackend(Backend):
+    # Chunks under directory/chunks, finished files assembled under
+    # directory/files
+    def __init__(self, directory):
+        self.directory = directory
+        self.chunks = os.path.join(directory, 'chunks')
+        self.files = os.path.join(directory, 'files')
+        os.makedirs(self.chunks, exist_ok=True)
+        os.makedirs(self.files, exist_ok=True)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks, digest)
+
+    def location(self):
+        return os.path.abspath(self.directory)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self._chunk_path(digest))
+
+    def put_chunk(self, digest, data):
+        path = self._chunk_path(digest)
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            for piece in self._slices(data):
+                f.write(piece)
+        os.replace(tmp, path)
+
+    def put_file(self, name, manifest):
+        missing = [d for d in manifest['chunks'] if not self.has_chunk(d)]
+        if missing:
+            raise MissingChunks(name, missing)
+        assemble(self.files, name, manifest, self._chunk_path)
+
+
+class HTTPBackend(Backend):
+    # The protocol of upload_server.py:
+    #
+    #   HEAD /chunks/<sha256>    200 if stored, 404 if not
+    #   PUT  /chunks/<sha256>    body is the chunk, checked against the name
+    #   PUT  /files/<name>       body is the JSON manifest, the server builds
+    #                            the file from its chunks
+    def __init__(self, url, connections=4, timeout=30.0):
+        self.url = url
+        url = urllib.parse.urlsplit(url)
+        self.https = url.scheme == 'https'
+        self.host = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        # Kept-alive connections, handed to one worker at a time
+        self._pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all = []
+        for _ in range(connections):
+            self._pool.put(None)
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = cls(self.host, timeout=self.timeout)
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    def _request(self, method, path, body=None, headers=None):
+        conn = self._pool.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            try:
+                conn.request(method, self.prefix + path, body, headers or {})
+                response = conn.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException):
+                # Broken connection, the next request opens a new one
+                conn.close()
+                conn = None
+                raise
+            return response.status, content
+        finally:
+            self._pool.put(conn)
+
+    def location(self):
+        return self.url
+
+    def has_chunk(self, digest):
+        status, _ = self._request('HEAD', '/chunks/' + digest)
+        return status == 200
+
+    def put_chunk(self, digest, data):
+        # Sent slice by slice, with the length given so it isn't chunked
+        status, content = self._request('PUT', '/chunks/' + digest, self._slices(data),
+                                        {'Content-Type': 'application/octet-stream',
+                                         'Content-Length': str(len(data))})
+        if status not in (200, 201, 204):
+            raise UploadError('chunk {}: HTTP {} {}'.format(digest, status, content[:200]))
+
+    def put_file(self, name, manifest):
+        body = json.dumps(manifest).encode('utf-8')
+        status, content = self._request('PUT', '/files/' + urllib.parse.quote(name), body,
+                                        {'Content-Type': 'application/json'})
+        if status == 409:
+            try:
+                missing = json.loads(content.decode('utf-8'))['missing']
+            except (ValueError, KeyError):
+                missing = None
+            if missing:
+                raise MissingChunks(name, missing)
+        if status not in (200, 201, 204):
+            raise UploadError('{}: HTTP {} {}'.format(name, status, content[:200]))
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+
+
+def assemble(directory, name, manifest, chunk_path):
+    # Build a file from stored chunks and check its hash. Shared by
+    # DirectoryBackend and upload_server.py.
+    path = os.path.join(directory, os.path.normpath('/' + name).lstrip('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sha = hashlib.sha256()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as out:
+        for digest in manifest['chunks']:
+            with open(chunk_path(digest), 'rb') as f:
+                data = f.read()
+            sha.update(data)
+            out.write(data)
+    if sha.hexdigest() != manifest['sha256'] or os.path.getsize(tmp) != manifest['size']:
+        os.remove(tmp)
+        raise UploadError('{}: assembled file does not match its manifest'.format(name))
+    os.replace(tmp, path)
+    return path
+
+
+# ----------------------------------------------------------------- manifest
+
+class Manifest(object):
+    # Upload progress of one file, saved as JSON in the state directory
+    def __init__(self, path, state_dir, name):
+        self.name = name
+        self.path = os.path.join(state_dir, name.replace(os.sep, '__') + '.json')
+        self.source = path
+        self.size = None
+        self.mtime = None
+        self.sha256 = None
+        self.chunk_size = None
+        self.chunks = []
+        self.uploaded = set()
+        self.done = False
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.size, self.mtime = data['size'], data['mtime']
+            self.sha256, self.chunk_size = data['sha256'], data['chunk_size']
+            self.chunks = data['chunks']
+            self.uploaded = set(data['uploaded'])
+            self.done = data['done']
+
+    def matches(self, size, mtime, chunk_size):
+        return (self.size, self.mtime, self.chunk_size) == (size, mtime, chunk_size)
+
+    def reset(self, size, mtime, chunk_size):
+        self.size, self.mtime, self.chunk_size = size, mtime, chunk_size
+        self.sha256 = None
+        self.chunks = []
+        self.uploaded = set()
+        self.done = False
+
+    def mark(self, digest):
+        with self._lock:
+            self.uploaded.add(digest)
+            self.save()
+
+    def unmark(self, digests):
+        with self._lock:
+            self.uploaded.difference_update(digests)
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'name': self.name, 'size': self.size, 'mtime': self.mtime, 'sha256': self.sha256,
+                       'chunk_size': self.chunk_size, 'chunks': self.chunks,
+                       'uploaded': sorted(self.uploaded), 'done': self.done}, f)
+        os.replace(tmp, self.path)
+
+
+def hash_chunks(path, chunk_size):
+    # (sha256 of the file, [sha256 of each chunk])
+    whole = hashlib.sha256()
+    chunks = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            whole.update(block)
+            chunks.append(hashlib.sha256(block).hexdigest())
+    return whole.hexdigest(), chunks
+
+
+# ----------------------------------------------------------------- uploader
+
+class Uploader(object):
+    def __init__(self, backend, state_dir=DEFAULT_STATE_DIR, chunk_size=DEFAULT_CHUNK_SIZE, workers=4,
+                 limit=None, retries=5, backoff=2.0):
+        self.backend = backend
+        # Manifests say what one destination has, so keep them apart
+        self.state_dir = os.path.join(state_dir, hashlib.sha256(backend.location().encode('utf-8')).hexdigest()[:16])
+        self.chunk_size = chunk_size
+        self.limiter = RateLimiter(limit)
+        backend.limiter = self.limiter
+        self.retries = retries
+        self.backoff = backoff
+        self._pool = ThreadPoolExecutor(workers)
+
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+        self.chunks_skipped = 0
+        self.files_done = 0
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def close(self):
+        self._pool.shutdown()
+        self.backend.close()
+
+    def _retry(self, fn, *args):
+        delay = 1.0
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except MissingChunks:
+                # Trying the same again won't help
+                raise
+            except (OSError, http.client.HTTPException, UploadError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= self.backoff
+
+    def _upload_chunk(self, manifest, index):
+        digest = manifest.chunks[index]
+        if self._retry(self.backend.has_chunk, digest):
+            self.chunks_skipped += 1
+        else:
+            with open(manifest.source, 'rb') as f:
+                f.seek(index * manifest.chunk_size)
+                data = f.read(manifest.chunk_size)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise UploadError('{} changed while uploading'.format(manifest.source))
+            self._retry(self.backend.put_chunk, digest, data)
+            self.chunks_sent += 1
+            self.bytes_sent += len(data)
+        manifest.mark(digest)
+
+    def _upload_missing(self, manifest):
+        # The same chunk can appear twice in a file, upload it once
+        todo = {}
+        for index, digest in enumerate(manifest.chunks):
+            if digest not in manifest.uploaded:
+                todo.setdefault(digest, index)
+        for future in [self._pool.submit(self._upload_chunk, manifest, i) for i in todo.values()]:
+            future.result()
+
+    def upload(self, path, name=None):
+        # Upload one file, resuming if it was interrupted before. Returns
+        # False if it was already uploaded.
+        name = name or os.path.basename(path)
+        stat = os.stat(path)
+        manifest = Manifest(path, self.state_dir, name)
+        if not manifest.matches(stat.st_size, stat.st_mtime, self.chunk_size):
+            manifest.reset(stat.st_size, stat.st_mtime, self.chunk_size)
+        if manifest.done:
+            return False
+        if manifest.sha256 is None:
+            manifest.sha256, manifest.chunks = hash_chunks(path, self.chunk_size)
+            manifest.save()
+
+        self._upload_missing(manifest)
+        file_manifest = {'size': manifest.size, 'sha256': manifest.sha256, 'chunks': manifest.chunks}
+        try:
+            self._retry(self.backend.put_file, name, file_manifest)
+        except MissingChunks as e:
+            # The destination lost chunks we sent, or isn't the one we sent
+            # them to. Send them again, once.
+            manifest.unmark(e.missing)
+            self._upload_missing(manifest)
+            self._retry(self.backend.put_file, name, file_manifest)
+        manifest.done = True
+        manifest.save()
+        self.files_done += 1
+        return True
+
+    def scan(self, directory, settle=30.0):
+        # Upload every file under directory that has settled. Failures are
+        # reported and retried on the next scan.
+        now = time.time()
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in sorted(files):
+                if filename.startswith('.') or filename.endswith(('.part', '.part.json', '.tmp')):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    if now - os.path.getmtime(path) < settle:
+                        continue
+                    if self.upload(path, os.path.relpath(path, directory)):
+                        print('uploaded', path)
+                except (OSError, http.client.HTTPException, UploadError) as e:
+                    print('{}: {}'.format(path, e))
+
+    def watch(self, directory, interval=10.0, settle=30.0):
+        while True:
+            self.scan(directory, settle)
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upload session logs in the background')
+    parser.add_argument('directory', help='session log directory to watch')
+    parser.add_argument('--url', help='upload server, e.g. http://groundstation:8000')
+    parser.add_argument('--dest', help='copy into this directory instead, e.g. a synced Drive folder')
+    parser.add_argument('--state', default=None, help='manifest directory, default DIRECTORY/' + DEFAULT_STATE_DIR)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--limit', type=float, help='bytes per second for all uploads together')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between scans')
+    parser.add_argument('--settle', type=float, default=30.0, help='seconds a file must be unchanged')
+    parser.add_argument('--once', action='store_true', help='scan once and exit')
+    args = parser.parse_args()
+
+    if args.url:
+        backend = HTTPBackend(args.url, args.workers)
+    elif args.dest:
+        backend = DirectoryBackend(args.dest)
+    else:
+        parser.error('give --url or --dest')
+    uploader = Uploader(backend, args.state or os.path.join(args.directory, DEFAULT_STATE_DIR),
+                        args.chunk_size, args.workers, args.limit)
+    try:
+        if args.once:
+            uploader.scan(args.directory, args.settle)
+        else:
+            uploader.watch(args.directory, args.interval, args.settle)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        uploader.close()